@@ -0,0 +1,262 @@
+"""Page-view trends and site totals, rolled up ahead of the admin dashboard.
+
+The dashboard used to count every post, user and comment on each load, and
+the only traffic figure was each post's lifetime ``views``.
+
+Views: every flush of the buffered view counter (see view_counter.py)
+appends one ``analytics_event`` row per post, stamped with the hour of the
+flush, in the same transaction as the ``views`` update. Events are only
+ever inserted, so flushes from different workers never wait on each other's
+rows. ``flask analytics-rollup`` removes pending events with ``DELETE ...
+RETURNING`` and adds them to three tables:
+
+* ``post_views_hourly``: views per post per hour, kept for
+  ``ANALYTICS_HOURLY_DAYS`` days.
+* ``post_views_daily``: views per post per day, kept for
+  ``ANALYTICS_DAILY_DAYS`` days.
+* ``site_views_daily``: views per day for the whole site. It is kept for
+  good, at one row a day.
+
+The events are deleted and the aggregates updated in one transaction, so
+overlapping runs never count an event twice. The ``analytics`` process in
+the Procfile runs the rollup with ``--watch``. Events for posts deleted in
+the meantime count only toward the site.
+
+Totals: ``analytics_counter`` holds the number of posts, users and comments,
+and the rolled-up views of existing posts. Session hooks adjust the counts
+in the same transaction as the inserts and deletes, and take a deleted
+post's views off the total. Code that deletes rows through Core
+calls ``adjust()`` itself. A counter that doesn't exist yet is computed once
+from the tables, and ``analytics-rollup --recount`` recomputes all of them,
+e.g. after a bulk load.
+
+Configuration (``app.config``):
+
+    ANALYTICS_HOURLY_DAYS    7
+    ANALYTICS_DAILY_DAYS     400
+    ANALYTICS_TREND_DAYS     30
+    ANALYTICS_ROLLUP_BATCH   10000 (events per transaction)
+"""
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import delete, event, func, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+# Keeps IN lists under SQLite's bound-parameter limit
+BATCH = 500
+
+
+def _hour(value):
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+class Analytics:
+    def __init__(self, app=None, db=None, view_counter=None, counted=None, **tables):
+        if app is not None:
+            self.init_app(app, db, view_counter, counted, **tables)
+
+    def init_app(self, app, db, view_counter, counted, event_table, hourly, daily, site_daily, counter):
+        """``counted`` maps counter names to the models whose rows they count, e.g. ``{'posts': Post}``.
+
+        The ``'posts'`` model also provides the titles of top posts and the
+        ``views`` column that the views total starts from.
+        """
+        app.config.setdefault('ANALYTICS_HOURLY_DAYS', 7)
+        app.config.setdefault('ANALYTICS_DAILY_DAYS', 400)
+        app.config.setdefault('ANALYTICS_TREND_DAYS', 30)
+        app.config.setdefault('ANALYTICS_ROLLUP_BATCH', 10000)
+        self.app = app
+        self.db = db
+        self.counted = dict(counted)
+        self.post = self.counted['posts']
+        self.event = event_table
+        self.hourly = hourly
+        self.daily = daily
+        self.site_daily = site_daily
+        self.counter = counter
+        app.extensions['analytics'] = self
+        view_counter.on_flush(self._record)
+        event.listen(db.session, 'before_flush', self._forget_views)
+        event.listen(db.session, 'after_flush', self._count_changes)
+
+        @app.cli.command('analytics-rollup')
+        @click.option('--watch', is_flag=True, help='Keep running and roll up every --interval seconds.')
+        @click.option('--interval', default=60, show_default=True, help='Seconds between runs with --watch.')
+        @click.option('--recount', is_flag=True, help='Recompute every total from the tables first.')
+        def rollup_command(watch, interval, recount):
+            """Roll pending view events up into the hourly and daily tables."""
+            if recount:
+                totals = self.recount()
+                click.echo('Totals: ' + ', '.join(f'{value:,} {name}' for name, value in sorted(totals.items())))
+            while True:
+                views = self.rollup()
+                if views or not watch:
+                    click.echo(f'Rolled up {views} views.')
+                if not watch:
+                    break
+                time.sleep(interval)
+
+    @property
+    def names(self):
+        return (*self.counted, 'views')
+
+    # Dashboard
+
+    def totals(self):
+        """``{name: value}`` for every counter; counters that don't exist yet are computed first."""
+        counter = self.counter
+        values = dict(self.db.session.execute(select(counter.c.name, counter.c.value)).all())
+        missing = [name for name in self.names if name not in values]
+        if missing:
+            values.update(self.recount(missing))
+        return values
+
+    def trend(self, days=None):
+        """``[(date, views)]`` for the last ``days`` days, oldest first, with 0 for days without views."""
+        days = days or self.app.config['ANALYTICS_TREND_DAYS']
+        table = self.site_daily
+        today = datetime.utcnow().date()
+        first = today - timedelta(days=days - 1)
+        views = dict(self.db.session.execute(select(table.c.day, table.c.views).where(table.c.day >= first)).all())
+        return [(day, views.get(day, 0)) for day in (first + timedelta(days=i) for i in range(days))]
+
+    def hourly_trend(self, hours=24):
+        """``[(hour, views)]`` for the whole site over the last ``hours`` hours, oldest first."""
+        table = self.hourly
+        current = _hour(datetime.utcnow())
+        first = current - timedelta(hours=hours - 1)
+        views = dict(self.db.session.execute(select(table.c.hour, func.sum(table.c.views))
+                                             .where(table.c.hour >= first).group_by(table.c.hour)).all())
+        return [(hour, views.get(hour, 0)) for hour in (first + timedelta(hours=i) for i in range(hours))]
+
+    def top_posts(self, days=7, limit=5, options=()):
+        """``[(post, views)]`` for the most viewed posts of the last ``days`` days."""
+        Post, table = self.post, self.daily
+        first = datetime.utcnow().date() - timedelta(days=days - 1)
+        total = func.sum(table.c.views)
+        rows = self.db.session.execute(select(table.c.post_id, total).where(table.c.day >= first)
+                                       .group_by(table.c.post_id).order_by(total.desc(), table.c.post_id.desc())
+                                       .limit(limit)).all()
+        if not rows:
+            return []
+        posts = {p.id: p for p in Post.query.options(*options).filter(Post.id.in_([r[0] for r in rows]))}
+        return [(posts[post_id], views) for post_id, views in rows if post_id in posts]
+
+    # Counters
+
+    def adjust(self, conn, deltas):
+        """Apply ``{name: change}`` to the counters on ``conn``."""
+        counter = self.counter
+        for name, change in deltas.items():
+            if change:
+                conn.execute(update(counter).where(counter.c.name == name).values(value=counter.c.value + change))
+
+    def recount(self, names=None):
+        """Recompute counters from the tables; returns ``{name: value}``."""
+        names = list(names or self.names)
+        with self.app.app_context(), self.db.engine.begin() as conn:
+            values = {}
+            for name in names:
+                if name == 'views':
+                    # Views still waiting in events are added to the total by their rollup
+                    values[name] = conn.execute(self._rolled_up_views()).scalar() or 0
+                else:
+                    values[name] = conn.execute(select(func.count()).select_from(self.counted[name])).scalar()
+            self._upsert(conn, self.counter, ('name',), [{'name': n, 'value': v} for n, v in values.items()],
+                         replace=True)
+        return values
+
+    # Rollup
+
+    def rollup(self):
+        """Move pending view events into the aggregates and apply retention; returns the views rolled up."""
+        rolled_up = 0
+        batch = self.app.config['ANALYTICS_ROLLUP_BATCH']
+        with self.app.app_context():
+            while True:
+                with self.db.engine.begin() as conn:
+                    count, views = self._rollup_batch(conn, batch)
+                rolled_up += views
+                if count < batch:
+                    break
+            with self.db.engine.begin() as conn:
+                now = datetime.utcnow()
+                hourly, daily = self.hourly, self.daily
+                conn.execute(delete(hourly).where(
+                    hourly.c.hour < _hour(now) - timedelta(days=self.app.config['ANALYTICS_HOURLY_DAYS'])))
+                conn.execute(delete(daily).where(
+                    daily.c.day < now.date() - timedelta(days=self.app.config['ANALYTICS_DAILY_DAYS'])))
+        return rolled_up
+
+    def _rollup_batch(self, conn, batch):
+        table = self.event
+        oldest = select(table.c.id).order_by(table.c.id).limit(batch)
+        rows = conn.execute(delete(table).where(table.c.id.in_(oldest))
+                            .returning(table.c.post_id, table.c.hour, table.c.views)).all()
+        if not rows:
+            return 0, 0
+        hourly, daily, site = Counter(), Counter(), Counter()
+        for post_id, hour, views in rows:
+            hourly[post_id, hour] += views
+            daily[post_id, hour.date()] += views
+            site[hour.date()] += views
+        ids = list({post_id for post_id, _ in daily})
+        existing = set()
+        for first in range(0, len(ids), BATCH):
+            existing.update(conn.execute(select(self.post.id).where(self.post.id.in_(ids[first:first + BATCH]))).scalars())
+        self._upsert(conn, self.hourly, ('post_id', 'hour'), [
+            {'post_id': post_id, 'hour': hour, 'views': views}
+            for (post_id, hour), views in hourly.items() if post_id in existing])
+        self._upsert(conn, self.daily, ('post_id', 'day'), [
+            {'post_id': post_id, 'day': day, 'views': views}
+            for (post_id, day), views in daily.items() if post_id in existing])
+        self._upsert(conn, self.site_daily, ('day',), [{'day': day, 'views': views} for day, views in site.items()])
+        self.adjust(conn, {'views': sum(views for (post_id, _), views in daily.items() if post_id in existing)})
+        return len(rows), sum(site.values())
+
+    def _rolled_up_views(self, post_ids=None):
+        # Views still waiting in events are added to the total by their rollup
+        Post, table = self.post, self.event
+        flushed = select(func.coalesce(func.sum(Post.views), 0))
+        pending = select(func.coalesce(func.sum(table.c.views), 0)).where(table.c.post_id.in_(select(Post.id)))
+        if post_ids is not None:
+            flushed = flushed.where(Post.id.in_(post_ids))
+            pending = pending.where(table.c.post_id.in_(post_ids))
+        return select(flushed.scalar_subquery() - pending.scalar_subquery())
+
+    def _upsert(self, conn, table, keys, rows, replace=False):
+        """Insert ``rows``, or add their ``views`` (set their ``value`` with ``replace``) where ``keys`` exist."""
+        if not rows:
+            return
+        dialect = postgresql if conn.dialect.name == 'postgresql' else sqlite
+        statement = dialect.insert(table)
+        column = 'value' if replace else 'views'
+        new = statement.excluded[column]
+        conn.execute(statement.on_conflict_do_update(
+            index_elements=[table.c[key] for key in keys],
+            set_={column: new if replace else table.c[column] + new}), rows)
+
+    # Change tracking
+
+    def _record(self, conn, batch):
+        hour = _hour(datetime.utcnow())
+        conn.execute(insert(self.event), [{'post_id': post_id, 'hour': hour, 'views': n}
+                                          for post_id, n in batch.items()])
+
+    def _forget_views(self, session, flush_context, instances):
+        # Runs while the post rows still exist
+        post_ids = [obj.id for obj in session.deleted if isinstance(obj, self.post) and obj.id is not None]
+        if post_ids:
+            conn = session.connection()
+            self.adjust(conn, {'views': -conn.execute(self._rolled_up_views(post_ids)).scalar()})
+
+    def _count_changes(self, session, flush_context):
+        deltas = Counter()
+        for name, model in self.counted.items():
+            deltas[name] += sum(isinstance(obj, model) for obj in session.new)
+            deltas[name] -= sum(isinstance(obj, model) for obj in session.deleted)
+        if any(deltas.values()):
+            self.adjust(session.connection(), deltas)
@@ -0,0 +1,182 @@
+"""Building blocks for the versioned JSON read API (``/api/v1``, routes in app.py).
+
+Mobile clients and the static-site builder used to scrape ``/blog`` and
+``/post/<slug>``, which paid for a full Jinja render only for the data to be
+parsed back out of the HTML. The API serves the same data as JSON:
+
+* A ``Schema`` maps each public field name to the columns it reads. A
+  request selects only the columns behind the fields it asked for
+  (``?fields=id,title,url``), plus joins those fields need. Rows come back
+  as plain tuples, not ORM objects. Fields such as ``tags``, which are
+  one-to-many, are batch-loaded with one query per page.
+* Lists are paginated with keyset cursors (``next`` / ``prev`` in the
+  response, passed back as ``?after=`` / ``?before=``). ``?ids=3,1,2``
+  fetches up to ``API_MAX_PAGE_SIZE`` items by id in one request.
+* Responses are encoded with orjson when it is installed, falling back to
+  the standard library. They carry a strong ETag of the body and answer
+  ``If-None-Match`` with 304. The routes also use the page cache, so
+  anonymous repeats skip the queries entirely.
+
+Errors are JSON too: ``{"error": {"status": 400, "message": "..."}}``.
+
+Configuration (``app.config``):
+
+    API_PAGE_SIZE       20
+    API_MAX_PAGE_SIZE   100
+"""
+import hashlib
+import json
+from datetime import date, datetime
+
+from flask import Response, abort, request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(data):
+    """``data`` as compact UTF-8 JSON; naive datetimes are UTC."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NAIVE_UTC)
+    return json.dumps(data, default=_default, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat() + ('+00:00' if value.tzinfo is None else '')
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+class Field:
+    """A payload field: the ``columns`` it reads and how they become its value.
+
+    ``convert`` receives the column values as arguments; without it a
+    single column is used as is. ``join`` is a ``(target, onclause)`` outer
+    join the columns need. ``load(ids)`` batch-loads a field that isn't a
+    column, returning ``{key: value}`` for the page's keys.
+    """
+
+    def __init__(self, *columns, convert=None, join=None, load=None):
+        self.columns = columns
+        self.convert = convert
+        self.join = join
+        self.load = load
+
+
+class Schema:
+    def __init__(self, key, fields, defaults):
+        """``key`` is the primary-key column; ``defaults`` are the fields sent without ``?fields=``."""
+        self.key = key
+        self.fields = fields
+        self.defaults = tuple(defaults)
+
+    def query(self, session, names):
+        """A query of the columns ``names`` need; the key is always the first column."""
+        columns, joins, _ = self._plan(names)
+        query = session.query(*columns).select_from(self.key.class_)
+        for target, onclause in joins:
+            query = query.outerjoin(target, onclause)
+        return query
+
+    def serialize(self, rows, names):
+        """``[{name: value}]`` for rows from ``query(session, names)``, in order."""
+        _, _, plan = self._plan(names)
+        keys = [row[0] for row in rows]
+        loaded = {name: field.load(keys) for name, field, _ in plan if field.load is not None and keys}
+        items = []
+        for row in rows:
+            item = {}
+            for name, field, positions in plan:
+                if field.load is not None:
+                    item[name] = loaded[name].get(row[0], [])
+                elif field.convert is not None:
+                    item[name] = field.convert(*(row[i] for i in positions))
+                else:
+                    item[name] = row[positions[0]]
+            items.append(item)
+        return items
+
+    def _plan(self, names):
+        # Columns are compared by identity: == on a column builds SQL
+        columns, joins, plan = [self.key], [], []
+        for name in names:
+            field = self.fields[name]
+            positions = []
+            for column in field.columns:
+                index = next((i for i, seen in enumerate(columns) if seen is column), None)
+                if index is None:
+                    index = len(columns)
+                    columns.append(column)
+                positions.append(index)
+            if field.join is not None and not any(field.join is seen for seen in joins):
+                joins.append(field.join)
+            plan.append((name, field, positions))
+        return columns, joins, plan
+
+
+class ReadAPI:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('API_PAGE_SIZE', 20)
+        app.config.setdefault('API_MAX_PAGE_SIZE', 100)
+        self.app = app
+        app.extensions['api'] = self
+
+    def respond(self, data, status=200):
+        """A JSON response with a strong ETag; 304 when the client's copy is current."""
+        body = dumps(data)
+        response = Response(body, status=status, mimetype='application/json')
+        if status == 200:
+            response.set_etag(hashlib.blake2b(body, digest_size=16).hexdigest())
+            response.cache_control.public = True
+            response.cache_control.no_cache = True
+            response = response.make_conditional(request)
+        return response
+
+    def error(self, status, message):
+        """The JSON error response; the app's error handlers use it for ``/api/`` paths."""
+        return self.respond({'error': {'status': status, 'message': message}}, status)
+
+    def abort(self, status, message):
+        abort(self.error(status, message))
+
+    def fields(self, available, defaults):
+        """Field names from ``?fields=``, in request order; ``defaults`` without it."""
+        value = request.args.get('fields')
+        if not value:
+            return list(defaults)
+        names = list(dict.fromkeys(name.strip() for name in value.split(',') if name.strip()))
+        unknown = [name for name in names if name not in available]
+        if unknown or not names:
+            self.abort(400, f"Unknown fields: {', '.join(unknown) or value}. "
+                            f"Available: {', '.join(available)}")
+        return names
+
+    def limit(self):
+        """Page size from ``?limit=``, capped at ``API_MAX_PAGE_SIZE``."""
+        limit = request.args.get('limit', self.app.config['API_PAGE_SIZE'], type=int)
+        return max(1, min(limit, self.app.config['API_MAX_PAGE_SIZE']))
+
+    def ids(self):
+        """Integer ids from ``?ids=1,2,3`` in request order, or None without it."""
+        value = request.args.get('ids')
+        if value is None:
+            return None
+        try:
+            ids = list(dict.fromkeys(int(part) for part in value.split(',') if part.strip()))
+        except ValueError:
+            self.abort(400, 'ids must be a comma-separated list of integers')
+        if not ids or len(ids) > self.app.config['API_MAX_PAGE_SIZE']:
+            self.abort(400, f"Pass between 1 and {self.app.config['API_MAX_PAGE_SIZE']} ids")
+        return ids
+
+    def page(self, page, items):
+        """The body of a paginated list."""
+        return {'data': items, 'next': page.next_cursor, 'prev': page.prev_cursor}
@@ -1,33 +1,68 @@
 import os
+from urllib.parse import urljoin
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import (Flask, render_template, request, redirect, url_for, flash, jsonify, session, abort, Response,
+                   stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
+from sqlalchemy.orm import deferred, joinedload, selectinload, undefer_group
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
-import uuid
+from werkzeug.security import generate_password_hash
+from view_counter import ViewCounter
+from search import SearchIndex
+from page_cache import PageCache
+from taxonomy import TaxonomyCache
+from pagination import CountCache, keyset_paginate
+from migrations import Migrator
+from images import ImagePipeline
+from storage import Storage
+from content import ContentProcessor, parse_toc
+from comments import CommentThreads
+from assets import Assets
+from auth import Auth
+from user_cache import UserCache
+from newsletter import NewsletterEngine
+from metrics import Instrumentation
+from recommendations import Recommendations
+from feeds import Feeds
+from analytics import Analytics
+from slugs import Slugs
+from api import Field, ReadAPI, Schema
+import database
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-change-in-production'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///blog.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Max SQL statements per page (GET request), enforced only when TESTING (None
+# disables); counted by metrics.py, so it needs METRICS_ENABLED
+app.config['SQL_QUERY_BUDGET'] = 12
 
 # Ensure upload folder exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-db = SQLAlchemy(app)
+# DATABASE_URL, pool and SQLite PRAGMA settings from the environment (see database.py)
+database.configure(app)
+db = SQLAlchemy(app, session_options={'class_': database.RoutingSession})
+database.install(app, db)
+# Per-request SQL/render/latency timing, Server-Timing, /metrics and the slow-query log (see metrics.py)
+instrumentation = Instrumentation(app, db)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
+# Password hashing in a bounded process pool, plus login/register rate limits (see auth.py)
+auth = Auth(app)
+view_counter = ViewCounter(app, db)
+# Hashed CSS and icon bundles written by `flask assets-build` (see assets.py)
+static_assets = Assets(app)
 
 # Database Models
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(120), nullable=False)
+    password_hash = db.Column(db.String(255), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     posts = db.relationship('Post', backref='author', lazy=True)
@@ -48,9 +83,17 @@ class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     slug = db.Column(db.String(200), unique=True, nullable=False)
-    content = db.Column(db.Text, nullable=False)
+    # Bodies are only loaded by the post page (undefer_group('body'))
+    content = deferred(db.Column(db.Text, nullable=False), group='body')
     excerpt = db.Column(db.Text)
+    # Derived from content/excerpt on every save (see content.py)
+    content_html = deferred(db.Column(db.Text), group='body')
+    toc = deferred(db.Column(db.Text), group='body')
+    summary = db.Column(db.Text)
+    word_count = db.Column(db.Integer)
+    reading_time = db.Column(db.Integer)
     featured_image = db.Column(db.String(200))
+    featured_image_variants = db.Column(db.Text)  # JSON srcset data, see images.py
     is_published = db.Column(db.Boolean, default=True)
     is_featured = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -59,6 +102,28 @@ class Post(db.Model):
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
     comments = db.relationship('Comment', backref='post', lazy=True, cascade='all, delete-orphan')
     views = db.Column(db.Integer, default=0)
+    # Maintained on every comment flush (see comments.py)
+    approved_comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    pending_comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Time-decayed view count (see recommendations.py)
+    popularity = db.Column(db.Float, nullable=False, default=0, server_default='0')
+
+    # Indexes follow the route queries (equality columns first, then the
+    # sort key); migrations.py applies them to existing databases.
+    __table_args__ = (
+        # /blog, home page recent posts, keyset pagination
+        db.Index('idx_post_published_created', 'is_published', 'created_at', 'id'),
+        # /blog?category=, related posts
+        db.Index('idx_post_category_published_created', 'category_id', 'is_published', 'created_at', 'id'),
+        # Home page featured posts
+        db.Index('idx_post_featured_created', 'is_featured', 'is_published', 'created_at'),
+        # User dashboard
+        db.Index('idx_post_user_created', 'user_id', 'created_at'),
+        # Admin dashboard and post table
+        db.Index('idx_post_created', 'created_at', 'id'),
+        # Home page popular posts
+        db.Index('idx_post_published_popularity', 'is_published', 'popularity', 'id'),
+    )
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -68,69 +133,385 @@ class Comment(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
 
+    __table_args__ = (
+        # Approved comments under a post, oldest first
+        db.Index('idx_comment_post_approved', 'post_id', 'is_approved', 'created_at'),
+        # Keyset pagination of the moderation table, newest first
+        db.Index('idx_comment_created', 'created_at', 'id'),
+        # The same, filtered to one status, one post or one author
+        db.Index('idx_comment_approved_created', 'is_approved', 'created_at', 'id'),
+        db.Index('idx_comment_post_created', 'post_id', 'created_at', 'id'),
+        db.Index('idx_comment_user_created', 'user_id', 'created_at', 'id'),
+    )
+
 class Newsletter(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    # Lower-cased by newsletter.normalize_email before it gets here
     email = db.Column(db.String(120), unique=True, nullable=False)
     subscribed_at = db.Column(db.DateTime, default=datetime.utcnow)
+    unsubscribed_at = db.Column(db.DateTime)
+
+class NewsletterIssue(db.Model):
+    __tablename__ = 'newsletter_issue'
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    # Rendered once when queued; each message only swaps in its unsubscribe token
+    html = db.Column(db.Text, nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued', server_default='queued')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    queued_at = db.Column(db.DateTime)
+    sent_at = db.Column(db.DateTime)
+    # Delivery cursor: every active subscriber with a lower id has been sent this issue
+    last_subscriber_id = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    sent_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    failed_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
 # Association table for many-to-many relationship between posts and tags
 post_tags = db.Table('post_tags',
     db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
-    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True)
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
+    # The primary key covers post -> tags; this covers tag -> posts
+    db.Index('idx_post_tags_tag', 'tag_id', 'post_id')
+)
+
+# Each post's best related posts, rank 0 first (see recommendations.py)
+post_related = db.Table('post_related',
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('rank', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('related_id', db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), nullable=False),
+    db.Column('score', db.Float, nullable=False),
+    # ON DELETE CASCADE from related_id needs an index to find the rows
+    db.Index('idx_post_related_related', 'related_id')
+)
+
+# One row per stored upload, with the number of references to it (see storage.py)
+stored_file = db.Table('stored_file',
+    db.Column('key', db.String(100), primary_key=True),
+    db.Column('size', db.BigInteger, nullable=False),
+    db.Column('refcount', db.Integer, nullable=False, default=0, server_default='0'),
+    db.Column('touched_at', db.DateTime, nullable=False),
+    # storage-gc: unreferenced files past the grace period
+    db.Index('idx_stored_file_refcount_touched', 'refcount', 'touched_at')
+)
+
+# Page views waiting to be rolled up, one row per post per view counter flush (see analytics.py)
+analytics_event = db.Table('analytics_event',
+    db.Column('id', db.Integer, primary_key=True),
+    # No foreign key: events for deleted posts still count toward the site totals
+    db.Column('post_id', db.Integer, nullable=False),
+    db.Column('hour', db.DateTime, nullable=False),
+    db.Column('views', db.Integer, nullable=False)
 )
 
+# Views per post per hour, kept for ANALYTICS_HOURLY_DAYS
+post_views_hourly = db.Table('post_views_hourly',
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('hour', db.DateTime, primary_key=True),
+    db.Column('views', db.Integer, nullable=False),
+    # Site-wide hourly trend and retention, answered from the index alone
+    db.Index('idx_post_views_hourly_hour', 'hour', 'post_id', 'views')
+)
+
+# Views per post per day, kept for ANALYTICS_DAILY_DAYS
+post_views_daily = db.Table('post_views_daily',
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('day', db.Date, primary_key=True),
+    db.Column('views', db.Integer, nullable=False),
+    # Top posts over recent days and retention, answered from the index alone
+    db.Index('idx_post_views_daily_day', 'day', 'post_id', 'views')
+)
+
+# Views per day for the whole site
+site_views_daily = db.Table('site_views_daily',
+    db.Column('day', db.Date, primary_key=True),
+    db.Column('views', db.BigInteger, nullable=False)
+)
+
+# Former slugs of posts, so old URLs redirect (see slugs.py)
+slug_history = db.Table('slug_history',
+    db.Column('slug', db.String(200), primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), nullable=False),
+    db.Column('changed_at', db.DateTime, nullable=False),
+    # ON DELETE CASCADE from post_id needs an index to find the rows
+    db.Index('idx_slug_history_post', 'post_id')
+)
+
+# Running totals for the admin dashboard: posts, users, comments and views
+analytics_counter = db.Table('analytics_counter',
+    db.Column('name', db.String(20), primary_key=True),
+    db.Column('value', db.BigInteger, nullable=False)
+)
+
+# Versioned schema changes for existing databases (see migrations.py)
+migrator = Migrator(app, db)
+
+# Unique slugs for new posts, redirects from former ones and a slug -> id cache (see slugs.py)
+slugs = Slugs(app, db, Post, slug_history)
+
+# Full-text index over posts, kept in sync on every flush (see search.py)
+search_index = SearchIndex(app, db, Post)
+
+# Markdown rendered and sanitized once per save, not per view (see content.py)
+content_processor = ContentProcessor(app, db, Post)
+
+# Approved comments in pages, plus per-post comment counters (see comments.py)
+comment_threads = CommentThreads(app, db, Comment, Post)
+
+def page_cache_tags(obj):
+    """Cached-page dependency tags affected by a write to ``obj``."""
+    if isinstance(obj, Post):
+        category_ids = {obj.category_id, *inspect(obj).attrs.category_id.history.deleted}
+        return {'posts', f'post:{obj.id}'} | {f'category:{cid}' for cid in category_ids}
+    if isinstance(obj, Comment):
+        return {f'post:{obj.post_id}'}
+    if isinstance(obj, Category):
+        return {'posts', f'category:{obj.id}'}
+    if isinstance(obj, (Tag, User)):
+        return {'posts'}
+    return set()
+
+# Anonymous page cache, invalidated by the tags above after each commit (see page_cache.py)
+page_cache = PageCache(app, db, page_cache_tags)
+
+# Categories, tags and post counts for navigation, shared across requests (see taxonomy.py)
+taxonomy = TaxonomyCache(app, db, category=Category, tag=Tag, post=Post, post_tags=post_tags)
+
+# Admin table totals, recounted at most once a minute per worker
+admin_counts = CountCache(ttl=60)
+
+# Content-addressed, reference-counted uploads on local disk or S3 (see storage.py)
+storage = Storage(app, db, stored_file)
+
+# Featured images are resized and re-encoded off the request thread (see images.py)
+image_pipeline = ImagePipeline(app, db, Post, storage,
+                               on_ready=lambda post_ids: page_cache.invalidate('posts', *(f'post:{i}' for i in post_ids)))
+
+# id/username/is_admin snapshots of logged-in users, so requests skip the user table (see user_cache.py)
+user_cache = UserCache(app, db, User)
+
+# Newsletter signup, CSV import/export and batched delivery (see newsletter.py)
+newsletter = NewsletterEngine(app, db, Newsletter, NewsletterIssue)
+
+# Related posts by tag/category similarity and decayed popularity, precomputed (see recommendations.py)
+recommendations = Recommendations(app, db, Post, post_tags, post_related)
+
+# Sharded sitemap and site/category/tag RSS and Atom feeds, re-rendered per affected document (see feeds.py)
+feeds = Feeds(app, db, Post, Category, Tag, post_tags)
+
+# View trends rolled up from view counter flushes, and running totals for the dashboard (see analytics.py)
+analytics = Analytics(app, db, view_counter, counted={'posts': Post, 'users': User, 'comments': Comment},
+                      event_table=analytics_event, hourly=post_views_hourly, daily=post_views_daily,
+                      site_daily=site_views_daily, counter=analytics_counter)
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return user_cache.load(user_id)
+
+# Loading profiles: eager-load exactly what each template walks, so listing
+# pages don't fire one lazy SELECT per row for authors, categories and tags.
+def post_card_profile():
+    """Post cards on home/blog/related lists: author, category and tags."""
+    return (joinedload(Post.author), joinedload(Post.category), selectinload(Post.tags))
+
+def post_row_profile():
+    """Post cards and rows that don't show tags: author and category."""
+    return (joinedload(Post.author), joinedload(Post.category))
+
+def post_detail_profile():
+    """Single post page: card data and the rendered body; comments come from comment_threads."""
+    return post_card_profile() + (undefer_group('body'),)
+
+def user_post_profile():
+    """User dashboard rows: category only; the comment total is counted in SQL."""
+    return (joinedload(Post.category),)
+
+def comment_row_profile():
+    """Admin comment table: author and parent post."""
+    return (joinedload(Comment.author), joinedload(Comment.post))
+
+# Read API payloads, selected as column tuples (see api.py)
+api = ReadAPI(app)
+
+def api_category(category_id):
+    term = taxonomy.category(category_id)
+    return {'id': term.id, 'name': term.name} if term is not None else None
+
+def api_post_tags(post_ids):
+    """``{post_id: [{'id', 'name'}]}`` from post_tags, with names from the taxonomy cache."""
+    tags = {}
+    for post_id, tag_id in db.session.query(post_tags.c.post_id, post_tags.c.tag_id).filter(post_tags.c.post_id.in_(post_ids)):
+        term = taxonomy.tag(tag_id)
+        if term is not None:
+            tags.setdefault(post_id, []).append({'id': term.id, 'name': term.name})
+    return tags
+
+def api_image(path):
+    return urljoin(request.host_url, image_pipeline.url(path)) if path else None
+
+POST_API = Schema(Post.id, {
+    'id': Field(Post.id),
+    'slug': Field(Post.slug),
+    'url': Field(Post.slug, convert=lambda slug: url_for('post', slug=slug, _external=True)),
+    'title': Field(Post.title),
+    'summary': Field(Post.summary),
+    'excerpt': Field(Post.excerpt),
+    'created_at': Field(Post.created_at),
+    'updated_at': Field(Post.updated_at),
+    'reading_time': Field(Post.reading_time),
+    'word_count': Field(Post.word_count),
+    'views': Field(Post.id, Post.views, convert=lambda post_id, views: (views or 0) + view_counter.pending(post_id)),
+    'comment_count': Field(Post.approved_comment_count),
+    'is_featured': Field(Post.is_featured),
+    'category': Field(Post.category_id, convert=api_category),
+    'author': Field(User.username, join=(User, User.id == Post.user_id)),
+    'featured_image': Field(Post.featured_image, convert=api_image),
+    'tags': Field(load=api_post_tags),
+    'content_html': Field(Post.content_html),
+    'toc': Field(Post.toc, convert=lambda toc: [{'level': level, 'id': heading_id, 'text': text}
+                                                for level, heading_id, text in parse_toc(toc)]),
+}, defaults=('id', 'slug', 'url', 'title', 'summary', 'created_at', 'reading_time', 'category', 'author',
+             'featured_image', 'tags'))
+
+COMMENT_API = Schema(Comment.id, {
+    'id': Field(Comment.id),
+    'content': Field(Comment.content),
+    'created_at': Field(Comment.created_at),
+    'author': Field(User.username, join=(User, User.id == Comment.user_id)),
+}, defaults=('id', 'content', 'created_at', 'author'))
+
+CATEGORY_API_FIELDS = ('id', 'name', 'description', 'post_count')
+TAG_API_FIELDS = ('id', 'name', 'post_count')
+
+# Query budget: in tests, fail any page (GET request) that issues more SQL
+# statements than allowed, so N+1 regressions show up as test failures. Writes
+# run the session hooks' bookkeeping and aren't budgeted.
+def query_budget(limit):
+    """Override SQL_QUERY_BUDGET for a single view."""
+    def decorator(view):
+        view.query_budget = limit
+        return view
+    return decorator
+
+# Registered after instrumentation, so it runs before the request's metrics are closed
+@app.after_request
+def enforce_query_budget(response):
+    if not app.testing or request.method != 'GET':
+        return response
+    view = app.view_functions.get(request.endpoint)
+    limit = getattr(view, 'query_budget', app.config['SQL_QUERY_BUDGET'])
+    count = instrumentation.query_count()
+    if limit is not None and count is not None and count > limit:
+        raise AssertionError(f'{request.endpoint} issued {count} SQL statements (budget {limit})')
+    return response
 
 # Routes
 @app.route('/')
+@page_cache.cached('posts')
+@database.read_only
 def home():
-    featured_posts = Post.query.filter_by(is_featured=True, is_published=True).order_by(Post.created_at.desc()).limit(3).all()
-    recent_posts = Post.query.filter_by(is_published=True).order_by(Post.created_at.desc()).limit(6).all()
-    categories = Category.query.all()
-    tags = Tag.query.all()
-    return render_template('home.html', featured_posts=featured_posts, recent_posts=recent_posts, categories=categories, tags=tags)
+    featured_posts = Post.query.options(*post_row_profile()).filter_by(is_featured=True, is_published=True).order_by(Post.created_at.desc()).limit(3).all()
+    recent_posts = Post.query.options(*post_row_profile()).filter_by(is_published=True).order_by(Post.created_at.desc()).limit(6).all()
+    popular_posts = recommendations.popular(5, options=post_row_profile())
+    page_cache.last_modified(*featured_posts, *recent_posts)
+    return render_template('home.html', featured_posts=featured_posts, recent_posts=recent_posts, popular_posts=popular_posts,
+                         categories=taxonomy.categories, tags=taxonomy.tag_cloud)
 
 @app.route('/blog')
+@page_cache.cached('posts', query_args=('after', 'before', 'category', 'tag', 'search'))
+@database.read_only
 def blog():
-    page = request.args.get('page', 1, type=int)
     category_id = request.args.get('category', type=int)
     tag_id = request.args.get('tag', type=int)
     search = request.args.get('search', '')
     
     query = Post.query.filter_by(is_published=True)
+    order_by, descending = (Post.created_at, Post.id), True
     
     if category_id:
         query = query.filter_by(category_id=category_id)
     if tag_id:
         query = query.filter(Post.tags.any(id=tag_id))
-    if search:
+    if search and search_index.available:
+        hits = search_index.hits(search)
+        if hits is None:
+            query = query.filter(db.false())
+        else:
+            query = query.join(hits, hits.c.post_id == Post.id)
+            order_by, descending = (hits.c.rank, Post.id), False
+    elif search:
         query = query.filter(Post.title.contains(search) | Post.content.contains(search))
     
-    posts = query.order_by(Post.created_at.desc()).paginate(page=page, per_page=9, error_out=False)
-    categories = Category.query.all()
-    tags = Tag.query.all()
+    # Totals come from the taxonomy cache; filter combinations it can't answer show none
+    total = None
+    if not search:
+        if category_id and not tag_id:
+            total = getattr(taxonomy.category(category_id), 'post_count', 0)
+        elif tag_id and not category_id:
+            total = getattr(taxonomy.tag(tag_id), 'post_count', 0)
+        elif not category_id and not tag_id:
+            total = taxonomy.published_posts
+    
+    posts = keyset_paginate(query.options(*post_card_profile()), order_by, per_page=9, descending=descending, total=total,
+                            after=request.args.get('after'), before=request.args.get('before'))
+    snippets = search_index.snippets(search, [p.id for p in posts.items]) if search and search_index.available else {}
+    page_cache.last_modified(*posts.items)
     
-    return render_template('blog.html', posts=posts, categories=categories, tags=tags, 
-                         current_category=category_id, current_tag=tag_id, search=search)
+    return render_template('blog.html', posts=posts, categories=taxonomy.categories, tags=taxonomy.tags,
+                         tag_cloud=taxonomy.tag_cloud, snippets=snippets, search=search,
+                         current_category=category_id, current_tag=tag_id,
+                         current_category_term=taxonomy.category(category_id), current_tag_term=taxonomy.tag(tag_id))
 
 @app.route('/post/<slug>')
+@page_cache.cached(on_hit=lambda meta: view_counter.increment(meta['post_id']))
+@database.read_only
 def post(slug):
-    post = Post.query.filter_by(slug=slug, is_published=True).first_or_404()
-    post.views += 1
-    db.session.commit()
+    found = slugs.find(slug, db.session.query(Post.id, Post.slug, Post.category_id).filter(Post.is_published == True))
+    if found is None:
+        abort(404)
+    if found.slug != slug:
+        return redirect(url_for('post', slug=found.slug), 301)
+    # Generations are read before the post is loaded, so a commit in between invalidates the entry
+    page_cache.depends_on(f'post:{found.id}', f'category:{found.category_id}')
+    post = Post.query.options(*post_detail_profile()).filter_by(id=found.id, is_published=True).first()
+    if post is None:
+        abort(404)
+    if post.category_id != found.category_id:
+        page_cache.depends_on(f'category:{post.category_id}')
+    # Buffered and flushed in batches, see view_counter.py
+    view_counter.increment(post.id)
+    page_cache.meta(post_id=post.id)
     
-    # Get related posts
-    related_posts = Post.query.filter(
-        Post.category_id == post.category_id,
-        Post.id != post.id,
-        Post.is_published == True
-    ).order_by(Post.created_at.desc()).limit(3).all()
+    # Precomputed by recommendations.py; a post without a list yet falls back to its category
+    related_posts = recommendations.related(post.id, 3, options=post_row_profile())
+    if not related_posts:
+        related_posts = Post.query.options(*post_row_profile()).filter(
+            Post.category_id == post.category_id,
+            Post.id != post.id,
+            Post.is_published == True
+        ).order_by(Post.created_at.desc()).limit(3).all()
+    page_cache.last_modified(post, *related_posts)
     
-    return render_template('post.html', post=post, related_posts=related_posts)
+    comments = comment_threads.page(post.id)
+    return render_template('post.html', post=post, related_posts=related_posts, comments=comments)
+
+@app.route('/post/<int:post_id>/comments')
+@page_cache.cached(query_args=('after',))
+@database.read_only
+def post_comments(post_id):
+    """Next page of approved comments for the "Load more" button."""
+    page_cache.depends_on(f'post:{post_id}')
+    db.session.query(Post.id).filter_by(id=post_id, is_published=True).first_or_404()
+    comments = comment_threads.page(post_id, after=request.args.get('after'))
+    return jsonify({
+        'html': render_template('_comments.html', comments=comments),
+        'next': url_for('post_comments', post_id=post_id, after=comments.next_cursor) if comments.has_next else None,
+    })
 
 @app.route('/about')
+@page_cache.cached()
+@database.read_only
 def about():
     return render_template('about.html')
 
@@ -143,6 +524,7 @@ def contact():
     return render_template('contact.html')
 
 @app.route('/register', methods=['GET', 'POST'])
+@auth.throttled('register', 'register.html')
 def register():
     if current_user.is_authenticated:
         return redirect(url_for('home'))
@@ -160,7 +542,7 @@ def register():
             flash('Email already registered', 'error')
             return redirect(url_for('register'))
         
-        user = User(username=username, email=email, password_hash=generate_password_hash(password))
+        user = User(username=username, email=email, password_hash=auth.hash_password(password))
         db.session.add(user)
         db.session.commit()
         
@@ -170,6 +552,7 @@ def register():
     return render_template('register.html')
 
 @app.route('/login', methods=['GET', 'POST'])
+@auth.throttled('login', 'login.html')
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('home'))
@@ -179,7 +562,9 @@ def login():
         password = request.form['password']
         user = User.query.filter_by(username=username).first()
         
-        if user and check_password_hash(user.password_hash, password):
+        if auth.check_password(user, password):
+            # Stores the upgraded hash, if check_password replaced an outdated one
+            db.session.commit()
             login_user(user)
             return redirect(url_for('home'))
         else:
@@ -211,39 +596,63 @@ def add_comment(post_id):
 
 @app.route('/newsletter', methods=['POST'])
 def subscribe_newsletter():
-    email = request.form['email']
-    if Newsletter.query.filter_by(email=email).first():
+    result = newsletter.subscribe(request.form.get('email'))
+    if result == 'invalid':
+        return jsonify({'success': False, 'message': 'Please enter a valid email address'}), 400
+    if result == 'exists':
         return jsonify({'success': False, 'message': 'Email already subscribed'})
-    
-    subscriber = Newsletter(email=email)
-    db.session.add(subscriber)
-    db.session.commit()
     return jsonify({'success': True, 'message': 'Successfully subscribed to newsletter!'})
 
+@app.route('/newsletter/unsubscribe/<token>', methods=['GET', 'POST'])
+def newsletter_unsubscribe(token):
+    # GET only asks for confirmation, so link scanners can't unsubscribe anyone;
+    # mail clients' one-click unsubscribe (RFC 8058) POSTs here directly.
+    done = False
+    if request.method == 'POST':
+        if not newsletter.unsubscribe(token):
+            abort(404)
+        done = True
+    return render_template('newsletter_unsubscribe.html', token=token, done=done)
+
+@app.route('/admin/newsletter/export.csv')
+@login_required
+def export_newsletter():
+    if not current_user.is_admin:
+        flash('Access denied', 'error')
+        return redirect(url_for('home'))
+    filename = f"subscribers-{datetime.utcnow():%Y%m%d}.csv"
+    return Response(stream_with_context(newsletter.export_csv()), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
 # Admin routes
 @app.route('/admin')
 @login_required
+@database.read_only
 def admin_dashboard():
     if not current_user.is_admin:
         flash('Access denied', 'error')
         return redirect(url_for('home'))
     
-    posts_count = Post.query.count()
-    users_count = User.query.count()
-    comments_count = Comment.query.count()
-    recent_posts = Post.query.order_by(Post.created_at.desc()).limit(5).all()
+    # Precomputed totals and rollups, see analytics.py
+    totals = analytics.totals()
+    recent_posts = Post.query.options(*post_row_profile()).order_by(Post.created_at.desc()).limit(5).all()
     
-    return render_template('admin/dashboard.html', posts_count=posts_count, users_count=users_count, 
-                         comments_count=comments_count, recent_posts=recent_posts)
+    return render_template('admin/dashboard.html', posts_count=totals['posts'], users_count=totals['users'],
+                         comments_count=totals['comments'], views_count=totals['views'],
+                         trend=analytics.trend(), hourly_trend=analytics.hourly_trend(),
+                         top_posts=analytics.top_posts(), recent_posts=recent_posts)
 
 @app.route('/admin/posts')
 @login_required
+@database.read_only
 def admin_posts():
     if not current_user.is_admin:
         flash('Access denied', 'error')
         return redirect(url_for('home'))
     
-    posts = Post.query.order_by(Post.created_at.desc()).all()
+    posts = keyset_paginate(Post.query.options(*post_row_profile()), (Post.created_at, Post.id), per_page=50,
+                            after=request.args.get('after'), before=request.args.get('before'),
+                            total=admin_counts.get('posts', lambda: Post.query.count()))
     return render_template('admin/posts.html', posts=posts)
 
 @app.route('/admin/post/new', methods=['GET', 'POST'])
@@ -261,22 +670,12 @@ def new_post():
         is_featured = 'is_featured' in request.form
         is_published = 'is_published' in request.form
         
-        # Generate slug from title
-        slug = title.lower().replace(' ', '-').replace('?', '').replace('!', '').replace('.', '')
-        
-        # Handle file upload
-        featured_image = None
-        if 'featured_image' in request.files:
-            file = request.files['featured_image']
-            if file and file.filename:
-                filename = secure_filename(file.filename)
-                unique_filename = f"{uuid.uuid4().hex}_{filename}"
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], unique_filename))
-                featured_image = f"uploads/{unique_filename}"
+        # Handle file upload (variants are generated after commit)
+        featured_image = image_pipeline.save_upload(request.files.get('featured_image'))
         
+        # The slug is generated from the title on flush, see slugs.py
         post = Post(
             title=title,
-            slug=slug,
             content=content,
             excerpt=excerpt,
             featured_image=featured_image,
@@ -291,8 +690,7 @@ def new_post():
         flash('Post created successfully!', 'success')
         return redirect(url_for('admin_posts'))
     
-    categories = Category.query.all()
-    return render_template('admin/new_post.html', categories=categories)
+    return render_template('admin/new_post.html', categories=taxonomy.categories)
 
 @app.route('/admin/post/edit/<int:post_id>', methods=['GET', 'POST'])
 @login_required
@@ -310,22 +708,20 @@ def edit_post(post_id):
         post.category_id = request.form.get('category_id', type=int)
         post.is_featured = 'is_featured' in request.form
         post.is_published = 'is_published' in request.form
+        # The old slug keeps working as a redirect
+        slugs.rename(post, request.form.get('slug'))
         
-        # Handle file upload
-        if 'featured_image' in request.files:
-            file = request.files['featured_image']
-            if file and file.filename:
-                filename = secure_filename(file.filename)
-                unique_filename = f"{uuid.uuid4().hex}_{filename}"
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], unique_filename))
-                post.featured_image = f"uploads/{unique_filename}"
+        # Handle file upload (variants are generated after commit)
+        featured_image = image_pipeline.save_upload(request.files.get('featured_image'))
+        if featured_image:
+            post.featured_image = featured_image
+            post.featured_image_variants = None
         
         db.session.commit()
         flash('Post updated successfully!', 'success')
         return redirect(url_for('admin_posts'))
     
-    categories = Category.query.all()
-    return render_template('admin/edit_post.html', post=post, categories=categories)
+    return render_template('admin/edit_post.html', post=post, categories=taxonomy.categories)
 
 @app.route('/admin/post/delete/<int:post_id>', methods=['POST'])
 @login_required
@@ -342,13 +738,72 @@ def delete_post(post_id):
 
 @app.route('/admin/comments')
 @login_required
+@database.read_only
 def admin_comments():
     if not current_user.is_admin:
         flash('Access denied', 'error')
         return redirect(url_for('home'))
     
-    comments = Comment.query.order_by(Comment.created_at.desc()).all()
-    return render_template('admin/comments.html', comments=comments)
+    filters = comment_filters(request.args)
+    query = comment_threads.queue(filters['status'], filters['post'], filters['user'])
+    comments = keyset_paginate(query.options(*comment_row_profile()), (Comment.created_at, Comment.id), per_page=50,
+                               after=request.args.get('after'), before=request.args.get('before'))
+    if filters['post'] is None and filters['user'] is None:
+        stats = admin_counts.get('comments', comment_threads.stats)
+    else:
+        stats = comment_threads.stats(filters['post'], filters['user'])
+    return render_template('admin/comments.html', comments=comments, filters=filters, stats=stats,
+                           filter_post=db.session.get(Post, filters['post']) if filters['post'] else None,
+                           filter_user=db.session.get(User, filters['user']) if filters['user'] else None,
+                           approved_count=stats['approved'], pending_count=stats['pending'], total_count=stats['total'])
+
+def comment_filters(values):
+    """Moderation queue filters from query string or form ``values``."""
+    status = values.get('status')
+    return {
+        'status': status if status in ('pending', 'approved') else None,
+        'post': values.get('post', type=int),
+        'user': values.get('user', type=int),
+    }
+
+@app.route('/admin/comments/bulk', methods=['POST'])
+@login_required
+def bulk_comments():
+    """Approve or delete many comments in one transaction."""
+    wants_json = request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json'
+    if not current_user.is_admin:
+        if wants_json:
+            return jsonify({'success': False, 'message': 'Access denied'}), 403
+        flash('Access denied', 'error')
+        return redirect(url_for('home'))
+
+    action = request.form.get('action')
+    ids = request.form.getlist('ids', type=int)
+    limit = app.config['COMMENTS_BULK_LIMIT']
+    if action not in ('approve', 'delete') or not ids or len(ids) > limit:
+        message = f'Select between 1 and {limit} comments and an action'
+        if wants_json:
+            return jsonify({'success': False, 'message': message}), 400
+        flash(message, 'error')
+        return redirect(url_for('admin_comments', **comment_filters(request.form)))
+
+    if action == 'approve':
+        count, post_ids = comment_threads.bulk_approve(ids)
+    else:
+        count, post_ids = comment_threads.bulk_delete(ids)
+        analytics.adjust(db.session.connection(), {'comments': -count})
+    db.session.commit()
+    # Core statements skip the ORM flush hooks that normally invalidate pages
+    page_cache.invalidate(*(f'post:{i}' for i in post_ids))
+    admin_counts.clear('comments')
+
+    message = f"{count} comment{'s' if count != 1 else ''} {'approved' if action == 'approve' else 'deleted'}"
+    if wants_json:
+        filters = comment_filters(request.form)
+        return jsonify({'success': True, 'message': message, 'count': count,
+                        'stats': comment_threads.stats(filters['post'], filters['user'])})
+    flash(message, 'success')
+    return redirect(url_for('admin_comments', **comment_filters(request.form)))
 
 @app.route('/admin/comment/approve/<int:comment_id>', methods=['POST'])
 @login_required
@@ -379,9 +834,12 @@ def delete_comment(comment_id):
 # User dashboard and blog creation routes
 @app.route('/dashboard')
 @login_required
+@database.read_only
 def user_dashboard():
-    user_posts = Post.query.filter_by(user_id=current_user.id).order_by(Post.created_at.desc()).all()
-    return render_template('user/dashboard.html', posts=user_posts)
+    user_posts = Post.query.options(*user_post_profile()).filter_by(user_id=current_user.id).order_by(Post.created_at.desc()).all()
+    # Counted in SQL rather than by loading every comment on every post
+    comment_count = db.session.query(db.func.count(Comment.id)).join(Post).filter(Post.user_id == current_user.id).scalar()
+    return render_template('user/dashboard.html', posts=user_posts, comment_count=comment_count)
 
 @app.route('/post/create', methods=['GET', 'POST'])
 @login_required
@@ -393,22 +851,12 @@ def create_post():
         category_id = request.form.get('category_id', type=int)
         is_published = 'is_published' in request.form
         
-        # Generate slug from title
-        slug = title.lower().replace(' ', '-').replace('?', '').replace('!', '').replace('.', '')
-        
-        # Handle file upload
-        featured_image = None
-        if 'featured_image' in request.files:
-            file = request.files['featured_image']
-            if file and file.filename:
-                filename = secure_filename(file.filename)
-                unique_filename = f"{uuid.uuid4().hex}_{filename}"
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], unique_filename))
-                featured_image = f"uploads/{unique_filename}"
+        # Handle file upload (variants are generated after commit)
+        featured_image = image_pipeline.save_upload(request.files.get('featured_image'))
         
+        # The slug is generated from the title on flush, see slugs.py
         post = Post(
             title=title,
-            slug=slug,
             content=content,
             excerpt=excerpt,
             featured_image=featured_image,
@@ -423,8 +871,7 @@ def create_post():
         flash('Post created successfully!', 'success')
         return redirect(url_for('user_dashboard'))
     
-    categories = Category.query.all()
-    return render_template('user/create_post.html', categories=categories)
+    return render_template('user/create_post.html', categories=taxonomy.categories)
 
 @app.route('/post/edit/<int:post_id>', methods=['GET', 'POST'])
 @login_required
@@ -443,24 +890,20 @@ def edit_user_post(post_id):
         post.category_id = request.form.get('category_id', type=int)
         post.is_published = 'is_published' in request.form
         
-        # Generate new slug from title
-        post.slug = post.title.lower().replace(' ', '-').replace('?', '').replace('!', '').replace('.', '')
+        # The old slug keeps working as a redirect
+        slugs.rename(post, request.form.get('slug'))
         
-        # Handle file upload
-        if 'featured_image' in request.files:
-            file = request.files['featured_image']
-            if file and file.filename:
-                filename = secure_filename(file.filename)
-                unique_filename = f"{uuid.uuid4().hex}_{filename}"
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], unique_filename))
-                post.featured_image = f"uploads/{unique_filename}"
+        # Handle file upload (variants are generated after commit)
+        featured_image = image_pipeline.save_upload(request.files.get('featured_image'))
+        if featured_image:
+            post.featured_image = featured_image
+            post.featured_image_variants = None
         
         db.session.commit()
         flash('Post updated successfully!', 'success')
         return redirect(url_for('user_dashboard'))
     
-    categories = Category.query.all()
-    return render_template('user/edit_post.html', post=post, categories=categories)
+    return render_template('user/edit_post.html', post=post, categories=taxonomy.categories)
 
 @app.route('/post/delete/<int:post_id>', methods=['POST'])
 @login_required
@@ -485,19 +928,95 @@ def toggle_theme():
     session['dark_mode'] = not session['dark_mode']
     return jsonify({'dark_mode': session['dark_mode']})
 
+# Read API routes; anonymous responses share the page cache with the HTML pages
+@app.route('/api/v1/posts')
+@page_cache.cached('posts', query_args=('fields', 'after', 'before', 'limit', 'ids', 'category', 'tag'))
+@database.read_only
+def api_posts():
+    names = api.fields(POST_API.fields, POST_API.defaults)
+    query = POST_API.query(db.session, names).filter(Post.is_published == True)
+    
+    # Batch fetch: published posts among ?ids=, in the order asked for
+    ids = api.ids()
+    if ids is not None:
+        rows = {row[0]: row for row in query.filter(Post.id.in_(ids))}
+        return api.respond({'data': POST_API.serialize([rows[i] for i in ids if i in rows], names)})
+    
+    category_id = request.args.get('category', type=int)
+    tag_id = request.args.get('tag', type=int)
+    if category_id:
+        query = query.filter(Post.category_id == category_id)
+    if tag_id:
+        query = query.filter(Post.tags.any(id=tag_id))
+    posts = keyset_paginate(query, (Post.created_at, Post.id), per_page=api.limit(), columns=True,
+                            after=request.args.get('after'), before=request.args.get('before'))
+    return api.respond(api.page(posts, POST_API.serialize(posts.items, names)))
+
+@app.route('/api/v1/posts/<slug>')
+@page_cache.cached(query_args=('fields',))
+@database.read_only
+def api_post(slug):
+    names = api.fields(POST_API.fields, POST_API.fields)
+    found = slugs.find(slug, db.session.query(Post.id, Post.slug, Post.category_id).filter(Post.is_published == True))
+    if found is None:
+        api.abort(404, 'Post not found')
+    if found.slug != slug:
+        args = {name: values for name, values in request.args.lists() if name != 'slug'}
+        return redirect(url_for('api_post', slug=found.slug, **args), 301)
+    # Generations are read before the row is loaded, so a commit in between invalidates the entry
+    page_cache.depends_on(f'post:{found.id}', f'category:{found.category_id}')
+    
+    row = POST_API.query(db.session, names).filter(Post.id == found.id, Post.is_published == True).first()
+    if row is None:
+        api.abort(404, 'Post not found')
+    return api.respond({'data': POST_API.serialize([row], names)[0]})
+
+@app.route('/api/v1/posts/<int:post_id>/comments')
+@page_cache.cached(query_args=('fields', 'after', 'before', 'limit'))
+@database.read_only
+def api_post_comments(post_id):
+    names = api.fields(COMMENT_API.fields, COMMENT_API.defaults)
+    page_cache.depends_on(f'post:{post_id}')
+    if db.session.query(Post.id).filter_by(id=post_id, is_published=True).first() is None:
+        api.abort(404, 'Post not found')
+    
+    query = COMMENT_API.query(db.session, names).filter(Comment.post_id == post_id, Comment.is_approved == True)
+    comments = keyset_paginate(query, (Comment.created_at, Comment.id), per_page=api.limit(), columns=True,
+                               after=request.args.get('after'), before=request.args.get('before'))
+    return api.respond(api.page(comments, COMMENT_API.serialize(comments.items, names)))
+
+@app.route('/api/v1/categories')
+@page_cache.cached('posts', query_args=('fields',))
+def api_categories():
+    # Served from the taxonomy cache, with published-post counts
+    names = api.fields(CATEGORY_API_FIELDS, CATEGORY_API_FIELDS)
+    return api.respond({'data': [{name: getattr(term, name) for name in names} for term in taxonomy.categories]})
+
+@app.route('/api/v1/tags')
+@page_cache.cached('posts', query_args=('fields',))
+def api_tags():
+    names = api.fields(TAG_API_FIELDS, TAG_API_FIELDS)
+    return api.respond({'data': [{name: getattr(term, name) for name in names} for term in taxonomy.tags]})
+
 # Error handlers
 @app.errorhandler(404)
 def not_found_error(error):
+    if request.path.startswith('/api/'):
+        return api.error(404, 'Not found')
     return render_template('errors/404.html'), 404
 
 @app.errorhandler(500)
 def internal_error(error):
     db.session.rollback()
+    if request.path.startswith('/api/'):
+        return api.error(500, 'Internal server error')
     return render_template('errors/500.html'), 500
 
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        search_index.create()
+        migrator.upgrade()
         
         # Create admin user if not exists
         if not User.query.filter_by(username='admin').first():
@@ -0,0 +1,304 @@
+"""Build-time CSS and icon font bundles, served with far-future caching.
+
+``flask assets-build`` scans the templates (and any scripts under
+``static/``) for words that could be class names, then writes the following
+to ``static/dist``:
+
+* ``app.<hash>.css``: Preflight plus only the utilities those words name,
+  generated by utility_css.py and minified. This replaces the Tailwind CDN
+  script that compiled the stylesheet in every visitor's browser.
+* ``icons.<hash>.css`` and ``<font>.<hash>.woff2``: the Font Awesome
+  stylesheet reduced to the icons in use. Each font is subset to those
+  glyphs when fontTools is installed, and copied whole otherwise. The source
+  is the Font Awesome Free kit unpacked into ``assets/fontawesome``
+  (``css/all.css`` and ``webfonts/``). Without it the icons stay on the CDN.
+* ``.gz`` copies of every file, plus ``.br`` when the brotli module is
+  installed.
+* ``manifest.json``, which maps logical names (``app.css``) to hashed ones.
+
+Nothing is fetched, so the build works offline. Templates call
+``asset_url('app.css')``, which returns None before the first build so that
+base.html can fall back to the CDNs. Files are served from ``/assets/``
+with ``Cache-Control: public, max-age=31536000, immutable``. The gzip or
+brotli copy goes to clients that accept it. Each build keeps the files of
+the previous manifest, so pages cached before a deploy still load their CSS.
+"""
+import glob
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+import click
+from flask import abort, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+import utility_css
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from fontTools import subset as font_subset
+    from fontTools.ttLib import TTFont
+except ImportError:
+    font_subset = None
+
+ONE_YEAR = 31536000
+MANIFEST = 'manifest.json'
+COMPRESSIBLE = ('.css', '.js', '.svg', '.ttf', '.json')
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# Candidate class names: anything between quotes, whitespace and markup
+TOKEN = re.compile(r'[^\s"\'`<>=]+')
+FA_CLASS = re.compile(r'\.(fa-[a-z0-9-]+)')
+CODEPOINT = re.compile(r'content:\s*"\\([0-9a-fA-F]+)"|--fa:\s*"\\([0-9a-fA-F]+)"')
+FONT_URL = re.compile(r'url\(\s*["\']?([^"\')]+?)["\']?\s*\)')
+
+
+class Assets:
+    def __init__(self, app=None):
+        self._manifest = None
+        self._manifest_mtime = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        root = app.root_path
+        app.config.setdefault('ASSETS_OUTPUT', os.path.join(app.static_folder, 'dist'))
+        app.config.setdefault('ASSETS_CONTENT', (
+            os.path.join(root, app.template_folder or 'templates', '**', '*.html'),
+            os.path.join(app.static_folder, '**', '*.js'),
+        ))
+        app.config.setdefault('ASSETS_FONTAWESOME', os.path.join(root, 'assets', 'fontawesome'))
+        self.app = app
+        app.extensions['assets'] = self
+        app.add_template_global(self.asset_url, 'asset_url')
+        app.add_url_rule('/assets/<path:filename>', 'assets', self.send)
+
+        @app.cli.command('assets-build')
+        def assets_build_command():
+            """Build the hashed, precompressed CSS and icon bundles."""
+            manifest = self.build(echo=click.echo)
+            for name, filename in sorted(manifest.items()):
+                click.echo(f'{name} -> {filename}')
+
+    @property
+    def output(self):
+        return self.app.config['ASSETS_OUTPUT']
+
+    # Template side
+
+    def manifest(self):
+        path = os.path.join(self.output, MANIFEST)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return {}
+        # Builds normally happen before the app starts; only debug reloads
+        if self._manifest is None or (self.app.debug and mtime != self._manifest_mtime):
+            with open(path) as f:
+                self._manifest = json.load(f)
+            self._manifest_mtime = mtime
+        return self._manifest
+
+    def asset_url(self, name):
+        """URL of the built asset ``name`` (e.g. ``app.css``), or None if it hasn't been built."""
+        filename = self.manifest().get(name)
+        return url_for('assets', filename=filename) if filename else None
+
+    def send(self, filename):
+        if filename == MANIFEST or filename.endswith(tuple(ext for _, ext in ENCODINGS)):
+            abort(404)
+        path = safe_join(self.output, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        for encoding, ext in ENCODINGS:
+            if request.accept_encodings[encoding] and os.path.isfile(path + ext):
+                response = send_from_directory(self.output, filename + ext, mimetype=mimetype, max_age=ONE_YEAR)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(self.output, filename, mimetype=mimetype, max_age=ONE_YEAR)
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    # Build side
+
+    def build(self, echo=print):
+        """Write the bundles and manifest; returns the new manifest."""
+        os.makedirs(self.output, exist_ok=True)
+        tokens = scan(self.app.config['ASSETS_CONTENT'])
+        previous = self._read_manifest()
+        manifest = {}
+
+        for name in utility_css.unknown_utilities(tokens):
+            echo(f'warning: no rule for class {name!r}')
+        manifest['app.css'] = self._write('app.css', minify(utility_css.generate(tokens)).encode())
+
+        fontawesome = self.app.config['ASSETS_FONTAWESOME']
+        stylesheet = os.path.join(fontawesome, 'css', 'all.css')
+        if os.path.isfile(stylesheet):
+            manifest.update(self._build_icons(stylesheet, tokens, echo))
+        else:
+            echo(f'warning: {stylesheet} not found; icons will load from the CDN')
+
+        with open(os.path.join(self.output, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        self._prune(set(manifest.values()) | set(previous.values()))
+        self._manifest = None
+        return manifest
+
+    def _build_icons(self, stylesheet, tokens, echo):
+        with open(stylesheet, encoding='utf-8') as f:
+            css = purge_icons(f.read(), tokens)
+        codepoints = {int(a or b, 16) for a, b in CODEPOINT.findall(css)}
+        built = {}
+
+        def replace_src(match):
+            # One source per @font-face: the built font, in the best format we can write
+            block = match.group(0)
+            preferred = '.ttf' if font_subset is not None else '.woff2'
+            paths = [os.path.normpath(os.path.join(os.path.dirname(stylesheet), url))
+                     for url in FONT_URL.findall(block)]
+            source = next((path for path in sorted(paths, key=lambda p: not p.endswith(preferred))
+                           if os.path.isfile(path)), None)
+            if source is None:
+                return ''
+            if source not in built:
+                data, ext = subset_font(source, codepoints)
+                name = os.path.splitext(os.path.basename(source))[0] + ext
+                built[source] = (self._write(name, data), ext)
+            filename, ext = built[source]
+            font_format = {'.woff2': 'woff2', '.woff': 'woff', '.ttf': 'truetype'}[ext]
+            return re.sub(r'src:[^;}]+', f'src:url({filename}) format("{font_format}")', block)
+
+        css = re.sub(r'@font-face\s*{[^}]*}', replace_src, css)
+        if font_subset is None:
+            echo('warning: fontTools is not installed; icon fonts are copied without subsetting')
+        manifest = {'icons.css': self._write('icons.css', minify(css).encode())}
+        manifest.update({os.path.basename(source): filename for source, (filename, _) in built.items()})
+        return manifest
+
+    def _write(self, name, data):
+        """Write ``data`` under a content-hashed name (plus compressed copies); returns the name."""
+        stem, ext = os.path.splitext(name)
+        filename = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+        path = os.path.join(self.output, filename)
+        with open(path, 'wb') as f:
+            f.write(data)
+        if ext in COMPRESSIBLE:
+            with open(path + '.gz', 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                with open(path + '.br', 'wb') as f:
+                    f.write(brotli.compress(data, quality=11))
+        return filename
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.output, MANIFEST)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _prune(self, keep):
+        for entry in os.listdir(self.output):
+            base = entry
+            for _, ext in ENCODINGS:
+                base = base[:-len(ext)] if base.endswith(ext) else base
+            if entry != MANIFEST and base not in keep:
+                path = os.path.join(self.output, entry)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+
+
+def scan(patterns):
+    """Every candidate class name in the files matching ``patterns``."""
+    tokens = set()
+    for pattern in patterns:
+        for path in glob.glob(pattern, recursive=True):
+            if os.sep + 'dist' + os.sep in path or os.sep + 'uploads' + os.sep in path:
+                continue
+            with open(path, encoding='utf-8', errors='replace') as f:
+                tokens.update(TOKEN.findall(f.read()))
+    # Jinja and JS punctuation can stick to class names: {% if x %}hidden{% endif %}
+    for token in list(tokens):
+        tokens.update(part for part in re.split(r'[{}%()\[\],;+]+', token) if part)
+    return tokens
+
+
+def minify(css):
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>~])\s*', r'\1', css)
+    css = re.sub(r'([{;])([-\w]+):\s+', r'\1\2:', css)
+    return css.replace(';}', '}').strip()
+
+
+def split_rules(css):
+    """Top-level ``(prelude, body)`` pairs of a stylesheet; bodies keep nested blocks."""
+    rules = []
+    depth = 0
+    start = 0
+    prelude = None
+    for i, ch in enumerate(css):
+        if ch == '{':
+            if depth == 0:
+                prelude = css[start:i].strip()
+                start = i + 1
+            depth += 1
+        elif ch == '}':
+            depth -= 1
+            if depth == 0:
+                rules.append((prelude, css[start:i]))
+                start = i + 1
+    return rules
+
+
+def purge_icons(css, tokens):
+    """Drop Font Awesome selectors that name ``fa-*`` classes absent from ``tokens``."""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    out = []
+    for prelude, body in split_rules(css):
+        if prelude.startswith('@media') or prelude.startswith('@supports'):
+            inner = purge_icons(body, tokens)
+            if inner:
+                out.append(f'{prelude}{{{inner}}}')
+            continue
+        if prelude.startswith('@'):
+            out.append(f'{prelude}{{{body}}}')
+            continue
+        selectors = [s for s in prelude.split(',') if all(name in tokens for name in FA_CLASS.findall(s))]
+        if selectors:
+            out.append(f'{",".join(selectors)}{{{body}}}')
+    return '\n'.join(out)
+
+
+def subset_font(path, codepoints):
+    """``(data, extension)`` of ``path`` cut down to ``codepoints`` (the whole font without fontTools)."""
+    if font_subset is None:
+        with open(path, 'rb') as f:
+            return f.read(), os.path.splitext(path)[1]
+    font = TTFont(path)
+    options = font_subset.Options()
+    options.flavor = 'woff2' if brotli is not None else 'woff'
+    options.layout_features = ['*']
+    subsetter = font_subset.Subsetter(options)
+    subsetter.populate(unicodes=codepoints)
+    subsetter.subset(font)
+    buffer = io.BytesIO()
+    font.flavor = options.flavor
+    font.save(buffer)
+    return buffer.getvalue(), '.' + options.flavor
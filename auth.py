@@ -0,0 +1,342 @@
+"""Password hashing off the request thread, and rate limits on the auth forms.
+
+``/login`` and ``/register`` used to run werkzeug's PBKDF2 (600,000 rounds)
+directly in the view. That is a few hundred milliseconds of CPU per
+attempt. A burst of logins, or a credential-stuffing run, kept every
+gunicorn worker busy hashing, so ordinary pages queued behind them. Three
+things now bound that cost:
+
+* Hashing runs in a small process pool (``AUTH_HASH_WORKERS`` per app
+  process, created lazily so each forked gunicorn worker gets its own). Its
+  processes come from a fork server rather than a fork of the worker, whose
+  background threads may hold locks. They run at a lower priority, so page rendering wins the CPU
+  when the two compete. At most ``AUTH_HASH_QUEUE`` hashes may be running
+  or waiting per process (this matters with threaded workers). Past that, a
+  request fails fast with 503 and ``Retry-After`` rather than piling up
+  behind the pool. ``AUTH_HASH_WORKERS = 0`` hashes in the request thread,
+  still under the queue limit.
+* New hashes use argon2id when argon2-cffi is installed, and werkzeug's
+  scrypt otherwise. Both are memory-hard, so guessing on GPUs is expensive
+  while a single check stays cheap. Stored hashes from other methods or
+  older parameters still verify. On the next successful login they are
+  replaced with a hash in the current format, so users migrate as they
+  sign in.
+* Token buckets limit attempts per client IP and per username before any
+  hashing happens. Over the limit, the form is shown again with 429 and
+  ``Retry-After``. The ``memory`` store is per process. The ``sqlite``
+  store is a small WAL file shared by every worker on the host, as with the
+  page cache.
+
+Unknown usernames are checked against a dummy hash. A miss costs as much as
+a wrong password, so response times don't reveal which accounts exist.
+
+Configuration (``app.config``):
+
+    AUTH_PASSWORD_METHOD   'argon2' (if installed) or 'scrypt:32768:8:1';
+                           any werkzeug method string also works
+    AUTH_HASH_WORKERS      1 (processes per app process; 0 = inline)
+    AUTH_HASH_QUEUE        4 (hashes running or waiting per app process)
+    AUTH_HASH_TIMEOUT      10 (s to wait for a hash before giving up)
+    AUTH_HASH_NICE         10 (niceness added to pool processes)
+    AUTH_RATE_LIMITS       {scope: {'ip': (n, seconds), 'username': (n, seconds)}}
+    AUTH_RATE_LIMIT_STORE  'memory' or 'sqlite'
+    AUTH_RATE_LIMIT_PATH   instance/rate_limits.db
+"""
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from functools import wraps
+
+from flask import flash, make_response, render_template, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from werkzeug.security import check_password_hash, generate_password_hash
+
+try:
+    import argon2
+    from argon2.exceptions import InvalidHashError, VerificationError
+except ImportError:
+    argon2 = None
+
+ARGON2 = 'argon2'
+ARGON2_PREFIX = '$argon2'
+DEFAULT_METHOD = ARGON2 if argon2 is not None else 'scrypt:32768:8:1'
+# What werkzeug 2.3 fills in for parameters a method string leaves out
+WERKZEUG_DEFAULTS = {'scrypt': ('32768', '8', '1'), 'pbkdf2': ('sha256', '600000')}
+
+DEFAULT_RATE_LIMITS = {
+    'login': {'ip': (20, 60), 'username': (10, 300)},
+    'register': {'ip': (5, 3600)},
+}
+
+
+class RateLimited(TooManyRequests):
+    description = 'Too many attempts. Please wait a moment and try again.'
+
+
+class HashingBusy(ServiceUnavailable):
+    description = 'The server is busy. Please try again in a moment.'
+
+
+# Hashing. Module-level functions so the process pool can pickle them.
+
+def hash_password(password, method=DEFAULT_METHOD):
+    if method == ARGON2:
+        return argon2.PasswordHasher().hash(password)
+    return generate_password_hash(password, method=method)
+
+
+def verify_password(stored, password):
+    if stored.startswith(ARGON2_PREFIX):
+        if argon2 is None:
+            raise RuntimeError('argon2-cffi is required to check argon2 password hashes')
+        try:
+            return argon2.PasswordHasher().verify(stored, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    return check_password_hash(stored, password)
+
+
+def check_and_upgrade(stored, password, method=DEFAULT_METHOD):
+    """``(valid, new_hash)``; ``new_hash`` is set when ``stored`` should be replaced."""
+    if not verify_password(stored, password):
+        return False, None
+    return True, hash_password(password, method) if needs_rehash(stored, method) else None
+
+
+def needs_rehash(stored, method=DEFAULT_METHOD):
+    if method == ARGON2:
+        return not stored.startswith(ARGON2_PREFIX) or argon2.PasswordHasher().check_needs_rehash(stored)
+    # werkzeug prefixes hashes with the full method, e.g. scrypt:32768:8:1$salt$hash
+    return stored.split('$', 1)[0] != full_method(method)
+
+
+def full_method(method):
+    """A werkzeug method string with its defaults spelled out: 'scrypt' -> 'scrypt:32768:8:1'."""
+    name, *params = method.split(':')
+    defaults = WERKZEUG_DEFAULTS.get(name, ())
+    return ':'.join([name, *params, *defaults[len(params):]])
+
+
+class HashPool:
+    """A lazily started process pool that refuses work past ``queue`` outstanding jobs."""
+
+    def __init__(self, workers=1, queue=4, timeout=10, nice=10):
+        self.workers = workers
+        self.timeout = timeout
+        self.nice = nice
+        self._slots = threading.BoundedSemaphore(queue)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy(retry_after=1)
+        try:
+            if not self.workers:
+                return fn(*args)
+            try:
+                return self._pool().submit(fn, *args).result(timeout=self.timeout)
+            except FutureTimeout:
+                raise HashingBusy(retry_after=1)
+        finally:
+            self._slots.release()
+
+    def _pool(self):
+        # A pool inherited through fork belongs to the parent; start our own
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=_start_context(),
+                                                     initializer=_lower_priority, initargs=(self.nice,))
+                self._pid = os.getpid()
+            return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def _start_context():
+    # Not fork: the worker already runs the view counter, feeds and recommendations
+    # threads, and a child forked while one of them holds a lock can deadlock on it
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def _lower_priority(increment):
+    # Page rendering wins the CPU when hashing and requests compete for it
+    if increment and hasattr(os, 'nice'):
+        os.nice(increment)
+
+
+# Rate limit stores: take(key, capacity, period) -> seconds to wait (0 = allowed)
+
+class MemoryBuckets:
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, period):
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens, wait = _refill(tokens, updated, now, capacity, period)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteBuckets:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn().execute(
+            'CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, key, capacity, period):
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens, wait = _refill(*(row or (capacity, now)), now, capacity, period)
+            conn.execute('INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)', (key, tokens, now))
+            if hash(key) % 256 == 0:
+                # Buckets idle for a day are full again; forget them
+                conn.execute('DELETE FROM bucket WHERE updated < ?', (now - 86400,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+    def clear(self):
+        self._conn().execute('DELETE FROM bucket')
+
+
+def _refill(tokens, updated, now, capacity, period):
+    """Spend one token after refilling at ``capacity / period`` per second; returns ``(tokens, wait)``."""
+    rate = capacity / period
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+class Auth:
+    def __init__(self, app=None):
+        self.pool = None
+        self.buckets = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('AUTH_PASSWORD_METHOD', DEFAULT_METHOD)
+        app.config.setdefault('AUTH_HASH_WORKERS', 1)
+        app.config.setdefault('AUTH_HASH_QUEUE', 4)
+        app.config.setdefault('AUTH_HASH_TIMEOUT', 10)
+        app.config.setdefault('AUTH_HASH_NICE', 10)
+        app.config.setdefault('AUTH_RATE_LIMITS', DEFAULT_RATE_LIMITS)
+        app.config.setdefault('AUTH_RATE_LIMIT_STORE', 'memory')
+        app.config.setdefault('AUTH_RATE_LIMIT_PATH', os.path.join(app.instance_path, 'rate_limits.db'))
+        self.app = app
+        if app.config['AUTH_PASSWORD_METHOD'] == ARGON2 and argon2 is None:
+            raise RuntimeError("AUTH_PASSWORD_METHOD = 'argon2' needs the argon2-cffi package")
+        self.pool = HashPool(app.config['AUTH_HASH_WORKERS'], app.config['AUTH_HASH_QUEUE'],
+                             app.config['AUTH_HASH_TIMEOUT'], app.config['AUTH_HASH_NICE'])
+        store = app.config['AUTH_RATE_LIMIT_STORE']
+        if store == 'memory':
+            self.buckets = MemoryBuckets()
+        elif store == 'sqlite':
+            self.buckets = SQLiteBuckets(app.config['AUTH_RATE_LIMIT_PATH'])
+        elif store:
+            raise ValueError(f'Unknown AUTH_RATE_LIMIT_STORE {store!r}')
+        self._dummy_hash = None
+        app.extensions['auth'] = self
+
+    @property
+    def method(self):
+        return self.app.config['AUTH_PASSWORD_METHOD']
+
+    def hash_password(self, password):
+        return self.pool.run(hash_password, password, self.method)
+
+    def check_password(self, user, password):
+        """Verify ``password`` for ``user`` (which may be None) and upgrade an outdated hash.
+
+        The new hash is only assigned; the caller's commit stores it.
+        """
+        if user is None:
+            self.pool.run(verify_password, self._dummy(), password)
+            return False
+        valid, new_hash = self.pool.run(check_and_upgrade, user.password_hash, password, self.method)
+        if new_hash is not None:
+            user.password_hash = new_hash
+        return valid
+
+    def _dummy(self):
+        if self._dummy_hash is None:
+            self._dummy_hash = hash_password(os.urandom(16).hex(), self.method)
+        return self._dummy_hash
+
+    # Rate limits
+
+    def throttled(self, scope, template):
+        """Rate-limit POSTs to a form view; over the limit (or when hashing is saturated)
+        ``template`` is rendered again with a flash message and 429/503.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                try:
+                    if request.method == 'POST':
+                        self.limit(scope, username=request.form.get('username'))
+                    return view(*args, **kwargs)
+                except (RateLimited, HashingBusy) as error:
+                    flash(error.description, 'error')
+                    response = make_response(render_template(template), error.code)
+                    response.headers['Retry-After'] = str(error.retry_after)
+                    return response
+            return wrapper
+        return decorator
+
+    def limit(self, scope, username=None):
+        """Take a token from each of ``scope``'s buckets; raise RateLimited if any is empty."""
+        if self.buckets is None:
+            return
+        limits = self.app.config['AUTH_RATE_LIMITS'].get(scope, {})
+        keys = [('ip', request.remote_addr or '-')]
+        if username:
+            keys.append(('username', username.strip().lower()))
+        wait = 0
+        for kind, value in keys:
+            if kind in limits:
+                capacity, period = limits[kind]
+                wait = max(wait, self.buckets.take(f'{scope}:{kind}:{value}', capacity, period))
+        if wait:
+            raise RateLimited(retry_after=max(1, round(wait)))
@@ -0,0 +1,263 @@
+"""Bulk synthetic data for benchmarks: users, categories, tags, posts and comments.
+
+Builds the app's real schema (``db.create_all()`` and the migrations) in the
+target database, then fills it with batched inserts on the raw DBAPI
+connection: ``executemany`` on SQLite and ``COPY ... FROM STDIN`` on
+PostgreSQL. The ORM is bypassed, so everything the session hooks would
+normally derive is written directly:
+
+* ``content_html``, ``toc``, ``summary``, ``word_count`` and
+  ``reading_time`` come from ``content.process()``. It runs once per body in
+  a pool of Markdown bodies, not once per post.
+* ``approved_comment_count`` and ``pending_comment_count`` are counted as
+  the comments are generated.
+* ``popularity`` starts at the view count for posts from the last two
+  weeks and at 0 for older ones.
+* The search index, the related-posts lists and the dashboard totals are
+  rebuilt at the end, and any rendered sitemaps and feeds are dropped.
+  Views carry no history, so the view trends start out empty.
+
+Secondary indexes on ``post``, ``comment`` and ``post_tags`` are dropped
+during the load and recreated afterwards, which is much faster than
+maintaining them row by row. Comments per post follow a long-tailed
+distribution and tags a Zipf-like one, so some posts get hundreds of
+comments and a few tags cover most posts. Posts and comments are spread
+over ``--days`` of history. The same ``--seed`` gives the same data.
+
+Every user's password is ``PASSWORD``. The first user is named ``admin``
+and is an admin; ``benchmarks/loadtest.py`` logs in as these users.
+
+    python benchmarks/datagen.py --posts 10000 --comments 100000
+    python benchmarks/datagen.py --database-url postgresql://localhost/blog_bench \\
+        --posts 1000000 --comments 10000000 --users 100000 --tags 2000
+"""
+import argparse
+import csv
+import io
+import itertools
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import text  # noqa: E402
+
+import auth  # noqa: E402
+import content  # noqa: E402
+
+DEFAULT_URL = f"sqlite:///{os.path.join(ROOT, 'instance', 'benchmark.db')}"
+PASSWORD = 'benchmark'
+SYLLABLES = 'ka lo mi ne ru sa ti vo be da fe gu hi jo pu ze'.split()
+VOCABULARY = 20000
+BODY_POOL = 500
+COMMENT_POOL = 5000
+BATCH = 5000
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+RECENT = timedelta(days=14)
+
+
+class Text:
+    """Pseudo-words with Zipf-like frequencies, so search terms range from common to rare."""
+
+    def __init__(self, rng):
+        self.rng = rng
+        words = set()
+        while len(words) < VOCABULARY:
+            words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+        self.words = sorted(words)
+        rng.shuffle(self.words)
+        self.cum_weights = list(itertools.accumulate(1.0 / rank for rank in range(1, VOCABULARY + 1)))
+
+    def sentence(self, n):
+        return ' '.join(self.rng.choices(self.words, cum_weights=self.cum_weights, k=n))
+
+    def markdown(self):
+        sections = []
+        for _ in range(self.rng.randint(2, 5)):
+            paragraphs = [self.sentence(self.rng.randint(30, 90)).capitalize() + '.'
+                          for _ in range(self.rng.randint(1, 4))]
+            sections.append(f'## {self.sentence(4).title()}\n\n' + '\n\n'.join(paragraphs))
+        return '\n\n'.join(sections)
+
+
+def timestamp(value):
+    return value.strftime(DATETIME_FORMAT)
+
+
+class Loader:
+    """Batched inserts on the raw DBAPI connection of a SQLAlchemy ``Connection``."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.dialect = conn.dialect.name
+        self.raw = conn.connection.dbapi_connection
+        self.rows = {}
+
+    def insert(self, table, columns, rows):
+        if not rows:
+            return
+        cursor = self.raw.cursor()
+        try:
+            names = ', '.join(f'"{c}"' for c in columns)
+            if self.dialect == 'postgresql':
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(rows)
+                buffer.seek(0)
+                cursor.copy_expert(f'COPY "{table}" ({names}) FROM STDIN WITH (FORMAT csv)', buffer)
+            else:
+                marks = ', '.join(['?' if self.dialect == 'sqlite' else '%s'] * len(columns))
+                cursor.executemany(f'INSERT INTO "{table}" ({names}) VALUES ({marks})', rows)
+        finally:
+            cursor.close()
+        self.rows[table] = self.rows.get(table, 0) + len(rows)
+
+    def finish(self, tables):
+        """Move PostgreSQL id sequences past the explicit ids just loaded."""
+        if self.dialect != 'postgresql':
+            return
+        cursor = self.raw.cursor()
+        try:
+            for table in tables:
+                cursor.execute(f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), "
+                               f'(SELECT COALESCE(MAX(id), 1) FROM "{table}"))')
+        finally:
+            cursor.close()
+
+
+def generate(app, db, args):
+    """Fill an empty database; returns ``{table: rows inserted}``."""
+    rng = random.Random(args.seed)
+    words = Text(rng)
+    now = datetime.utcnow().replace(microsecond=0)
+    start = now - timedelta(days=args.days)
+    password_hash = auth.hash_password(PASSWORD, app.config['AUTH_PASSWORD_METHOD'])
+
+    print(f'Rendering {BODY_POOL} post bodies...')
+    bodies = []
+    for _ in range(BODY_POOL):
+        source = words.markdown()
+        derived = content.process(source)
+        bodies.append((source, derived['content_html'], derived['toc'], derived['summary'],
+                       derived['word_count'], derived['reading_time']))
+    comment_texts = [words.sentence(rng.randint(5, 40)).capitalize() + '.' for _ in range(COMMENT_POOL)]
+    tag_weights = list(itertools.accumulate(1.0 / rank for rank in range(1, args.tags + 1)))
+
+    heavy = [db.metadata.tables[name] for name in ('post', 'comment', 'post_tags')]
+    indexes = [index for table in heavy for index in table.indexes]
+
+    with db.engine.begin() as conn:
+        if conn.dialect.name == 'sqlite':
+            conn.exec_driver_sql('PRAGMA synchronous = OFF')
+        for index in indexes:
+            index.drop(conn, checkfirst=True)
+        loader = Loader(conn)
+
+        print(f'Users: {args.users}, categories: {args.categories}, tags: {args.tags}')
+        for first in range(0, args.users, BATCH):
+            loader.insert('user', ('id', 'username', 'email', 'password_hash', 'is_admin', 'created_at'), [
+                (i + 1, 'admin' if i == 0 else f'user{i}', f'user{i}@example.com', password_hash, i == 0,
+                 timestamp(start + timedelta(seconds=rng.uniform(0, args.days * 86400))))
+                for i in range(first, min(first + BATCH, args.users))])
+        loader.insert('category', ('id', 'name', 'description'), [
+            (i + 1, f'{words.words[i].title()} {i + 1}', words.sentence(8).capitalize())
+            for i in range(args.categories)])
+        loader.insert('tag', ('id', 'name'), [(i + 1, words.words[i]) for i in range(args.tags)])
+
+        print(f'Posts: {args.posts}, comments: ~{args.comments}...')
+        began = time.perf_counter()
+        mean_comments = args.comments / max(args.posts, 1)
+        span = args.days * 86400 / max(args.posts, 1)
+        post_columns = ('id', 'title', 'slug', 'content', 'excerpt', 'content_html', 'toc', 'summary', 'word_count',
+                        'reading_time', 'is_published', 'is_featured', 'created_at', 'updated_at', 'user_id',
+                        'category_id', 'views', 'popularity', 'approved_comment_count', 'pending_comment_count')
+        comment_columns = ('id', 'content', 'created_at', 'is_approved', 'user_id', 'post_id')
+        comment_id = 0
+        for first in range(0, args.posts, BATCH):
+            posts, tags, comments = [], [], []
+            for i in range(first, min(first + BATCH, args.posts)):
+                post_id = i + 1
+                created = start + timedelta(seconds=(i + rng.random()) * span)
+                title = words.sentence(rng.randint(3, 8)).title()
+                source, html, toc, summary, word_count, reading_time = rng.choice(bodies)
+                approved = pending = 0
+                for _ in range(int(rng.expovariate(1 / mean_comments)) if mean_comments else 0):
+                    comment_id += 1
+                    is_approved = rng.random() < 0.85
+                    approved += is_approved
+                    pending += not is_approved
+                    posted = created + timedelta(seconds=rng.uniform(0, (now - created).total_seconds()))
+                    comments.append((comment_id, rng.choice(comment_texts), timestamp(posted), is_approved,
+                                     rng.randint(1, args.users), post_id))
+                views = int(rng.paretovariate(1.2) * 10)
+                posts.append((post_id, title, f"{title.lower().replace(' ', '-')}-{post_id}", source, None, html,
+                              toc, summary, word_count, reading_time, rng.random() < 0.95, rng.random() < 0.01,
+                              timestamp(created), timestamp(created), rng.randint(1, args.users),
+                              rng.randint(1, args.categories), views, views if now - created < RECENT else 0,
+                              approved, pending))
+                for tag_id in set(rng.choices(range(1, args.tags + 1), cum_weights=tag_weights,
+                                              k=rng.randint(1, 4))):
+                    tags.append((post_id, tag_id))
+            loader.insert('post', post_columns, posts)
+            loader.insert('post_tags', ('post_id', 'tag_id'), tags)
+            for offset in range(0, len(comments), BATCH * 4):
+                loader.insert('comment', comment_columns, comments[offset:offset + BATCH * 4])
+            done = first + len(posts)
+            rate = done / (time.perf_counter() - began)
+            print(f'  {done}/{args.posts} posts, {comment_id} comments ({rate:,.0f} posts/s)', end='\r')
+        print()
+        loader.finish(('user', 'category', 'tag', 'post', 'comment'))
+
+        print(f'Creating {len(indexes)} indexes...')
+        for index in indexes:
+            index.create(conn)
+        conn.exec_driver_sql('ANALYZE')
+    return loader.rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default=os.environ.get('BENCHMARK_DATABASE_URL', DEFAULT_URL),
+                        help=f'target database (default: BENCHMARK_DATABASE_URL or {DEFAULT_URL})')
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--comments', type=int, default=100000, help='approximate total')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--categories', type=int, default=12)
+    parser.add_argument('--tags', type=int, default=200)
+    parser.add_argument('--days', type=int, default=3 * 365, help='history the posts are spread over')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--reset', action='store_true', help='drop and recreate every table first')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+    from app import analytics, app, db, feeds, migrator, recommendations, search_index, taxonomy
+
+    with app.app_context():
+        if args.reset:
+            db.drop_all()
+        db.create_all()
+        search_index.create()
+        migrator.upgrade()
+        if db.session.execute(text('SELECT 1 FROM post')).first() is not None:
+            sys.exit(f'{args.database_url} already has posts; pass --reset to replace them.')
+        db.session.rollback()
+
+        began = time.perf_counter()
+        rows = generate(app, db, args)
+        if search_index.available:
+            print('Rebuilding the search index...')
+            search_index.rebuild()
+        print('Computing related posts...')
+        recommendations.refresh_related()
+        taxonomy.stamp.bump()
+        feeds.clear()
+        analytics.recount()
+    summary = ', '.join(f'{count:,} {table}' for table, count in rows.items())
+    print(f'Loaded {summary} in {time.perf_counter() - began:.1f}s into {args.database_url}')
+
+
+if __name__ == '__main__':
+    main()
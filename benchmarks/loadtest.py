@@ -0,0 +1,415 @@
+"""Scripted load scenarios against the real routes, in-process or under gunicorn.
+
+Run ``benchmarks/datagen.py`` first. Then each scenario sends a weighted mix
+of requests from ``--concurrency`` client threads for ``--seconds``, after
+``--warmup`` seconds that aren't recorded:
+
+* ``browse``  -- anonymous readers: ``/``, ``/blog``, deep ``/blog`` pages
+  (keyset cursors taken from random posts), category and tag listings,
+  search, and ``/post/<slug>``.
+* ``comment`` -- logged-in readers viewing posts and posting comments.
+* ``admin``   -- the admin dashboard, post table and moderation queue, with
+  and without filters.
+
+Requests are timed by the client. The SQL statement count and SQL time of
+each request come from its ``Server-Timing`` header (see metrics.py), so
+they're reported in every mode. The report gives p50/p95/p99 latency,
+throughput, mean queries and errors per request type.
+
+Targets:
+
+* default     -- the Flask test client in this process, one client per
+  thread, like a single threaded worker with no network.
+* ``--gunicorn`` -- starts ``gunicorn`` with ``--workers``/``--threads`` on
+  a free port against the same database and talks HTTP to it.
+* ``--url``   -- an already running server; ``--database-url`` must point
+  at that server's database, which is sampled for slugs and ids.
+
+Login rate limits are turned off (default and ``--gunicorn``), and
+``--no-page-cache`` serves anonymous pages without the page cache.
+
+``--save NAME`` writes the results to ``benchmarks/results/NAME.json``.
+``--compare NAME`` prints the change against such a baseline and exits 1
+if any request type's p95 got more than ``--tolerance`` slower, or if it
+now runs more SQL statements.
+
+    python benchmarks/datagen.py --posts 100000 --comments 1000000
+    python benchmarks/loadtest.py --seconds 20 --concurrency 8 --save baseline
+    python benchmarks/loadtest.py --seconds 20 --concurrency 8 --compare baseline
+    python benchmarks/loadtest.py --gunicorn --workers 4 --scenario browse
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from urllib.parse import quote, urlencode, urlsplit
+
+from sqlalchemy.engine import make_url
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+from datagen import DEFAULT_URL, PASSWORD  # noqa: E402
+
+RESULTS_DIR = os.path.join(HERE, 'results')
+SERVER_TIMING = re.compile(r'db;dur=([\d.]+);desc="(\d+) queries"')
+SAMPLE_SIZE = 2000
+
+
+def configure(app, page_cache=True):
+    """Benchmark settings: no login rate limits, and optionally no page cache."""
+    app.config['AUTH_RATE_LIMITS'] = {}
+    if not page_cache:
+        app.extensions['page_cache'].backend = None
+    return app
+
+
+def serve(page_cache=True):
+    """gunicorn entry point, e.g. ``gunicorn 'loadtest:serve(page_cache=False)'``."""
+    from app import app
+    return configure(app, page_cache)
+
+
+# URL material
+
+class Sample:
+    """Slugs, ids, cursors and search terms drawn from the benchmark database."""
+
+    def __init__(self, seed):
+        from sqlalchemy import func, select
+
+        from app import Category, Comment, Post, Tag, User, app, db
+        from pagination import encode_cursor
+
+        rng = random.Random(seed)
+        with app.app_context(), db.engine.connect() as conn:
+            max_post = conn.execute(select(func.max(Post.id))).scalar() or 0
+            ids = rng.sample(range(1, max_post + 1), min(SAMPLE_SIZE, max_post))
+            posts = []
+            for first in range(0, len(ids), 500):
+                posts += conn.execute(select(Post.id, Post.slug, Post.title, Post.created_at).where(
+                    Post.id.in_(ids[first:first + 500]), Post.is_published == True)).all()  # noqa: E712
+            if not posts:
+                sys.exit('No published posts; run benchmarks/datagen.py first.')
+            self.posts = [(row.id, row.slug) for row in posts]
+            self.cursors = [encode_cursor([row.created_at, row.id]) for row in posts]
+            self.words = sorted({word for row in posts for word in row.title.lower().split()})
+            self.categories = conn.execute(select(Category.id)).scalars().all()
+            # Tags were generated with Zipf-like popularity, lowest id first
+            self.tags = conn.execute(select(Tag.id).order_by(Tag.id).limit(50)).scalars().all()
+            self.users = conn.execute(select(User.username).where(User.is_admin == False)  # noqa: E712
+                                      .order_by(User.id).limit(64)).scalars().all()
+            self.admin = conn.execute(select(User.username).where(User.is_admin == True)  # noqa: E712
+                                      .order_by(User.id)).scalars().first()
+            self.counts = {'posts': max_post,
+                           'comments': conn.execute(select(func.max(Comment.id))).scalar() or 0,
+                           'users': conn.execute(select(func.count(User.id))).scalar()}
+
+
+# Scenarios: (weight, name, request) where request(sample, rng) -> (method, path, form)
+
+def _post(s, rng):
+    return 'GET', f'/post/{rng.choice(s.posts)[1]}', None
+
+
+SCENARIOS = {
+    'browse': {'login': None, 'requests': [
+        (20, 'home', lambda s, rng: ('GET', '/', None)),
+        (15, 'blog', lambda s, rng: ('GET', '/blog', None)),
+        (10, 'blog_deep', lambda s, rng: ('GET', f'/blog?after={rng.choice(s.cursors)}', None)),
+        (10, 'blog_category', lambda s, rng: ('GET', f'/blog?category={rng.choice(s.categories)}', None)),
+        (5, 'blog_tag', lambda s, rng: ('GET', f'/blog?tag={rng.choice(s.tags)}', None)),
+        (10, 'search', lambda s, rng: ('GET', f'/blog?search={quote(rng.choice(s.words))}', None)),
+        (30, 'post', _post),
+    ]},
+    'comment': {'login': 'users', 'requests': [
+        (70, 'post', _post),
+        (30, 'add_comment', lambda s, rng: ('POST', f'/comment/{rng.choice(s.posts)[0]}',
+                                            {'content': ' '.join(rng.choices(s.words, k=12)).capitalize() + '.'})),
+    ]},
+    'admin': {'login': 'admin', 'requests': [
+        (20, 'admin_dashboard', lambda s, rng: ('GET', '/admin', None)),
+        (25, 'admin_posts', lambda s, rng: ('GET', '/admin/posts', None)),
+        (25, 'admin_comments', lambda s, rng: ('GET', '/admin/comments', None)),
+        (15, 'admin_comments_pending', lambda s, rng: ('GET', '/admin/comments?status=pending', None)),
+        (15, 'admin_comments_post', lambda s, rng: ('GET', f'/admin/comments?post={rng.choice(s.posts)[0]}', None)),
+    ]},
+}
+
+
+# Clients: request(method, path, form, cookie) -> (status, headers)
+
+class InProcessClient:
+    def __init__(self, app):
+        self.client = app.test_client(use_cookies=False)
+
+    def request(self, method, path, form=None, cookie=None):
+        response = self.client.open(path, method=method, data=form, headers={'Cookie': cookie} if cookie else {})
+        response.close()
+        return response.status_code, response.headers
+
+
+class HTTPClient:
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+
+    def request(self, method, path, form=None, cookie=None):
+        headers = {'Cookie': cookie} if cookie else {}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        for attempt in (1, 2):
+            try:
+                self.connection.request(method, path, body, headers)
+                response = self.connection.getresponse()
+                response.read()
+                return response.status, response.headers
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed a kept-alive connection; reconnect once
+                self.connection.close()
+                if attempt == 2:
+                    raise
+
+
+def login(client, username):
+    status, headers = client.request('POST', '/login', {'username': username, 'password': PASSWORD})
+    cookies = [value.split(';', 1)[0] for value in headers.get_all('Set-Cookie') or ()]
+    if status != 302 or not cookies:
+        sys.exit(f'Logging in as {username} failed with {status}; was the database built by datagen.py?')
+    return '; '.join(cookies)
+
+
+# Running
+
+def run_scenario(name, make_client, sample, args):
+    spec = SCENARIOS[name]
+    weights = [weight for weight, _, _ in spec['requests']]
+    requests = [(label, build) for _, label, build in spec['requests']]
+    cookies = [None]
+    if spec['login'] == 'admin':
+        cookies = [login(make_client(), sample.admin)]
+    elif spec['login'] == 'users':
+        cookies = [login(make_client(), username) for username in sample.users[:max(1, min(args.concurrency, 8))]]
+
+    records = []
+    lock = threading.Lock()
+
+    def worker(n, deadline, record):
+        rng = random.Random(args.seed * 1000 + n)
+        client = make_client()
+        cookie = cookies[n % len(cookies)]
+        local = []
+        while time.perf_counter() < deadline:
+            label, build = rng.choices(requests, weights)[0]
+            method, path, form = build(sample, rng)
+            start = time.perf_counter()
+            status, headers = client.request(method, path, form, cookie)
+            elapsed = time.perf_counter() - start
+            match = SERVER_TIMING.search(headers.get('Server-Timing') or '')
+            local.append((label, elapsed, status,
+                          int(match.group(2)) if match else None, float(match.group(1)) if match else None))
+        if record:
+            with lock:
+                records.extend(local)
+
+    for seconds, record in ((args.warmup, False), (args.seconds, True)):
+        if seconds <= 0:
+            continue
+        deadline = time.perf_counter() + seconds
+        threads = [threading.Thread(target=worker, args=(n, deadline, record)) for n in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    results = {label: summarize([r for r in records if r[0] == label], args.seconds) for label, _ in requests}
+    results['all'] = summarize(records, args.seconds)
+    return {label: stats for label, stats in results.items() if stats['count']}
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))] if values else None
+
+
+def summarize(records, seconds):
+    latencies = sorted(elapsed for _, elapsed, _, _, _ in records)
+    queries = [q for _, _, _, q, _ in records if q is not None]
+    db_ms = [d for _, _, _, _, d in records if d is not None]
+    ms = lambda value: round(value * 1000, 2) if value is not None else None  # noqa: E731
+    return {
+        'count': len(records),
+        'rps': round(len(records) / seconds, 1),
+        'p50': ms(percentile(latencies, 0.50)),
+        'p95': ms(percentile(latencies, 0.95)),
+        'p99': ms(percentile(latencies, 0.99)),
+        'queries': round(sum(queries) / len(queries), 2) if queries else None,
+        'db_ms': round(sum(db_ms) / len(db_ms), 2) if db_ms else None,
+        'errors': sum(1 for _, _, status, _, _ in records if status >= 400),
+    }
+
+
+def report(results):
+    header = f'{"request":<24}{"count":>8}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}' \
+             f'{"queries":>9}{"db ms":>8}{"errors":>8}'
+    for scenario, rows in results.items():
+        print(f'\n[{scenario}]\n{header}')
+        for label, s in rows.items():
+            print(f'{label:<24}{s["count"]:>8}{s["rps"]:>9.1f}{_fmt(s["p50"])}{_fmt(s["p95"])}{_fmt(s["p99"])}'
+                  f'{_fmt(s["queries"])}{_fmt(s["db_ms"], 8)}{s["errors"]:>8}')
+
+
+def compare(output, baseline, tolerance):
+    """Print changes against ``baseline``; returns the regressions."""
+    regressions = []
+    print(f'\nAgainst baseline from {baseline["meta"]["date"]} ({baseline["meta"].get("commit") or "unknown commit"}):')
+    mismatched = [key for key in ('target', 'concurrency', 'seconds', 'page_cache', 'database')
+                  if baseline['meta'].get(key) != output['meta'][key]]
+    # The comment scenario adds comments, so only the post and user counts identify the dataset
+    if any(baseline['meta']['data'].get(key) != output['meta']['data'][key] for key in ('posts', 'users')):
+        mismatched.append('data')
+    if mismatched:
+        print(f'Note: the runs differ in {", ".join(mismatched)}; the numbers may not be comparable.')
+    print(f'{"request":<32}{"p95 before":>11}{"after":>9}{"change":>9}{"queries":>15}')
+    for scenario, rows in output['scenarios'].items():
+        for label, now in rows.items():
+            before = baseline['scenarios'].get(scenario, {}).get(label)
+            if not before or before['p95'] is None or now['p95'] is None:
+                continue
+            change = now['p95'] / before['p95'] - 1 if before['p95'] else 0
+            queries = f'{_fmt(before["queries"], 0)} -> {_fmt(now["queries"], 0)}'
+            flags = []
+            if change > tolerance:
+                flags.append('slower')
+            if before['queries'] is not None and now['queries'] is not None and now['queries'] >= before['queries'] + 1:
+                flags.append('more queries')
+            if flags:
+                regressions.append((scenario, label, flags))
+            print(f'{scenario + "/" + label:<32}{before["p95"]:>11.2f}{now["p95"]:>9.2f}{change:>+9.0%}{queries:>15}'
+                  f'  {", ".join(flags)}')
+    return regressions
+
+
+def _fmt(value, width=9):
+    return f'{"-":>{width}}' if value is None else f'{value:>{width}.2f}' if width else f'{value:.2f}'
+
+
+def results_path(name):
+    return name if name.endswith('.json') or os.sep in name else os.path.join(RESULTS_DIR, f'{name}.json')
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(args):
+    port = free_port()
+    command = [sys.executable, '-m', 'gunicorn', '--workers', str(args.workers), '--threads', str(args.threads),
+               '--bind', f'127.0.0.1:{port}', '--pythonpath', f'{ROOT},{HERE}', '--log-level', 'warning',
+               f'loadtest:serve(page_cache={args.page_cache})']
+    server = subprocess.Popen(command, cwd=ROOT, env=dict(os.environ, DATABASE_URL=args.database_url))
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit(f'gunicorn exited with {server.returncode}')
+        try:
+            if HTTPClient(url).request('GET', '/about')[0] == 200:
+                return server, url
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    sys.exit('gunicorn did not start within 30s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default=os.environ.get('BENCHMARK_DATABASE_URL', DEFAULT_URL))
+    parser.add_argument('--scenario', choices=tuple(SCENARIOS), action='append',
+                        help='scenario(s) to run (default: all)')
+    parser.add_argument('--seconds', type=float, default=15)
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads')
+    parser.add_argument('--gunicorn', action='store_true', help='run the app under gunicorn and use HTTP')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=4, help='gunicorn threads per worker')
+    parser.add_argument('--url', help='benchmark an already running server instead')
+    parser.add_argument('--no-page-cache', dest='page_cache', action='store_false')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', metavar='NAME', help='write results to benchmarks/results/NAME.json')
+    parser.add_argument('--compare', metavar='NAME', help='compare with a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 slowdown (default 0.2 = 20%%)')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+    from app import app, auth
+    sample = Sample(args.seed)
+
+    server = None
+    if args.url:
+        target, make_client = args.url, lambda: HTTPClient(args.url)
+    elif args.gunicorn:
+        server, url = start_gunicorn(args)
+        target, make_client = f'gunicorn {args.workers}x{args.threads}', lambda: HTTPClient(url)
+    else:
+        configure(app, args.page_cache)
+        target, make_client = 'in-process', lambda: InProcessClient(app)
+
+    print(f'{target}, {args.concurrency} clients, {args.seconds:g}s per scenario; '
+          f'{sample.counts["posts"]:,} posts, {sample.counts["comments"]:,} comments, {sample.counts["users"]:,} users')
+    results = {}
+    try:
+        for scenario in args.scenario or SCENARIOS:
+            results[scenario] = run_scenario(scenario, make_client, sample, args)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if auth.pool is not None:
+            auth.pool.shutdown()
+    report(results)
+
+    output = {
+        'meta': {'date': datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(), 'target': target,
+                 'concurrency': args.concurrency, 'seconds': args.seconds, 'page_cache': args.page_cache,
+                 'database': make_url(args.database_url).get_backend_name(), 'data': sample.counts,
+                 'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'scenarios': results,
+    }
+    if args.save:
+        path = results_path(args.save)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(output, f, indent=2)
+        print(f'\nSaved {path}')
+    if args.compare:
+        with open(results_path(args.compare)) as f:
+            regressions = compare(output, json.load(f), args.tolerance)
+        if regressions:
+            print(f'\n{len(regressions)} regression(s).')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
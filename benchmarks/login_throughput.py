@@ -0,0 +1,138 @@
+"""Load test: login throughput, and what a login burst does to page latency.
+
+Builds a throwaway database with ``--users`` accounts, then runs the real
+``/login`` view through the Flask test client once per profile:
+
+* ``inline-pbkdf2`` -- werkzeug's default PBKDF2 (600,000 rounds) hashed in
+  the request thread, as the app did before auth.py.
+* ``pool-scrypt``   -- scrypt (n=32768, r=8, p=1) in the auth process pool.
+* ``pool-argon2``   -- argon2id with argon2-cffi's defaults in the pool
+  (skipped if argon2-cffi isn't installed).
+
+``--threads`` threads post correct passwords in a loop for ``--seconds``,
+standing in for a login burst on a threaded worker. One more thread keeps
+requesting ``/about`` (served without the page cache) and records its
+latency, standing in for everyone else. Rate limits are off so that only
+hashing is measured. "busy" counts logins refused with 503 because the
+hash queue was full.
+
+    python benchmarks/login_throughput.py --threads 8 --seconds 10 --workers 2 --queue 8
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp = tempfile.TemporaryDirectory()
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_tmp.name, 'login.db')}"
+
+import auth as auth_module  # noqa: E402
+from app import User, app, auth, db  # noqa: E402
+
+PASSWORD = 'correct horse battery staple'
+
+PROFILES = {
+    'inline-pbkdf2': {'AUTH_PASSWORD_METHOD': 'pbkdf2:sha256:600000', 'AUTH_HASH_WORKERS': 0},
+    'pool-scrypt': {'AUTH_PASSWORD_METHOD': 'scrypt:32768:8:1'},
+    'pool-argon2': {'AUTH_PASSWORD_METHOD': auth_module.ARGON2},
+}
+
+
+def configure(profile, args):
+    settings = {'AUTH_HASH_WORKERS': args.workers, 'AUTH_HASH_QUEUE': args.queue,
+                'AUTH_RATE_LIMITS': {}}
+    settings.update(PROFILES[profile])
+    if auth.pool is not None:
+        auth.pool.shutdown()
+    app.config.update(settings)
+    auth.init_app(app)
+    app.extensions['page_cache'].backend = None
+
+
+def build(users, method):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        password_hash = auth_module.hash_password(PASSWORD, method)
+        db.session.add_all(User(username=f'user{i}', email=f'user{i}@example.com', password_hash=password_hash)
+                           for i in range(users))
+        db.session.commit()
+
+
+def login_loop(deadline, offset, users, latencies, counts):
+    client = app.test_client()
+    i = offset
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        response = client.post('/login', data={'username': f'user{i % users}', 'password': PASSWORD})
+        elapsed = time.perf_counter() - start
+        if response.status_code == 302:
+            latencies.append(elapsed)
+            client.get('/logout')
+        else:
+            counts[response.status_code] = counts.get(response.status_code, 0) + 1
+        i += 1
+
+
+def page_loop(deadline, latencies):
+    client = app.test_client()
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        client.get('/about')
+        latencies.append(time.perf_counter() - start)
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(profile, args):
+    configure(profile, args)
+    build(args.users, app.config['AUTH_PASSWORD_METHOD'])
+    auth.check_password(None, PASSWORD)  # start the pool and the dummy hash outside the timing
+    logins, pages, counts = [], [], {}
+    deadline = time.perf_counter() + args.seconds
+    threads = [threading.Thread(target=login_loop, args=(deadline, n, args.users, logins, counts))
+               for n in range(args.threads)]
+    threads.append(threading.Thread(target=page_loop, args=(deadline, pages)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ms = lambda values, p: percentile(values, p) * 1000  # noqa: E731
+    print(f'{profile:<14} {len(logins) / args.seconds:>9.1f} {ms(logins, 0.5):>9.1f} {ms(logins, 0.95):>8.1f} '
+          f'{ms(pages, 0.5):>9.2f} {ms(pages, 0.95):>8.2f} {ms(pages, 0.99):>8.2f} {counts.get(503, 0):>6}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8, help='concurrent login clients')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=1, help='AUTH_HASH_WORKERS for the pool profiles')
+    parser.add_argument('--queue', type=int, default=4, help='AUTH_HASH_QUEUE')
+    parser.add_argument('--profile', choices=tuple(PROFILES), action='append',
+                        help='profile(s) to run (default: all available)')
+    args = parser.parse_args()
+
+    profiles = args.profile or [p for p in PROFILES if p != 'pool-argon2' or auth_module.argon2 is not None]
+    print(f'{args.threads} login threads, {args.seconds:g}s, pool of {args.workers}, queue {args.queue}\n')
+    print(f'{"profile":<14} {"logins/s":>9} {"login p50":>9} {"p95":>8} '
+          f'{"page p50":>9} {"p95":>8} {"p99":>8} {"busy":>6}')
+    try:
+        for profile in profiles:
+            run(profile, args)
+    finally:
+        auth.pool.shutdown()
+    print('\nLatencies in ms. "page" is /about, requested alongside the logins.')
+
+
+if __name__ == '__main__':
+    main()
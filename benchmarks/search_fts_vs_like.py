@@ -0,0 +1,122 @@
+"""Compare /blog?search= on the old LIKE path against the FTS5 index.
+
+Builds a throwaway SQLite database with a synthetic corpus (100k posts by
+default), then times the two statements each search request runs on both
+paths: the COUNT for pagination and the first page of 9 results.
+
+    python benchmarks/search_fts_vs_like.py --posts 100000 --repeat 5
+"""
+import argparse
+import itertools
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search import CREATE_SQL, WEIGHTS, plain_text, to_match_query  # noqa: E402
+
+SYLLABLES = 'ka lo mi ne ru sa ti vo be da fe gu hi jo pu ze'.split()
+VOCABULARY = 20000
+
+
+def vocabulary(rng):
+    """Distinct pseudo-words with Zipf-like frequencies, like natural text."""
+    words = set()
+    while len(words) < VOCABULARY:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    words = sorted(words)
+    rng.shuffle(words)
+    cum_weights = list(itertools.accumulate(1.0 / rank for rank in range(1, VOCABULARY + 1)))
+    return words, cum_weights
+
+
+def queries(words):
+    """A common, a mid-frequency and a rare term, a two-term query, a prefix and a miss."""
+    return [words[10], words[500], words[8000], f'{words[40]} {words[300]}', words[200][:4], 'zzzmissing']
+
+
+LIKE_COUNT = "SELECT count(*) FROM post WHERE is_published = 1 AND (title LIKE ? OR content LIKE ?)"
+LIKE_PAGE = ("SELECT id, title FROM post WHERE is_published = 1 AND (title LIKE ? OR content LIKE ?) "
+             "ORDER BY created_at DESC LIMIT 9")
+FTS_COUNT = ("SELECT count(*) FROM post JOIN post_fts ON post_fts.rowid = post.id "
+             "WHERE post.is_published = 1 AND post_fts MATCH ?")
+FTS_PAGE = ("SELECT post.id, post.title FROM post JOIN "
+            "(SELECT rowid AS post_id, bm25(post_fts, %s, %s, %s) AS rank FROM post_fts WHERE post_fts MATCH ?) hits "
+            "ON hits.post_id = post.id WHERE post.is_published = 1 ORDER BY hits.rank LIMIT 9") % WEIGHTS
+
+
+def build(path, posts, seed=42):
+    rng = random.Random(seed)
+    words, cum_weights = vocabulary(rng)
+
+    def sentence(n):
+        return ' '.join(rng.choices(words, cum_weights=cum_weights, k=n))
+
+    # Posts are assembled from pools of generated text; drawing every word
+    # per post would dominate the run time without changing term statistics.
+    titles = [sentence(6).title() for _ in range(20000)]
+    paragraphs = [sentence(60) for _ in range(5000)]
+
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE post (id INTEGER PRIMARY KEY, title TEXT, excerpt TEXT, content TEXT,
+                    is_published BOOLEAN, created_at DATETIME)""")
+    conn.execute("CREATE INDEX idx_post_created_at ON post(created_at)")
+    conn.execute(CREATE_SQL)
+    batch = []
+    for i in range(1, posts + 1):
+        title = rng.choice(titles)
+        body = rng.sample(paragraphs, 5)
+        excerpt = body[0][:120]
+        content = '<p>' + '</p><p>'.join(body) + '</p>'
+        batch.append((i, title, excerpt, content, 1, '2024-01-01 00:00:%08d' % i))
+        if len(batch) == 5000:
+            _insert(conn, batch)
+            batch = []
+    if batch:
+        _insert(conn, batch)
+    conn.execute("INSERT INTO post_fts (post_fts) VALUES ('optimize')")
+    conn.commit()
+    return conn, words
+
+
+def _insert(conn, batch):
+    conn.executemany("INSERT INTO post VALUES (?, ?, ?, ?, ?, ?)", batch)
+    conn.executemany("INSERT INTO post_fts (rowid, title, excerpt, content) VALUES (?, ?, ?, ?)",
+                     [(i, title, plain_text(excerpt), plain_text(content)) for i, title, excerpt, content, _, _ in batch])
+
+
+def timed(conn, sql, params, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        conn, words = build(os.path.join(tmp, 'bench.db'), args.posts)
+        print(f'Built {args.posts} posts + FTS index in {time.perf_counter() - start:.1f}s')
+        print(f"{'query':<18}{'LIKE ms':>10}{'FTS ms':>10}{'speedup':>10}")
+        for query in queries(words):
+            like = '%' + query + '%'
+            match = to_match_query(query)
+            like_ms = timed(conn, LIKE_COUNT, (like, like), args.repeat) + timed(conn, LIKE_PAGE, (like, like), args.repeat)
+            fts_ms = timed(conn, FTS_COUNT, (match,), args.repeat) + timed(conn, FTS_PAGE, (match,), args.repeat)
+            print(f'{query:<18}{like_ms:>10.1f}{fts_ms:>10.1f}{like_ms / fts_ms:>9.1f}x')
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Load test: concurrent readers and writers on SQLite, before and after tuning.
+
+Runs the same mixed workload against a throwaway database twice:
+
+* ``default`` -- ``create_engine(url)`` with nothing else, as the app was
+  configured before database.py: rollback journal, synchronous=FULL.
+* ``tuned``   -- the engine options and connect-hook PRAGMAs from database.py
+  (WAL, synchronous=NORMAL, busy_timeout, mmap, cache_size).
+
+Each worker is a separate process, as gunicorn workers are. A worker loops
+for ``--seconds``. Each op is either a read (the /blog first page plus the
+approved comments of one post) or, with probability ``--writes``, a write
+transaction (insert a comment, bump a view count). The report gives
+throughput, latency percentiles and the number of operations that failed
+with ``database is locked``.
+
+    python benchmarks/sqlite_concurrency.py --workers 8 --seconds 10 --writes 0.2
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, event, text  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+
+import database  # noqa: E402
+
+SCHEMA = """
+CREATE TABLE post (
+    id INTEGER PRIMARY KEY, title VARCHAR(200) NOT NULL, slug VARCHAR(200) UNIQUE NOT NULL,
+    content TEXT NOT NULL, excerpt TEXT, is_published BOOLEAN, created_at DATETIME,
+    category_id INTEGER, views INTEGER DEFAULT 0
+);
+CREATE INDEX idx_post_published_created ON post (is_published, created_at, id);
+CREATE TABLE comment (
+    id INTEGER PRIMARY KEY, content TEXT NOT NULL, created_at DATETIME, is_approved BOOLEAN,
+    user_id INTEGER NOT NULL, post_id INTEGER NOT NULL REFERENCES post (id)
+);
+CREATE INDEX idx_comment_post_approved ON comment (post_id, is_approved, created_at);
+"""
+
+READ_PAGE = text("SELECT id, title, slug, excerpt, created_at, views FROM post WHERE is_published = 1 "
+                 "ORDER BY created_at DESC, id DESC LIMIT 9")
+READ_COMMENTS = text("SELECT id, content, created_at FROM comment WHERE post_id = :post_id AND is_approved = 1 "
+                     "ORDER BY created_at")
+WRITE_COMMENT = text("INSERT INTO comment (content, created_at, is_approved, user_id, post_id) "
+                     "VALUES (:content, datetime('now'), 0, 1, :post_id)")
+WRITE_VIEWS = text("UPDATE post SET views = COALESCE(views, 0) + 1 WHERE id = :post_id")
+
+
+def build(path, posts):
+    engine = create_engine(f'sqlite:///{path}')
+    with engine.begin() as conn:
+        for statement in SCHEMA.split(';'):
+            if statement.strip():
+                conn.exec_driver_sql(statement)
+        conn.execute(text(
+            "INSERT INTO post (id, title, slug, content, excerpt, is_published, created_at, category_id) "
+            "VALUES (:id, :title, :slug, :content, :excerpt, 1, datetime('now', :age), :category)"
+        ), [{'id': i, 'title': f'Post {i}', 'slug': f'post-{i}', 'content': 'lorem ipsum ' * 300,
+             'excerpt': 'lorem ipsum', 'age': f'-{i} minutes', 'category': i % 5 + 1}
+            for i in range(1, posts + 1)])
+        conn.execute(text(
+            "INSERT INTO comment (content, created_at, is_approved, user_id, post_id) "
+            "VALUES ('nice post', datetime('now'), 1, 1, :post_id)"
+        ), [{'post_id': i % posts + 1} for i in range(posts * 3)])
+    engine.dispose()
+
+
+def make_engine(url, profile):
+    if profile == 'default':
+        return create_engine(url)
+    engine = create_engine(url, **database.engine_options(url, {}))
+    pragmas = [(pragma, default) for _, pragma, default in database.SQLITE_PRAGMAS]
+    event.listen(engine, 'connect', lambda dbapi_connection, record: database.apply_pragmas(dbapi_connection, pragmas))
+    return engine
+
+
+def worker(url, profile, seconds, write_ratio, posts, seed):
+    rng = random.Random(seed)
+    engine = make_engine(url, profile)
+    reads, writes, errors = [], [], 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        post_id = rng.randint(1, posts)
+        is_write = rng.random() < write_ratio
+        start = time.perf_counter()
+        try:
+            if is_write:
+                with engine.begin() as conn:
+                    conn.execute(WRITE_COMMENT, {'content': 'load test', 'post_id': post_id})
+                    conn.execute(WRITE_VIEWS, {'post_id': post_id})
+            else:
+                with engine.connect() as conn:
+                    conn.execute(READ_PAGE).all()
+                    conn.execute(READ_COMMENTS, {'post_id': post_id}).all()
+        except OperationalError:
+            errors += 1
+            continue
+        (writes if is_write else reads).append(time.perf_counter() - start)
+    engine.dispose()
+    return reads, writes, errors
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(profile, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'load.db')
+        build(path, args.posts)
+        url = f'sqlite:///{path}'
+        jobs = [(url, profile, args.seconds, args.writes, args.posts, n) for n in range(args.workers)]
+        with multiprocessing.Pool(args.workers) as pool:
+            results = pool.starmap(worker, jobs)
+    reads = [t for r, _, _ in results for t in r]
+    writes = [t for _, w, _ in results for t in w]
+    errors = sum(e for _, _, e in results)
+    ms = lambda values, p: percentile(values, p) * 1000  # noqa: E731
+    print(f'{profile:<8} {(len(reads) + len(writes)) / args.seconds:>9.0f} '
+          f'{ms(reads, 0.5):>8.2f} {ms(reads, 0.95):>8.2f} {ms(reads, 0.99):>8.2f} '
+          f'{ms(writes, 0.5):>8.2f} {ms(writes, 0.95):>8.2f} {ms(writes, 0.99):>8.2f} {errors:>7}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--writes', type=float, default=0.2, help='fraction of operations that write')
+    parser.add_argument('--posts', type=int, default=2000)
+    parser.add_argument('--profile', choices=('default', 'tuned'), action='append',
+                        help='profile(s) to run (default: both)')
+    args = parser.parse_args()
+
+    print(f'{args.workers} workers, {args.seconds:g}s, {args.writes:.0%} writes, {args.posts} posts\n')
+    print(f'{"profile":<8} {"ops/s":>9} {"read p50":>8} {"p95":>8} {"p99":>8} '
+          f'{"write p50":>8} {"p95":>8} {"p99":>8} {"locked":>7}')
+    for profile in args.profile or ('default', 'tuned'):
+        run(profile, args)
+    print('\nLatencies in ms. "locked" counts operations that failed with "database is locked".')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""Comment threads: approved comments a page at a time, and per-post counters.
+
+A post page used to load every comment on the post, approved or not, then
+fetch each author separately. It also counted the list again to decide
+whether to show "No comments yet". ``page()`` now returns one keyset page of
+approved comments, newest first, with authors joined in. The query is
+answered from ``idx_comment_post_approved``, whatever the thread's length.
+Later pages come from the JSON endpoint behind the "Load more" button.
+
+``Post.approved_comment_count`` and ``Post.pending_comment_count`` hold the
+totals. Every flush that adds, deletes or (un)approves a comment adjusts
+them with ``count = count + n`` in the same transaction, so concurrent
+writers don't lose updates. The counters don't depend on which route made
+the change. Bulk Core statements bypass the ORM, so callers follow them
+with ``recount(post_ids)``. ``flask comments-recount`` rebuilds every
+counter from the comment table.
+
+Moderation: ``queue()`` filters the admin table by status, post or author,
+each backed by an index. ``stats()`` counts pending and approved comments
+in one grouped query. ``bulk_approve()`` and ``bulk_delete()`` handle any
+number of IDs as set-based statements in the caller's transaction, then
+recount the posts they touched.
+"""
+from collections import defaultdict
+
+import click
+from markupsafe import Markup, escape
+from sqlalchemy import event, func, inspect, select, update
+from sqlalchemy.orm import joinedload
+
+from pagination import keyset_paginate
+
+# Keeps IN lists under SQLite's bound-parameter limit
+BULK_CHUNK = 500
+QUEUE_STATUSES = ('pending', 'approved')
+
+
+def nl2br(value):
+    """Escape ``value`` and turn its line breaks into ``<br>``."""
+    return Markup('<br>\n').join(escape(value or '').split('\n'))
+
+
+def counter_values(post_table, comment_table):
+    """Correlated subqueries that recount both counters from ``comment_table``."""
+    def count(approved):
+        condition = comment_table.c.is_approved.is_(True) if approved else \
+            (comment_table.c.is_approved.is_(False) | comment_table.c.is_approved.is_(None))
+        return (select(func.count()).select_from(comment_table)
+                .where(comment_table.c.post_id == post_table.c.id, condition).scalar_subquery())
+    return {'approved_comment_count': count(True), 'pending_comment_count': count(False)}
+
+
+class CommentThreads:
+    def __init__(self, app=None, db=None, comment=None, post=None):
+        if app is not None:
+            self.init_app(app, db, comment, post)
+
+    def init_app(self, app, db, comment, post):
+        app.config.setdefault('COMMENTS_PER_PAGE', 20)
+        app.config.setdefault('COMMENTS_BULK_LIMIT', 5000)
+        self.app = app
+        self.db = db
+        self.comment = comment
+        self.post = post
+        app.extensions['comment_threads'] = self
+        app.add_template_filter(nl2br, 'nl2br')
+        event.listen(db.session, 'after_flush', self._count_changes)
+        event.listen(db.session, 'after_flush_postexec', self._expire_counts)
+
+        @app.cli.command('comments-recount')
+        def comments_recount_command():
+            """Recompute every post's approved/pending comment counters."""
+            with app.app_context():
+                self.recount()
+                db.session.commit()
+            click.echo('Comment counters rebuilt.')
+
+    def page(self, post_id, after=None, per_page=None):
+        """One page of a post's approved comments, newest first, authors loaded."""
+        Comment = self.comment
+        query = (Comment.query.options(joinedload(Comment.author))
+                 .filter(Comment.post_id == post_id, Comment.is_approved == True))  # noqa: E712
+        return keyset_paginate(query, (Comment.created_at, Comment.id), after=after,
+                               per_page=per_page or self.app.config['COMMENTS_PER_PAGE'])
+
+    # Moderation
+
+    def queue(self, status=None, post_id=None, user_id=None):
+        """Comments for the moderation table, optionally narrowed by status, post and author."""
+        Comment = self.comment
+        query = Comment.query
+        if status in QUEUE_STATUSES:
+            query = query.filter(Comment.is_approved == (status == 'approved'))
+        if post_id is not None:
+            query = query.filter(Comment.post_id == post_id)
+        if user_id is not None:
+            query = query.filter(Comment.user_id == user_id)
+        return query
+
+    def stats(self, post_id=None, user_id=None):
+        """``{'approved': n, 'pending': n, 'total': n}`` in one grouped query."""
+        Comment = self.comment
+        query = self.queue(post_id=post_id, user_id=user_id).with_entities(
+            Comment.is_approved, func.count(Comment.id)).group_by(Comment.is_approved).order_by(None)
+        counts = {'approved': 0, 'pending': 0}
+        for approved, count in query:
+            counts['approved' if approved else 'pending'] += count
+        counts['total'] = counts['approved'] + counts['pending']
+        return counts
+
+    def bulk_approve(self, ids):
+        """Approve the pending comments among ``ids``; returns ``(count, post_ids)``."""
+        table = self.comment.__table__
+        pending = table.c.is_approved.is_(False) | table.c.is_approved.is_(None)
+        return self._bulk(ids, pending, lambda chunk: update(table).where(
+            table.c.id.in_(chunk), pending).values(is_approved=True))
+
+    def bulk_delete(self, ids):
+        """Delete the comments among ``ids``; returns ``(count, post_ids)``."""
+        table = self.comment.__table__
+        return self._bulk(ids, None, lambda chunk: table.delete().where(table.c.id.in_(chunk)))
+
+    def _bulk(self, ids, condition, statement_for):
+        table = self.comment.__table__
+        session = self.db.session
+        ids = sorted({int(i) for i in ids})
+        count = 0
+        post_ids = set()
+        for start in range(0, len(ids), BULK_CHUNK):
+            chunk = ids[start:start + BULK_CHUNK]
+            affected = select(table.c.post_id).distinct().where(table.c.id.in_(chunk))
+            if condition is not None:
+                affected = affected.where(condition)
+            post_ids.update(session.execute(affected).scalars())
+            count += session.execute(statement_for(chunk)).rowcount
+        # Objects already loaded in this session no longer match the rows
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, self.comment) and obj.id in ids:
+                session.expire(obj)
+        if post_ids:
+            self.recount(post_ids)
+        return count, post_ids
+
+    def recount(self, post_ids=None):
+        """Recompute counters from the comment table, for ``post_ids`` or every post."""
+        post_table = self.post.__table__
+        statement = update(post_table).values(**counter_values(post_table, self.comment.__table__))
+        if post_ids is not None:
+            statement = statement.where(post_table.c.id.in_(list(post_ids)))
+        self.db.session.execute(statement)
+        self._expire(self.db.session, post_ids)
+
+    # Change tracking
+
+    def _count_changes(self, session, flush_context):
+        Comment = self.comment
+        deltas = defaultdict(lambda: [0, 0])  # post_id -> [approved, pending]
+        for obj in session.new:
+            if isinstance(obj, Comment):
+                deltas[obj.post_id][0 if obj.is_approved else 1] += 1
+        for obj in session.deleted:
+            if isinstance(obj, Comment):
+                deltas[obj.post_id][0 if obj.is_approved else 1] -= 1
+        for obj in session.dirty:
+            if not isinstance(obj, Comment):
+                continue
+            history = inspect(obj).attrs.is_approved.history
+            if history.deleted and bool(history.deleted[0]) != bool(obj.is_approved):
+                step = 1 if obj.is_approved else -1
+                deltas[obj.post_id][0] += step
+                deltas[obj.post_id][1] -= step
+
+        post_table = self.post.__table__
+        connection = session.connection()
+        for post_id, (approved, pending) in deltas.items():
+            if approved or pending:
+                connection.execute(update(post_table).where(post_table.c.id == post_id).values(
+                    approved_comment_count=post_table.c.approved_comment_count + approved,
+                    pending_comment_count=post_table.c.pending_comment_count + pending))
+        session.info.setdefault('comment_counts_changed', set()).update(deltas)
+
+    def _expire_counts(self, session, flush_context):
+        post_ids = session.info.pop('comment_counts_changed', None)
+        if post_ids:
+            self._expire(session, post_ids)
+
+    def _expire(self, session, post_ids):
+        """Drop stale counters on loaded posts so the next access reads the database."""
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, self.post) and (post_ids is None or obj.id in post_ids):
+                session.expire(obj, ['approved_comment_count', 'pending_comment_count'])
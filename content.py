@@ -0,0 +1,180 @@
+"""Post bodies rendered once, when they are saved.
+
+Authors write Markdown, and inline HTML is still accepted, so older posts
+written as HTML render unchanged. Before any flush that adds a post or
+changes its ``content`` or ``excerpt``, the source goes through this
+pipeline and the results land in columns on the post:
+
+* ``content_html``: Markdown rendered to HTML, then sanitized with nh3
+  against an allowlist. Scripts, event handlers, ``javascript:`` URLs and
+  unknown tags are removed, and links get ``rel="noopener noreferrer
+  nofollow"``. Headings get stable ``id`` anchors.
+* ``toc``: JSON ``[[level, id, text], ...]`` for the h2/h3 headings.
+* ``summary``: the author's excerpt, or the first ~160 characters of the
+  plain text, cut at a word boundary. It feeds meta descriptions and cards.
+* ``word_count`` and ``reading_time`` (minutes, at 200 words a minute).
+
+Views then only print stored values. Nothing parses or sanitizes Markdown
+per request, and nothing slices ``content``. Migration 3 fills the columns
+for existing posts. After changing the rules here, run ``flask
+content-rebuild --all`` to re-render every post.
+"""
+import html
+import json
+import math
+import re
+from functools import lru_cache
+
+import click
+import markdown
+import nh3
+from sqlalchemy import event, inspect, select
+
+from search import plain_text
+
+MARKDOWN_EXTENSIONS = ('extra', 'sane_lists')
+
+ALLOWED_TAGS = {
+    'a', 'abbr', 'b', 'blockquote', 'br', 'caption', 'cite', 'code', 'dd', 'del', 'details', 'div', 'dl', 'dt',
+    'em', 'figcaption', 'figure', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'ins', 'kbd', 'li',
+    'mark', 'ol', 'p', 'pre', 'q', 's', 'small', 'span', 'strong', 'sub', 'summary', 'sup', 'table', 'tbody',
+    'td', 'tfoot', 'th', 'thead', 'tr', 'u', 'ul',
+}
+ALLOWED_ATTRIBUTES = {
+    '*': {'title'},
+    'a': {'href'},
+    'abbr': {'title'},
+    'img': {'src', 'alt', 'width', 'height'},
+    'ol': {'start'},
+    'td': {'colspan', 'rowspan', 'align'},
+    'th': {'colspan', 'rowspan', 'align', 'scope'},
+    'code': {'class'},  # fenced code language, e.g. language-python
+}
+URL_SCHEMES = {'http', 'https', 'mailto'}
+
+SUMMARY_LENGTH = 160
+WORDS_PER_MINUTE = 200
+TOC_LEVELS = (2, 3)
+
+PROCESSED_FIELDS = ('content', 'excerpt')
+
+_HEADING_RE = re.compile(r'<h([1-6])>(.*?)</h\1>', re.S)
+_TAG_RE = re.compile(r'<[^>]*>')
+_SLUG_RE = re.compile(r'[^\w\s-]', re.UNICODE)
+_DASH_RE = re.compile(r'[-\s]+')
+
+
+def render_markdown(source):
+    return markdown.markdown(source or '', extensions=list(MARKDOWN_EXTENSIONS), output_format='html')
+
+
+def sanitize(value):
+    return nh3.clean(value, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES, url_schemes=URL_SCHEMES,
+                     link_rel='noopener noreferrer nofollow')
+
+
+def anchor(text):
+    slug = _DASH_RE.sub('-', _SLUG_RE.sub('', text).strip().lower())
+    return slug or 'section'
+
+
+def add_heading_ids(value):
+    """Give each heading a unique ``id``; returns ``(html, [(level, id, text)])``."""
+    headings = []
+    seen = {}
+
+    def replace(match):
+        level, inner = int(match.group(1)), match.group(2)
+        text = html.unescape(_TAG_RE.sub('', inner)).strip()
+        base = anchor(text)
+        seen[base] = seen.get(base, 0) + 1
+        heading_id = base if seen[base] == 1 else f'{base}-{seen[base]}'
+        headings.append((level, heading_id, text))
+        return f'<h{level} id="{heading_id}">{inner}</h{level}>'
+
+    return _HEADING_RE.sub(replace, value), headings
+
+
+def summarize(text, length=SUMMARY_LENGTH):
+    if len(text) <= length:
+        return text
+    cut = text[:length].rsplit(' ', 1)[0].rstrip(' ,;:.-')
+    return f'{cut}…'
+
+
+def process(content, excerpt=None):
+    """Everything derived from a post's source, keyed by column name."""
+    body, headings = add_heading_ids(sanitize(render_markdown(content)))
+    text = plain_text(body)
+    words = len(text.split())
+    return {
+        'content_html': body,
+        'toc': json.dumps([[level, heading_id, title] for level, heading_id, title in headings
+                           if level in TOC_LEVELS]),
+        'summary': (excerpt or '').strip() or summarize(text),
+        'word_count': words,
+        'reading_time': max(1, math.ceil(words / WORDS_PER_MINUTE)),
+    }
+
+
+@lru_cache(maxsize=1024)
+def parse_toc(value):
+    """``[(level, id, text)]`` from a stored ``toc`` column."""
+    if not value:
+        return ()
+    try:
+        return tuple(tuple(entry) for entry in json.loads(value))
+    except ValueError:
+        return ()
+
+
+class ContentProcessor:
+    def __init__(self, app=None, db=None, model=None):
+        if app is not None:
+            self.init_app(app, db, model)
+
+    def init_app(self, app, db, model):
+        self.app = app
+        self.db = db
+        self.model = model
+        app.extensions['content_processor'] = self
+        app.add_template_filter(parse_toc, 'toc_entries')
+        event.listen(db.session, 'before_flush', self._render_changed)
+
+        @app.cli.command('content-rebuild')
+        @click.option('--all', 'everything', is_flag=True, help='Re-render every post, not only unrendered ones.')
+        def content_rebuild_command(everything):
+            """Render and sanitize post bodies (only unprocessed ones unless --all)."""
+            count = self.rebuild(everything)
+            click.echo(f'Processed {count} posts.')
+
+    def apply(self, post):
+        for column, value in process(post.content, post.excerpt).items():
+            setattr(post, column, value)
+
+    def rebuild(self, everything=False, batch_size=200):
+        """Process posts in batches; with ``everything`` False, only those never processed."""
+        Post = self.model
+        session = self.db.session
+        with self.app.app_context():
+            query = select(Post.id).order_by(Post.id)
+            if not everything:
+                query = query.where(Post.content_html.is_(None))
+            ids = session.execute(query).scalars().all()
+            for start in range(0, len(ids), batch_size):
+                for post in session.execute(select(Post).where(Post.id.in_(ids[start:start + batch_size]))).scalars():
+                    self.apply(post)
+                session.commit()
+        return len(ids)
+
+    def _render_changed(self, session, flush_context, instances):
+        Post = self.model
+        for obj in session.new:
+            if isinstance(obj, Post):
+                self.apply(obj)
+        for obj in session.dirty:
+            if not isinstance(obj, Post):
+                continue
+            state = inspect(obj)
+            if any(state.attrs[field].history.has_changes() for field in PROCESSED_FIELDS):
+                self.apply(obj)
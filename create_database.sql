@@ -9,7 +9,7 @@ CREATE TABLE IF NOT EXISTS user (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     username VARCHAR(80) UNIQUE NOT NULL,
     email VARCHAR(120) UNIQUE NOT NULL,
-    password_hash VARCHAR(120) NOT NULL,
+    password_hash VARCHAR(255) NOT NULL,
     is_admin BOOLEAN DEFAULT 0,
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP
 );
@@ -34,7 +34,13 @@ CREATE TABLE IF NOT EXISTS post (
     slug VARCHAR(200) UNIQUE NOT NULL,
     content TEXT NOT NULL,
     excerpt TEXT,
+    content_html TEXT,
+    toc TEXT,
+    summary TEXT,
+    word_count INTEGER,
+    reading_time INTEGER,
     featured_image VARCHAR(200),
+    featured_image_variants TEXT,
     is_published BOOLEAN DEFAULT 1,
     is_featured BOOLEAN DEFAULT 0,
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
@@ -42,6 +48,9 @@ CREATE TABLE IF NOT EXISTS post (
     user_id INTEGER NOT NULL,
     category_id INTEGER,
     views INTEGER DEFAULT 0,
+    approved_comment_count INTEGER NOT NULL DEFAULT 0,
+    pending_comment_count INTEGER NOT NULL DEFAULT 0,
+    popularity FLOAT NOT NULL DEFAULT 0,
     FOREIGN KEY (user_id) REFERENCES user (id),
     FOREIGN KEY (category_id) REFERENCES category (id)
 );
@@ -62,7 +71,24 @@ CREATE TABLE IF NOT EXISTS comment (
 CREATE TABLE IF NOT EXISTS newsletter (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     email VARCHAR(120) UNIQUE NOT NULL,
-    subscribed_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    subscribed_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    unsubscribed_at DATETIME
+);
+
+-- Newsletter issues, rendered once when queued and delivered in batches
+CREATE TABLE IF NOT EXISTS newsletter_issue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    subject VARCHAR(200) NOT NULL,
+    body TEXT NOT NULL,
+    html TEXT NOT NULL,
+    text TEXT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    queued_at DATETIME,
+    sent_at DATETIME,
+    last_subscriber_id INTEGER NOT NULL DEFAULT 0,
+    sent_count INTEGER NOT NULL DEFAULT 0,
+    failed_count INTEGER NOT NULL DEFAULT 0
 );
 
 -- Association table for many-to-many relationship between posts and tags
@@ -74,18 +100,94 @@ CREATE TABLE IF NOT EXISTS post_tags (
     FOREIGN KEY (tag_id) REFERENCES tag (id)
 );
 
+-- Precomputed related posts, rank 0 first (see recommendations.py)
+CREATE TABLE IF NOT EXISTS post_related (
+    post_id INTEGER NOT NULL,
+    rank INTEGER NOT NULL,
+    related_id INTEGER NOT NULL,
+    score FLOAT NOT NULL,
+    PRIMARY KEY (post_id, rank),
+    FOREIGN KEY (post_id) REFERENCES post (id) ON DELETE CASCADE,
+    FOREIGN KEY (related_id) REFERENCES post (id) ON DELETE CASCADE
+);
+
+-- Stored uploads and their reference counts (see storage.py)
+CREATE TABLE IF NOT EXISTS stored_file (
+    "key" VARCHAR(100) NOT NULL PRIMARY KEY,
+    size BIGINT NOT NULL,
+    refcount INTEGER NOT NULL DEFAULT 0,
+    touched_at DATETIME NOT NULL
+);
+
+-- Page views waiting to be rolled up, and their rollups (see analytics.py)
+CREATE TABLE IF NOT EXISTS analytics_event (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    post_id INTEGER NOT NULL,
+    hour DATETIME NOT NULL,
+    views INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS post_views_hourly (
+    post_id INTEGER NOT NULL,
+    hour DATETIME NOT NULL,
+    views INTEGER NOT NULL,
+    PRIMARY KEY (post_id, hour),
+    FOREIGN KEY (post_id) REFERENCES post (id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS post_views_daily (
+    post_id INTEGER NOT NULL,
+    day DATE NOT NULL,
+    views INTEGER NOT NULL,
+    PRIMARY KEY (post_id, day),
+    FOREIGN KEY (post_id) REFERENCES post (id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS site_views_daily (
+    day DATE NOT NULL PRIMARY KEY,
+    views BIGINT NOT NULL
+);
+
+-- Former post slugs, redirected to the current one (see slugs.py)
+CREATE TABLE IF NOT EXISTS slug_history (
+    slug VARCHAR(200) NOT NULL PRIMARY KEY,
+    post_id INTEGER NOT NULL,
+    changed_at DATETIME NOT NULL,
+    FOREIGN KEY (post_id) REFERENCES post (id) ON DELETE CASCADE
+);
+
+-- Dashboard totals: posts, users, comments and views
+CREATE TABLE IF NOT EXISTS analytics_counter (
+    name VARCHAR(20) NOT NULL PRIMARY KEY,
+    value BIGINT NOT NULL
+);
+
 -- Create indexes for better performance
-CREATE INDEX IF NOT EXISTS idx_post_user_id ON post(user_id);
-CREATE INDEX IF NOT EXISTS idx_post_category_id ON post(category_id);
-CREATE INDEX IF NOT EXISTS idx_post_slug ON post(slug);
-CREATE INDEX IF NOT EXISTS idx_post_published ON post(is_published);
-CREATE INDEX IF NOT EXISTS idx_post_featured ON post(is_featured);
-CREATE INDEX IF NOT EXISTS idx_post_created_at ON post(created_at);
-CREATE INDEX IF NOT EXISTS idx_comment_post_id ON comment(post_id);
-CREATE INDEX IF NOT EXISTS idx_comment_user_id ON comment(user_id);
-CREATE INDEX IF NOT EXISTS idx_comment_approved ON comment(is_approved);
-CREATE INDEX IF NOT EXISTS idx_post_tags_post_id ON post_tags(post_id);
-CREATE INDEX IF NOT EXISTS idx_post_tags_tag_id ON post_tags(tag_id);
+-- These mirror the __table_args__ of the models in app.py; keep them in sync
+CREATE INDEX IF NOT EXISTS idx_post_published_created ON post(is_published, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_post_category_published_created ON post(category_id, is_published, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_post_featured_created ON post(is_featured, is_published, created_at);
+CREATE INDEX IF NOT EXISTS idx_post_user_created ON post(user_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_post_created ON post(created_at, id);
+CREATE INDEX IF NOT EXISTS idx_post_published_popularity ON post(is_published, popularity, id);
+CREATE INDEX IF NOT EXISTS idx_comment_post_approved ON comment(post_id, is_approved, created_at);
+CREATE INDEX IF NOT EXISTS idx_comment_created ON comment(created_at, id);
+CREATE INDEX IF NOT EXISTS idx_comment_approved_created ON comment(is_approved, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_comment_post_created ON comment(post_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_comment_user_created ON comment(user_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_post_tags_tag ON post_tags(tag_id, post_id);
+CREATE INDEX IF NOT EXISTS idx_post_related_related ON post_related(related_id);
+CREATE INDEX IF NOT EXISTS idx_stored_file_refcount_touched ON stored_file(refcount, touched_at);
+CREATE INDEX IF NOT EXISTS idx_slug_history_post ON slug_history(post_id);
+CREATE INDEX IF NOT EXISTS idx_post_views_hourly_hour ON post_views_hourly(hour, post_id, views);
+CREATE INDEX IF NOT EXISTS idx_post_views_daily_day ON post_views_daily(day, post_id, views);
+
+-- Full-text search index over posts (kept in sync by the app, see search.py)
+CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(
+    title, excerpt, content,
+    tokenize = 'porter unicode61 remove_diacritics 2',
+    prefix = '2 3'
+);
 
 -- Insert default admin user (password: admin123)
 -- Note: This is a sample hash, the actual hash will be generated by Flask
@@ -0,0 +1,243 @@
+"""Database engine configuration, driven by the environment.
+
+``configure(app)`` fills in ``SQLALCHEMY_DATABASE_URI``,
+``SQLALCHEMY_ENGINE_OPTIONS`` and a bind per read replica, and must run before
+``SQLAlchemy(app, session_options={'class_': RoutingSession})``.
+``install(app, db)`` then adds a connect hook so every pooled SQLite
+connection gets the tuning PRAGMAs below, and the hooks that keep a client
+on the primary after it writes.
+
+SQLite defaults suit a single process. Under gunicorn, a rollback journal
+lets one writer block every reader, and a second writer fails at once with
+``database is locked``. The profile here uses WAL, so readers never wait
+for the writer. Writers queue for up to ``busy_timeout`` instead of failing.
+``synchronous=NORMAL`` is durable in WAL mode except against power loss
+within the last checkpoint, and it avoids an fsync on every commit.
+
+PostgreSQL (or any server database) gets a LIFO pool with pre-ping and
+recycling, and psycopg2 connections carry a connect timeout and a
+server-side ``statement_timeout``.
+
+Read replicas: views marked ``@read_only`` run their queries on a randomly
+chosen replica. Flushes, every other view and work outside a request use the
+primary. Once a client commits a write, its session cookie pins it to the
+primary for ``DB_REPLICA_STICKY_SECONDS``, so it reads its own writes despite
+replication lag. Any SQLAlchemy URL works as a replica. To try the routing
+locally without PostgreSQL, point DATABASE_REPLICA_URLS at a second SQLite
+file (or the same one). docker-compose.postgres.yml starts a primary and a
+streaming replica.
+
+Environment variables (all optional):
+
+    DATABASE_URL            SQLAlchemy URL (default sqlite:///blog.db, which
+                            Flask-SQLAlchemy places in the instance folder)
+    DATABASE_REPLICA_URLS   comma-separated replica URLs (default none)
+    DB_REPLICA_STICKY_SECONDS 15
+    SQLITE_JOURNAL_MODE     WAL
+    SQLITE_SYNCHRONOUS      NORMAL
+    SQLITE_BUSY_TIMEOUT     5000 (ms)
+    SQLITE_MMAP_SIZE        268435456 (bytes; 0 disables)
+    SQLITE_CACHE_SIZE       -65536 (negative = KiB, i.e. 64 MiB per connection)
+    SQLITE_FOREIGN_KEYS     ON
+    DB_POOL_SIZE            5
+    DB_MAX_OVERFLOW         10
+    DB_POOL_TIMEOUT         30 (s)
+    DB_POOL_RECYCLE         1800 (s; server databases only)
+    DB_CONNECT_TIMEOUT      10 (s; PostgreSQL only)
+    DB_STATEMENT_TIMEOUT    30000 (ms; PostgreSQL only, 0 disables)
+"""
+import os
+import random
+import time
+
+from flask import current_app, g, has_request_context, request, session as http_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+DEFAULT_URL = 'sqlite:///blog.db'
+REPLICA_PREFIX = 'replica_'
+STICKY_KEY = '_db_primary_until'
+
+# (config/environment key, pragma, default)
+SQLITE_PRAGMAS = (
+    ('SQLITE_JOURNAL_MODE', 'journal_mode', 'WAL'),
+    ('SQLITE_SYNCHRONOUS', 'synchronous', 'NORMAL'),
+    ('SQLITE_BUSY_TIMEOUT', 'busy_timeout', 5000),
+    ('SQLITE_MMAP_SIZE', 'mmap_size', 268435456),
+    ('SQLITE_CACHE_SIZE', 'cache_size', -65536),
+    ('SQLITE_FOREIGN_KEYS', 'foreign_keys', 'ON'),
+)
+
+POOL_SETTINGS = (
+    ('DB_POOL_SIZE', 'pool_size', 5),
+    ('DB_MAX_OVERFLOW', 'max_overflow', 10),
+    ('DB_POOL_TIMEOUT', 'pool_timeout', 30),
+)
+
+
+def normalize_url(url):
+    # Heroku and others still hand out the scheme SQLAlchemy dropped in 1.4
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def database_url(environ=None):
+    env = os.environ if environ is None else environ
+    return normalize_url(env.get('DATABASE_URL') or DEFAULT_URL)
+
+
+def replica_urls(environ=None):
+    env = os.environ if environ is None else environ
+    return [normalize_url(url.strip()) for url in env.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+
+
+def is_memory_sqlite(url):
+    url = make_url(url)
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def engine_options(url, environ=None):
+    """Pool settings for ``create_engine`` given the database URL."""
+    env = os.environ if environ is None else environ
+    if is_memory_sqlite(url):
+        return {}  # SQLAlchemy picks a single-connection pool for these
+    options = {option: int(env.get(key, default)) for key, option, default in POOL_SETTINGS}
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite':
+        # pysqlite's own lock wait, before the connect hook sets busy_timeout
+        options['connect_args'] = {'timeout': int(env.get('SQLITE_BUSY_TIMEOUT', 5000)) / 1000}
+        return options
+    # Check connections out before handing them over (servers drop idle
+    # ones), and reuse the most recent so surplus ones can age out.
+    options['pool_pre_ping'] = True
+    options['pool_recycle'] = int(env.get('DB_POOL_RECYCLE', 1800))
+    options['pool_use_lifo'] = True
+    if url.get_backend_name() == 'postgresql' and url.get_driver_name() == 'psycopg2':
+        connect_args = {'connect_timeout': int(env.get('DB_CONNECT_TIMEOUT', 10))}
+        statement_timeout = int(env.get('DB_STATEMENT_TIMEOUT', 30000))
+        if statement_timeout:
+            connect_args['options'] = f'-c statement_timeout={statement_timeout}'
+        options['connect_args'] = connect_args
+    return options
+
+
+def sqlite_pragmas(config):
+    """``[(pragma, value)]`` from app config, skipping any set to '' or None."""
+    pragmas = []
+    for key, pragma, _ in SQLITE_PRAGMAS:
+        value = config.get(key)
+        if value not in (None, ''):
+            pragmas.append((pragma, value))
+    return pragmas
+
+
+def apply_pragmas(dbapi_connection, pragmas):
+    """Run ``pragmas`` on a raw sqlite3 connection; returns the journal mode in effect."""
+    cursor = dbapi_connection.cursor()
+    journal_mode = None
+    try:
+        for pragma, value in pragmas:
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+            if pragma == 'journal_mode':
+                journal_mode = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    return journal_mode
+
+
+def configure(app, environ=None):
+    env = os.environ if environ is None else environ
+    url = database_url(env)
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    for key, _, default in SQLITE_PRAGMAS:
+        app.config.setdefault(key, env.get(key, default))
+    options = engine_options(url, env)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+    binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+    for i, replica in enumerate(replica_urls(env)):
+        binds[f'{REPLICA_PREFIX}{i}'] = {'url': replica, **engine_options(replica, env)}
+    app.config.setdefault('DB_REPLICA_STICKY_SECONDS', int(env.get('DB_REPLICA_STICKY_SECONDS', 15)))
+
+
+def install(app, db):
+    """Apply the SQLite PRAGMAs to every new connection of the app's engines
+    and, when replicas are configured, track writes for stickiness."""
+    pragmas = sqlite_pragmas(app.config)
+    wanted = dict(pragmas).get('journal_mode')
+    warned = []
+
+    def on_connect(dbapi_connection, connection_record):
+        mode = apply_pragmas(dbapi_connection, pragmas)
+        if wanted and mode and mode.lower() not in (str(wanted).lower(), 'memory') and not warned:
+            # e.g. WAL on a network filesystem
+            warned.append(mode)
+            app.logger.warning('SQLite journal_mode is %s, not %s', mode, wanted)
+
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', on_connect)
+        has_replicas = bool(_replicas(db))
+
+    if has_replicas:
+        event.listen(db.session, 'after_flush', _collect_write)
+        event.listen(db.session, 'after_commit', _committed)
+        event.listen(db.session, 'after_soft_rollback', _discard)
+
+
+# Read replica routing
+
+def read_only(view):
+    """Mark a view as safe to serve from a read replica."""
+    view.read_only = True
+    return view
+
+
+class RoutingSession(Session):
+    """Sends queries from ``@read_only`` views to a replica.
+
+    Flushes always go to the primary, and so does everything after this
+    session has written, so a request never reads around its own changes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and not self.info.get('db_wrote'):
+            replica = _replica_for_request(self._db)
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _replicas(db):
+    return [engine for key, engine in db.engines.items() if key and key.startswith(REPLICA_PREFIX)]
+
+
+def _replica_for_request(db):
+    if not has_request_context():
+        return None
+    if 'db_replica' not in g:
+        g.db_replica = None
+        view = current_app.view_functions.get(request.endpoint)
+        if getattr(view, 'read_only', False) and http_session.get(STICKY_KEY, 0) < time.time():
+            replicas = _replicas(db)
+            if replicas:
+                g.db_replica = random.choice(replicas)
+    return g.db_replica
+
+
+def _collect_write(session, flush_context):
+    session.info['db_wrote'] = True
+
+
+def _committed(session):
+    if session.info.pop('db_wrote', False) and has_request_context():
+        http_session[STICKY_KEY] = time.time() + current_app.config['DB_REPLICA_STICKY_SECONDS']
+        g.pop('db_replica', None)
+
+
+def _discard(session, previous_transaction):
+    session.info.pop('db_wrote', None)
@@ -0,0 +1,402 @@
+"""Sitemaps and RSS/Atom feeds, rendered ahead of time and served as files.
+
+Documents:
+
+* ``/sitemap.xml`` lists the public pages and every published post, with the
+  post's ``updated_at`` as ``<lastmod>``. Posts are sharded by id:
+  ``/sitemap-<n>.xml`` holds ids ``(n - 1) * FEEDS_SITEMAP_SHARD_SIZE + 1`` to
+  ``n * FEEDS_SITEMAP_SHARD_SIZE``, and shard 1 also lists the pages. While
+  every id fits in one shard, ``/sitemap.xml`` is that shard; past that it
+  becomes a sitemap index of the shards. The default shard size stays under
+  the protocol's limit of 50,000 URLs per file.
+* ``/feed.xml`` (RSS 2.0) and ``/atom.xml`` (Atom) carry the newest
+  ``FEEDS_ITEMS`` published posts. So do ``/category/<id>/feed.xml`` and
+  ``/tag/<id>/feed.xml``, each with an ``atom.xml`` twin.
+
+Each document is written to ``FEEDS_DIR`` along with a ``.gz`` copy, plus a
+``.br`` copy when the brotli module is installed. Requests are answered from
+those files with an ETag and Last-Modified, so polling readers and crawlers
+mostly get 304s. Every date inside a document comes from the posts, never
+from the clock. A re-render that produces the same bytes leaves the files
+alone, so the validators only change when the content does.
+
+A document is rendered on its first request. After that, a background
+thread re-renders only the documents affected by a commit. A commit that
+changes any of a post's columns (which moves its ``updated_at``, the
+``<lastmod>`` and ``<updated>`` of every document listing it) or its tags
+affects its sitemap shard, the sitemap root, the site feeds, and the feeds of
+its old and new category and tags. Renaming a category or tag affects its
+feeds. Documents nobody has requested are never rendered.
+``flask feeds-build`` renders everything up front. ``--clear`` drops the
+existing files first, e.g. after data was loaded behind the ORM's back.
+
+Configuration (``app.config``):
+
+    FEEDS_DIR                  instance/feeds
+    FEEDS_BASE_URL             http://localhost:5000
+    FEEDS_TITLE                CoNexus
+    FEEDS_ITEMS                20
+    FEEDS_SITEMAP_SHARD_SIZE   45000
+"""
+import glob
+import gzip
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from urllib.parse import urlsplit
+from xml.sax.saxutils import escape, quoteattr
+
+import click
+from flask import abort, request, send_from_directory, url_for
+from sqlalchemy import event, func, inspect, select
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+FORMATS = ('rss', 'atom')
+MIMETYPES = {'sitemap': 'application/xml', 'rss': 'application/rss+xml', 'atom': 'application/atom+xml'}
+# Endpoints listed in the sitemap besides the posts
+PAGES = ('home', 'blog', 'about', 'contact')
+EPOCH = datetime(1970, 1, 1)
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+ATOM_NS = 'http://www.w3.org/2005/Atom'
+
+
+def w3c_datetime(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def rfc822_datetime(value):
+    return format_datetime(value.replace(tzinfo=timezone.utc), usegmt=True)
+
+
+class Feeds:
+    def __init__(self, app=None, db=None, post=None, category=None, tag=None, post_tags=None):
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._dirty = set()
+        if app is not None:
+            self.init_app(app, db, post, category, tag, post_tags)
+
+    def init_app(self, app, db, post, category, tag, post_tags):
+        app.config.setdefault('FEEDS_DIR', os.path.join(app.instance_path, 'feeds'))
+        app.config.setdefault('FEEDS_BASE_URL', 'http://localhost:5000')
+        app.config.setdefault('FEEDS_TITLE', 'CoNexus')
+        app.config.setdefault('FEEDS_ITEMS', 20)
+        app.config.setdefault('FEEDS_SITEMAP_SHARD_SIZE', 45000)
+        self.app = app
+        self.db = db
+        self.post = post
+        self.category = category
+        self.tag = tag
+        self.post_tags = post_tags
+        app.extensions['feeds'] = self
+        event.listen(db.session, 'after_flush', self._collect)
+        event.listen(db.session, 'after_commit', self._apply)
+        event.listen(db.session, 'after_soft_rollback', self._discard)
+
+        app.add_url_rule('/sitemap.xml', 'sitemap', self.sitemap)
+        app.add_url_rule('/sitemap-<int:shard>.xml', 'sitemap', self.sitemap)
+        for format, filename in zip(FORMATS, ('feed.xml', 'atom.xml')):
+            app.add_url_rule(f'/{filename}', 'feed', self.feed, defaults={'format': format})
+            app.add_url_rule(f'/category/<int:category_id>/{filename}', 'category_feed', self.feed,
+                             defaults={'format': format})
+            app.add_url_rule(f'/tag/<int:tag_id>/{filename}', 'tag_feed', self.feed, defaults={'format': format})
+
+        @app.cli.command('feeds-build')
+        @click.option('--clear', is_flag=True, help='Delete every rendered document first.')
+        def build_command(clear):
+            """Render the sitemap and every feed."""
+            if clear:
+                self.clear()
+            count = self.build()
+            click.echo(f'Rendered {count} documents into {self.directory}.')
+
+    @property
+    def directory(self):
+        return self.app.config['FEEDS_DIR']
+
+    # Views
+
+    def sitemap(self, shard=None):
+        return self.send('sitemap' if shard is None else f'sitemap-{shard}')
+
+    def feed(self, format, category_id=None, tag_id=None):
+        if category_id is not None:
+            return self.send(f'category-{category_id}.{format}')
+        if tag_id is not None:
+            return self.send(f'tag-{tag_id}.{format}')
+        return self.send(f'site.{format}')
+
+    def send(self, name):
+        """Serve document ``name``, rendering it first if it has never been requested."""
+        filename = f'{name}.xml'
+        if not os.path.isfile(os.path.join(self.directory, filename)) and not self.render([name]):
+            abort(404)
+        mimetype = MIMETYPES[name.rpartition('.')[2] if '.' in name else 'sitemap']
+        for encoding, ext in ENCODINGS:
+            if request.accept_encodings[encoding] and os.path.isfile(os.path.join(self.directory, filename + ext)):
+                response = send_from_directory(self.directory, filename + ext, mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(self.directory, filename, mimetype=mimetype)
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+        return response
+
+    # Rendering
+
+    def render(self, names):
+        """Render and store ``names``; returns how many exist (the rest are removed)."""
+        rendered = 0
+        with self.app.test_request_context(base_url=self.app.config['FEEDS_BASE_URL']):
+            with self.db.engine.connect() as conn:
+                for name in names:
+                    rendered += self._store(name, self._document(conn, name))
+        return rendered
+
+    def refresh(self, keys):
+        """Re-render the documents of ``keys`` that have been rendered before."""
+        names = [name for key in keys for name in _documents(key)
+                 if os.path.isfile(os.path.join(self.directory, f'{name}.xml'))]
+        return self.render(names)
+
+    def build(self):
+        """Render every document; returns the number rendered."""
+        with self.app.app_context(), self.db.engine.connect() as conn:
+            shards = self._shard_count(conn)
+            categories = conn.execute(select(self.category.id)).scalars().all()
+            tags = conn.execute(select(self.tag.id)).scalars().all()
+        keys = ['sitemap', 'site', *(f'sitemap-{n}' for n in range(1, shards + 1)),
+                *(f'category-{i}' for i in categories), *(f'tag-{i}' for i in tags)]
+        return self.render([name for key in keys for name in _documents(key)])
+
+    def clear(self):
+        for path in glob.glob(os.path.join(self.directory, '*.xml*')):
+            os.remove(path)
+
+    def _document(self, conn, name):
+        if name == 'sitemap':
+            return self._sitemap(conn)
+        if name.startswith('sitemap-'):
+            return self._sitemap(conn, int(name[len('sitemap-'):]))
+        scope, format = name.split('.')
+        return self._feed(conn, scope, format)
+
+    def _store(self, name, data):
+        path = os.path.join(self.directory, f'{name}.xml')
+        if data is None:
+            for stale in (path, *(path + ext for _, ext in ENCODINGS)):
+                if os.path.exists(stale):
+                    os.remove(stale)
+            return False
+        try:
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    return True
+        except FileNotFoundError:
+            os.makedirs(self.directory, exist_ok=True)
+        # The plain file goes last: its presence is what marks the document as rendered
+        _replace(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            _replace(path + '.br', brotli.compress(data, quality=9))
+        _replace(path, data)
+        return True
+
+    def _shard_count(self, conn):
+        last = conn.execute(select(func.max(self.post.id))).scalar() or 0
+        return -(-last // self.app.config['FEEDS_SITEMAP_SHARD_SIZE'])
+
+    def _sitemap(self, conn, shard=None):
+        Post = self.post
+        size = self.app.config['FEEDS_SITEMAP_SHARD_SIZE']
+        shards = self._shard_count(conn)
+        if shard is None and shards > 1:
+            return self._sitemap_index(conn)
+        if shard is not None and not 1 <= shard <= max(shards, 1):
+            return None
+        query = select(Post.slug, Post.updated_at, Post.created_at).where(Post.is_published == True)  # noqa: E712
+        if shard is not None:
+            query = query.where(Post.id > (shard - 1) * size, Post.id <= shard * size)
+        parts = [XML_DECLARATION, f'<urlset xmlns="{SITEMAP_NS}">\n']
+        if shard in (None, 1):
+            parts += [f'<url><loc>{escape(url_for(page, _external=True))}</loc></url>\n' for page in PAGES]
+        for slug, updated_at, created_at in conn.execution_options(yield_per=1000).execute(query.order_by(Post.id)):
+            parts.append(f'<url><loc>{escape(url_for("post", slug=slug, _external=True))}</loc>'
+                         f'<lastmod>{w3c_datetime(updated_at or created_at or EPOCH)}</lastmod></url>\n')
+        parts.append('</urlset>\n')
+        return ''.join(parts).encode()
+
+    def _sitemap_index(self, conn):
+        Post = self.post
+        shard = ((Post.id - 1) // self.app.config['FEEDS_SITEMAP_SHARD_SIZE'] + 1).label('shard')
+        rows = conn.execute(select(shard, func.max(Post.updated_at)).where(Post.is_published == True)  # noqa: E712
+                            .group_by(shard).order_by(shard))
+        parts = [XML_DECLARATION, f'<sitemapindex xmlns="{SITEMAP_NS}">\n']
+        for n, updated_at in rows:
+            lastmod = f'<lastmod>{w3c_datetime(updated_at)}</lastmod>' if updated_at else ''
+            parts.append(f'<sitemap><loc>{escape(url_for("sitemap", shard=n, _external=True))}</loc>{lastmod}</sitemap>\n')
+        parts.append('</sitemapindex>\n')
+        return ''.join(parts).encode()
+
+    def _feed(self, conn, scope, format):
+        Post = self.post
+        kind, _, term_id = scope.partition('-')
+        title = self.app.config['FEEDS_TITLE']
+        query = select(Post.id, Post.title, Post.slug, Post.summary, Post.created_at, Post.updated_at).where(
+            Post.is_published == True)  # noqa: E712
+        if kind == 'category':
+            name = conn.execute(select(self.category.name).where(self.category.id == int(term_id))).scalar()
+            if name is None:
+                return None
+            title = f'{title}: {name}'
+            link = url_for('blog', category=term_id, _external=True)
+            self_link = url_for('category_feed', category_id=term_id, format=format, _external=True)
+            query = query.where(Post.category_id == int(term_id))
+        elif kind == 'tag':
+            name = conn.execute(select(self.tag.name).where(self.tag.id == int(term_id))).scalar()
+            if name is None:
+                return None
+            title = f'{title}: #{name}'
+            link = url_for('blog', tag=term_id, _external=True)
+            self_link = url_for('tag_feed', tag_id=term_id, format=format, _external=True)
+            query = query.join(self.post_tags, self.post_tags.c.post_id == Post.id).where(
+                self.post_tags.c.tag_id == int(term_id))
+        else:
+            link = url_for('blog', _external=True)
+            self_link = url_for('feed', format=format, _external=True)
+        posts = conn.execute(query.order_by(Post.created_at.desc(), Post.id.desc())
+                             .limit(self.app.config['FEEDS_ITEMS'])).all()
+        render = _rss if format == 'rss' else _atom
+        return render(title, link, self_link, posts).encode()
+
+    # Incremental updates, applied only once the change is committed
+
+    def _collect(self, session, flush_context):
+        Post = self.post
+        keys, unloaded = set(), set()
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, Post):
+                state = inspect(obj)
+                if obj in session.dirty and not _changed(state):
+                    continue
+                keys.update(('sitemap', self._shard_key(obj.id), 'site'))
+                keys.update(f'category-{cid}' for cid in {obj.category_id, *state.attrs.category_id.history.deleted}
+                            if cid is not None)
+                keys.update(f'tag-{tag.id}' for tag in state.attrs.tags.history.sum())
+                if 'tags' not in state.dict and obj not in session.deleted:
+                    unloaded.add(obj.id)
+            elif isinstance(obj, self.category):
+                keys.add(f'category-{obj.id}')
+            elif isinstance(obj, self.tag):
+                keys.add(f'tag-{obj.id}')
+        if unloaded:
+            # Posts whose tags weren't loaded still appear in those tags' feeds
+            tags = self.post_tags
+            keys.update(f'tag-{tag_id}' for tag_id in session.connection().execute(
+                select(tags.c.tag_id).where(tags.c.post_id.in_(unloaded)).distinct()).scalars())
+        if keys:
+            session.info.setdefault('feeds_changed', set()).update(keys)
+
+    def _shard_key(self, post_id):
+        return f'sitemap-{(post_id - 1) // self.app.config["FEEDS_SITEMAP_SHARD_SIZE"] + 1}'
+
+    def _apply(self, session):
+        keys = session.info.pop('feeds_changed', None)
+        if not keys:
+            return
+        with self._lock:
+            scheduled = bool(self._dirty)
+            self._dirty.update(keys)
+        # Commits that land while a refresh is queued share it
+        if not scheduled:
+            self._pool().submit(self._refresh)
+
+    def _refresh(self):
+        with self._lock:
+            keys, self._dirty = self._dirty, set()
+        try:
+            self.refresh(keys)
+        except Exception:
+            # Rendered files stay as they were; the next change or feeds-build catches up
+            self.app.logger.exception('Failed to refresh feeds for %s', sorted(keys))
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(1, thread_name_prefix='feeds')
+                self._pid = os.getpid()
+            return self._executor
+
+    def _discard(self, session, previous_transaction):
+        session.info.pop('feeds_changed', None)
+
+
+def _changed(state):
+    # Any column change makes the UPDATE bump updated_at (onupdate); tags are a separate table
+    columns = (attr.key for attr in state.mapper.column_attrs)
+    return any(state.attrs[key].history.has_changes() for key in (*columns, 'tags'))
+
+
+def _documents(key):
+    """File names rendered for a dirty key: sitemaps are one document, feeds two."""
+    if key.startswith('sitemap'):
+        return [key]
+    return [f'{key}.{format}' for format in FORMATS]
+
+
+def _replace(path, data):
+    # Write-then-rename, so other workers never serve a half-written file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.feeds-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _entry_id(post):
+    # Stays the same if the post's slug changes
+    host = urlsplit(url_for('home', _external=True)).hostname
+    return f'tag:{host},{post.created_at or EPOCH:%Y-%m-%d}:post-{post.id}'
+
+
+def _rss(title, link, self_link, posts):
+    updated = max((p.updated_at or p.created_at or EPOCH for p in posts), default=EPOCH)
+    parts = [XML_DECLARATION, f'<rss version="2.0" xmlns:atom="{ATOM_NS}"><channel>\n',
+             f'<title>{escape(title)}</title><link>{escape(link)}</link>'
+             f'<description>{escape(title)}</description>\n'
+             f'<atom:link href={quoteattr(self_link)} rel="self" type="application/rss+xml"/>\n'
+             f'<lastBuildDate>{rfc822_datetime(updated)}</lastBuildDate>\n']
+    for post in posts:
+        parts.append(f'<item><title>{escape(post.title)}</title>'
+                     f'<link>{escape(url_for("post", slug=post.slug, _external=True))}</link>'
+                     f'<guid isPermaLink="false">{escape(_entry_id(post))}</guid>'
+                     f'<pubDate>{rfc822_datetime(post.created_at or EPOCH)}</pubDate>'
+                     f'<description>{escape(post.summary or "")}</description></item>\n')
+    parts.append('</channel></rss>\n')
+    return ''.join(parts)
+
+
+def _atom(title, link, self_link, posts):
+    updated = max((p.updated_at or p.created_at or EPOCH for p in posts), default=EPOCH)
+    parts = [XML_DECLARATION, f'<feed xmlns="{ATOM_NS}">\n',
+             f'<title>{escape(title)}</title><id>{escape(self_link)}</id>'
+             f'<link href={quoteattr(link)}/><link href={quoteattr(self_link)} rel="self"/>'
+             f'<updated>{w3c_datetime(updated)}</updated><author><name>{escape(title)}</name></author>\n']
+    for post in posts:
+        parts.append(f'<entry><title>{escape(post.title)}</title><id>{escape(_entry_id(post))}</id>'
+                     f'<link href={quoteattr(url_for("post", slug=post.slug, _external=True))}/>'
+                     f'<published>{w3c_datetime(post.created_at or EPOCH)}</published>'
+                     f'<updated>{w3c_datetime(post.updated_at or post.created_at or EPOCH)}</updated>'
+                     f'<summary>{escape(post.summary or "")}</summary></entry>\n')
+    parts.append('</feed>\n')
+    return ''.join(parts)
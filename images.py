@@ -0,0 +1,390 @@
+"""Background processing of featured images into responsive variants.
+
+A request only streams the upload into storage (see storage.py) and
+records its key. Work is queued once the transaction commits. A worker pool
+decodes each new image, applies the EXIF orientation, and stores
+re-encoded variants at several widths: AVIF when a plugin provides it, then
+WebP, then JPEG. Re-encoding drops EXIF/XMP metadata, including camera and
+GPS data. The ICC profile is kept so colours don't shift.
+
+When the variants are ready, the worker points ``featured_image`` at the
+largest JPEG and stores the srcset data in ``featured_image_variants``.
+Until then, pages show the original. ``responsive_image()`` renders a
+``<picture>`` for either state. Storage counts the references held in both
+columns, so the original, and any image a post no longer uses, is deleted
+by ``flask storage-gc`` once nothing else refers to it.
+
+Posts from before storage existed point at ``uploads/...`` under
+``static/``. Those files are still served from there, and are deleted by
+the session hooks once a commit replaces the image or deletes the post.
+``flask images-import`` moves them into storage. ``flask images-rebuild``
+processes images that were never processed, such as jobs lost when a worker
+died.
+"""
+import contextlib
+import io
+import json
+import os
+import shutil
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import click
+from flask import flash, url_for
+from markupsafe import Markup, escape
+from PIL import Image, ImageOps, UnidentifiedImageError
+from sqlalchemy import event, inspect, select, update
+
+try:  # AVIF support for Pillow < 11 comes from a plugin
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+FORMATS = {
+    # name: (Pillow format, file extension, MIME type)
+    'avif': ('AVIF', 'avif', 'image/avif'),
+    'webp': ('WEBP', 'webp', 'image/webp'),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg'),
+}
+
+# Pillow format: extension uploads are stored with
+ACCEPTED_FORMATS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif', 'WEBP': '.webp', 'BMP': '.bmp', 'TIFF': '.tiff',
+                    'MPO': '.jpg', 'AVIF': '.avif'}
+
+
+def describe_formats(formats):
+    """``'JPEG, PNG or GIF'`` for ``formats``, naming each stored extension once."""
+    names, extensions = [], set()
+    for name, ext in formats.items():
+        if ext not in extensions:  # MPO is the multi-picture JPEG some cameras write
+            names.append(name)
+            extensions.add(ext)
+    return ', '.join(names[:-1]) + ' or ' + names[-1] if len(names) > 1 else names[0]
+
+
+def available_formats(names):
+    Image.init()
+    return tuple(name for name in names if FORMATS[name][0] in Image.SAVE)
+
+
+class ImagePipeline:
+    def __init__(self, app=None, db=None, model=None, storage=None, on_ready=None):
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, db, model, storage, on_ready)
+
+    def init_app(self, app, db, model, storage, on_ready=None):
+        """``on_ready(post_ids)`` is called after a worker updates posts, e.g. to purge caches."""
+        app.config.setdefault('IMAGE_WIDTHS', (320, 640, 960, 1280, 1920))
+        app.config.setdefault('IMAGE_FORMATS', ('avif', 'webp', 'jpeg'))
+        app.config.setdefault('IMAGE_QUALITY', {'avif': 55, 'webp': 80, 'jpeg': 82})
+        app.config.setdefault('IMAGE_WORKERS', 2)
+        self.app = app
+        self.db = db
+        self.model = model
+        self.storage = storage
+        self.on_ready = on_ready
+        self.formats = available_formats(app.config['IMAGE_FORMATS'])
+        app.extensions['image_pipeline'] = self
+        app.add_template_global(self.responsive_image, 'responsive_image')
+        app.add_template_global(self.url, 'image_url')
+        storage.track(model, ('featured_image', 'featured_image_variants'), image_keys)
+        event.listen(db.session, 'after_flush', self._collect)
+        event.listen(db.session, 'after_commit', self._committed)
+        event.listen(db.session, 'after_soft_rollback', self._discard)
+
+        @app.cli.command('images-rebuild')
+        def images_rebuild_command():
+            """Generate variants for featured images that don't have them yet."""
+            count = self.rebuild()
+            click.echo(f'Processed {count} images.')
+
+        @app.cli.command('images-import')
+        def images_import_command():
+            """Move featured images from static/uploads into storage."""
+            count = self.import_legacy()
+            click.echo(f'Imported the images of {count} posts.')
+
+    # Request side
+
+    def save_upload(self, file):
+        """Store an uploaded image and return its storage key.
+
+        Returns None when no file was sent, or when the file isn't an image
+        Pillow can read. In that case an error is flashed.
+        """
+        if not file or not file.filename:
+            return None
+        try:
+            with Image.open(file.stream) as image:  # reads the header only
+                kind = image.format
+        except Image.DecompressionBombError:
+            flash('Featured image has too many pixels.', 'error')
+            return None
+        except (UnidentifiedImageError, OSError):
+            kind = None
+        if kind not in ACCEPTED_FORMATS:
+            flash(f'Featured image must be a {describe_formats(ACCEPTED_FORMATS)} image.', 'error')
+            return None
+        file.stream.seek(0)
+        # Written in the request's transaction, which the post's row joins next
+        return self.storage.save(file.stream, ACCEPTED_FORMATS[kind], session=self.db.session)
+
+    def url(self, path):
+        """URL of a stored image, or of a pre-storage ``uploads/...`` file."""
+        if _is_legacy(path):
+            return url_for('static', filename=path)
+        return self.storage.url(path)
+
+    def responsive_image(self, post, sizes='100vw', **attrs):
+        """``<picture>`` markup for ``post.featured_image``.
+
+        Falls back to a plain ``<img>`` of the original while its variants
+        are still being generated. Extra keyword arguments become ``<img>``
+        attributes; ``loading`` defaults to lazy.
+        """
+        attrs.setdefault('alt', post.title)
+        attrs.setdefault('loading', 'lazy')
+        attrs.setdefault('decoding', 'async')
+        variants = _parse_variants(post.featured_image_variants)
+        if variants is None:
+            return Markup('<img src="%s"%s>') % (self.url(post.featured_image), _attributes(attrs))
+
+        def srcset(name):
+            return ', '.join(f"{self.url(path)} {width}w" for path, width in variants['sources'][name])
+
+        sources = ''.join(
+            Markup('<source type="%s" srcset="%s" sizes="%s">') % (FORMATS[name][2], srcset(name), sizes)
+            for name in variants['sources'] if name != 'jpeg')
+        img = Markup('<img src="%s" srcset="%s" sizes="%s" width="%d" height="%d"%s>') % (
+            self.url(post.featured_image), srcset('jpeg'), sizes,
+            variants['width'], variants['height'], _attributes(attrs))
+        return Markup('<picture>') + Markup(sources) + img + Markup('</picture>')
+
+    # Worker side
+
+    def submit(self, path):
+        self._pool().submit(self._run, path)
+
+    def process(self, path):
+        """Store the variants of the image at ``path``; returns the variants record."""
+        quality = self.app.config['IMAGE_QUALITY']
+        with self._source(path) as source, Image.open(source) as image:
+            image.seek(0)  # first frame of animations
+            image = ImageOps.exif_transpose(image)
+            icc_profile = image.info.get('icc_profile')
+            has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+            image = image.convert('RGBA' if has_alpha else 'RGB')
+            widths = [w for w in self.app.config['IMAGE_WIDTHS'] if w < image.width]
+            widths.append(min(image.width, max(self.app.config['IMAGE_WIDTHS'])))
+            sources = {name: [] for name in self.formats}
+            for width in sorted(set(widths)):
+                size = (width, round(image.height * width / image.width))
+                resized = image if width == image.width else image.resize(size, Image.LANCZOS)
+                resized_flat = _flatten(resized) if has_alpha else resized
+                for name in self.formats:
+                    pil_format, extension, _ = FORMATS[name]
+                    options = {'quality': quality.get(name, 80)}
+                    if icc_profile:
+                        options['icc_profile'] = icc_profile
+                    if name == 'jpeg':
+                        options.update(optimize=True, progressive=True)
+                    elif name == 'webp':
+                        options['method'] = 6
+                    output = resized_flat if name == 'jpeg' else resized
+                    buffer = io.BytesIO()
+                    output.save(buffer, pil_format, **options)
+                    buffer.seek(0)
+                    sources[name].append((self.storage.save(buffer, f'.{extension}'), width))
+            largest = sources['jpeg'][-1][1]
+            return {'width': largest, 'height': round(image.height * largest / image.width), 'sources': sources}
+
+    def rebuild(self):
+        """Process every featured image without variants, in this process."""
+        Post = self.model
+        with self.app.app_context():
+            paths = self.db.session.execute(
+                select(Post.featured_image).distinct()
+                .where(Post.featured_image.isnot(None), Post.featured_image_variants.is_(None))).scalars().all()
+        for path in paths:
+            self._run(path)
+        return len(paths)
+
+    def import_legacy(self):
+        """Move every ``uploads/...`` original and variant into storage; returns the number of posts."""
+        Post = self.model
+        static = self.app.static_folder
+        stored = {}
+
+        def store(path):
+            if path not in stored:
+                with open(os.path.join(static, path), 'rb') as f:
+                    stored[path] = self.storage.save(f, os.path.splitext(path)[1])
+            return stored[path]
+
+        count = 0
+        with self.app.app_context():
+            with self.db.engine.connect() as conn:
+                rows = conn.execute(select(Post.id, Post.featured_image, Post.featured_image_variants)
+                                    .where(Post.featured_image.like('uploads/%'))).all()
+            for post_id, path, variants in rows:
+                parsed = _parse_variants(variants)
+                try:
+                    image = store(path)
+                    if parsed is not None:
+                        variants = json.dumps({**parsed, 'sources': {
+                            name: [(store(source), width) for source, width in sources]
+                            for name, sources in parsed['sources'].items()}})
+                except FileNotFoundError:
+                    self.app.logger.warning('Featured image %s of post %d is missing', path, post_id)
+                    continue
+                with self.db.engine.begin() as conn:
+                    if not conn.execute(update(Post).where(Post.id == post_id, Post.featured_image == path)
+                                        .values(featured_image=image, featured_image_variants=variants)).rowcount:
+                        continue
+                    self.storage.adjust(conn, Counter(image_keys(image, variants)))
+                self.remove(path)
+                count += 1
+        return count
+
+    def remove(self, path):
+        """Delete a pre-storage image's original upload and its variants."""
+        static = self.app.static_folder
+        directory = os.path.join(static, _variant_dir(path))
+        shutil.rmtree(directory, ignore_errors=True)
+        original = os.path.join(static, path)
+        if os.path.dirname(original) != directory:
+            try:
+                os.remove(original)
+            except FileNotFoundError:
+                pass
+
+    def _run(self, path):
+        Post = self.model
+        with self.app.app_context():
+            try:
+                variants = self.process(path)
+            except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+                self.app.logger.exception('Could not process featured image %s', path)
+                return
+            image, record = variants['sources']['jpeg'][-1][0], json.dumps(variants)
+            post_ids = []
+            with self.db.engine.begin() as conn:
+                rows = conn.execute(select(Post.id, Post.featured_image_variants)
+                                    .where(Post.featured_image == path)).all()
+                # Core updates bypass the session hooks that keep reference counts
+                references = Counter()
+                for post_id, previous in rows:
+                    # Re-checked under the write lock: another run for the same
+                    # path may have updated the post since the select
+                    if conn.execute(update(Post).where(Post.id == post_id, Post.featured_image == path).values(
+                            featured_image=image, featured_image_variants=record)).rowcount:
+                        references.subtract(image_keys(path, previous))
+                        references.update(image_keys(image, record))
+                        post_ids.append(post_id)
+                self.storage.adjust(conn, references)
+            if post_ids and self.on_ready is not None:
+                self.on_ready(post_ids)
+            # Either the original has been superseded by its variants, or the
+            # post moved on to another image (or was deleted) meanwhile.
+            # Stored files are left to storage-gc.
+            if _is_legacy(path):
+                if post_ids:
+                    os.remove(os.path.join(self.app.static_folder, path))
+                else:
+                    self.remove(path)
+
+    @contextlib.contextmanager
+    def _source(self, path):
+        if _is_legacy(path):
+            yield os.path.join(self.app.static_folder, path)
+        else:
+            with self.storage.local_copy(path) as local:
+                yield local
+
+    def _pool(self):
+        # Worker threads don't survive a fork, so each process gets its own pool
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(self.app.config['IMAGE_WORKERS'], thread_name_prefix='images')
+                self._pid = os.getpid()
+            return self._executor
+
+    # Change tracking
+
+    def _collect(self, session, flush_context):
+        Post = self.model
+        added = session.info.setdefault('images_added', set())
+        removed = session.info.setdefault('images_removed', set())
+        for obj in session.new:
+            if isinstance(obj, Post) and obj.featured_image:
+                added.add(obj.featured_image)
+        for obj in session.deleted:
+            if isinstance(obj, Post) and obj.featured_image:
+                removed.add(obj.featured_image)
+        for obj in session.dirty:
+            if not isinstance(obj, Post):
+                continue
+            # _run updates posts through Core, so only uploads show up here
+            history = inspect(obj).attrs.featured_image.history
+            if history.has_changes():
+                removed.update(path for path in history.deleted if path)
+                added.update(path for path in history.added if path)
+
+    def _committed(self, session):
+        added = session.info.pop('images_added', None) or set()
+        removed = session.info.pop('images_removed', None) or set()
+        for path in removed - added:
+            if _is_legacy(path):
+                self._pool().submit(self.remove, path)
+        for path in added - removed:
+            self.submit(path)
+
+    def _discard(self, session, previous_transaction):
+        session.info.pop('images_added', None)
+        session.info.pop('images_removed', None)
+
+
+def image_keys(path, variants):
+    """The files a post's ``featured_image`` and ``featured_image_variants`` refer to."""
+    keys = {path} if path else set()
+    parsed = _parse_variants(variants)
+    if parsed is not None:
+        keys.update(source for sources in parsed['sources'].values() for source, _ in sources)
+    return keys
+
+
+def _is_legacy(path):
+    return path.startswith('uploads/')
+
+
+def _variant_dir(path):
+    """``uploads/<hex>_name.jpg`` and ``uploads/<hex>/960.jpg`` both map to ``uploads/<hex>``."""
+    head, name = os.path.split(path)
+    if os.path.basename(head) != 'uploads':
+        return head
+    return f"{head}/{name.split('_', 1)[0].split('.', 1)[0]}"
+
+
+def _flatten(image):
+    background = Image.new('RGB', image.size, (255, 255, 255))
+    background.paste(image, mask=image.getchannel('A'))
+    return background
+
+
+@lru_cache(maxsize=1024)
+def _parse_variants(value):
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        return None
+
+
+def _attributes(attrs):
+    return Markup(''.join(f' {escape(name)}="{escape(value)}"' for name, value in attrs.items() if value is not None))
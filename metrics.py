@@ -0,0 +1,300 @@
+"""Per-request timing: SQL, template rendering and total latency.
+
+Every request records three numbers: how many SQL statements it ran and
+how long they took (SQLAlchemy cursor events), how long ``render_template``
+took (Flask's template signals), and its total latency. They are reported
+three ways:
+
+* A ``Server-Timing`` response header (``app``, ``db``, ``render``), so
+  browser dev tools show the split for any page.
+* ``/metrics`` in Prometheus text format: a latency histogram and request
+  counter per endpoint, plus per-endpoint totals for SQL statements, SQL
+  seconds and render seconds. Divide those totals by the request count to
+  get averages per request. The endpoint answers loopback clients only, or
+  any client presenting ``METRICS_TOKEN`` as a bearer token.
+* An opt-in slow-query log. Each statement slower than ``SLOW_QUERY_MS``
+  is logged with its parameters, the endpoint, and the database's
+  ``EXPLAIN`` for it.
+
+Recording costs two ``perf_counter()`` calls per statement and one short
+lock per request, cheap enough to leave on in production. Metrics live in
+each process. With ``METRICS_DIR`` set, each gunicorn worker writes a
+snapshot there at most every ``METRICS_FLUSH_SECONDS``, and ``/metrics``
+adds up the snapshots of every worker on the host. Counters from a worker
+that has exited drop out after ``METRICS_STALE_SECONDS``, which Prometheus
+treats as a counter reset.
+
+Configuration (``app.config``):
+
+    METRICS_ENABLED          True
+    METRICS_SERVER_TIMING    True
+    METRICS_TOKEN            None (then /metrics answers loopback only)
+    METRICS_DIR              None (per-process metrics only)
+    METRICS_FLUSH_SECONDS    10
+    METRICS_STALE_SECONDS    600
+    SLOW_QUERY_MS            None (slow-query log off)
+"""
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import Response, abort, g, has_request_context, request, template_rendered, before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOPBACK = ('127.0.0.1', '::1')
+EXPLAIN = {'sqlite': 'EXPLAIN QUERY PLAN ', 'postgresql': 'EXPLAIN ', 'mysql': 'EXPLAIN '}
+
+
+class Registry:
+    """Counters and histograms keyed by label tuples, safe across threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = defaultdict(int)                                   # (endpoint, method, status)
+            self.latency = defaultdict(lambda: [0] * (len(BUCKETS) + 1) + [0.0])  # (endpoint, method)
+            self.sql_queries = defaultdict(int)                                # endpoint
+            self.sql_seconds = defaultdict(float)
+            self.render_seconds = defaultdict(float)
+            self.slow_queries = defaultdict(int)
+
+    def observe(self, endpoint, method, status, seconds, queries, sql_seconds, render_seconds):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            histogram = self.latency[(endpoint, method)]
+            histogram[bisect_left(BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+            self.sql_queries[endpoint] += queries
+            self.sql_seconds[endpoint] += sql_seconds
+            self.render_seconds[endpoint] += render_seconds
+
+    def slow_query(self, endpoint):
+        with self._lock:
+            self.slow_queries[endpoint] += 1
+
+    def snapshot(self):
+        """Plain lists, JSON-serializable, for merging across processes."""
+        with self._lock:
+            return {
+                'requests': [[*key, value] for key, value in self.requests.items()],
+                'latency': [[*key, list(value)] for key, value in self.latency.items()],
+                'sql_queries': list(self.sql_queries.items()),
+                'sql_seconds': list(self.sql_seconds.items()),
+                'render_seconds': list(self.render_seconds.items()),
+                'slow_queries': list(self.slow_queries.items()),
+            }
+
+
+def merge(snapshots):
+    total = {'requests': defaultdict(int), 'latency': {}, 'sql_queries': defaultdict(int),
+             'sql_seconds': defaultdict(float), 'render_seconds': defaultdict(float), 'slow_queries': defaultdict(int)}
+    for snapshot in snapshots:
+        for endpoint, method, status, value in snapshot['requests']:
+            total['requests'][(endpoint, method, status)] += value
+        for endpoint, method, values in snapshot['latency']:
+            current = total['latency'].setdefault((endpoint, method), [0] * len(values))
+            total['latency'][(endpoint, method)] = [a + b for a, b in zip(current, values)]
+        for name in ('sql_queries', 'sql_seconds', 'render_seconds', 'slow_queries'):
+            for endpoint, value in snapshot[name]:
+                total[name][endpoint] += value
+    return total
+
+
+def render_prometheus(total):
+    lines = []
+
+    def family(name, kind, help_text):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    family('flask_requests_total', 'counter', 'Requests by endpoint, method and status.')
+    for (endpoint, method, status), value in sorted(total['requests'].items()):
+        lines.append(f'flask_requests_total{_labels(endpoint=endpoint, method=method, status=status)} {value}')
+
+    family('flask_request_duration_seconds', 'histogram', 'Request latency by endpoint and method.')
+    for (endpoint, method), values in sorted(total['latency'].items()):
+        cumulative = 0
+        for bound, count in zip((*BUCKETS, '+Inf'), values[:-1]):
+            cumulative += count
+            lines.append(f'flask_request_duration_seconds_bucket'
+                         f'{_labels(endpoint=endpoint, method=method, le=bound)} {cumulative}')
+        lines.append(f'flask_request_duration_seconds_sum{_labels(endpoint=endpoint, method=method)} {values[-1]:.6f}')
+        lines.append(f'flask_request_duration_seconds_count{_labels(endpoint=endpoint, method=method)} {cumulative}')
+
+    for name, help_text in (('sql_queries', 'SQL statements issued while handling requests.'),
+                            ('sql_seconds', 'Time spent executing SQL while handling requests.'),
+                            ('render_seconds', 'Time spent rendering templates while handling requests.'),
+                            ('slow_queries', 'Statements slower than SLOW_QUERY_MS.')):
+        metric = f'flask_request_{name}_total'
+        family(metric, 'counter', help_text)
+        for endpoint, value in sorted(total[name].items()):
+            lines.append(f'{metric}{_labels(endpoint=endpoint)} {value:.6f}' if isinstance(value, float)
+                         else f'{metric}{_labels(endpoint=endpoint)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(**labels):
+    escaped = (f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for key, value in labels.items())
+    return '{' + ','.join(escaped) + '}'
+
+
+class Instrumentation:
+    def __init__(self, app=None, db=None):
+        self.registry = Registry()
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_SERVER_TIMING', True)
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.config.setdefault('METRICS_DIR', None)
+        app.config.setdefault('METRICS_FLUSH_SECONDS', 10)
+        app.config.setdefault('METRICS_STALE_SECONDS', 600)
+        app.config.setdefault('SLOW_QUERY_MS', None)
+        self.app = app
+        self.db = db
+        self.slow_log = logging.getLogger(f'{app.logger.name}.slow_query')
+        self._flushed = 0
+        app.extensions['instrumentation'] = self
+        if not app.config['METRICS_ENABLED']:
+            return
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    # Request timing
+
+    def query_count(self):
+        """SQL statements the current request has run so far, or None when it isn't being timed."""
+        state = g.get('metrics') if has_request_context() else None
+        return None if state is None else state['queries']
+
+    def _start(self):
+        g.metrics = {'start': time.perf_counter(), 'queries': 0, 'sql': 0.0, 'render': 0.0, 'rendering': []}
+
+    def _finish(self, response):
+        state = g.pop('metrics', None)
+        if state is None:
+            return response
+        elapsed = time.perf_counter() - state['start']
+        endpoint = request.endpoint or 'unmatched'
+        if endpoint != 'metrics':
+            self.registry.observe(endpoint, request.method, response.status_code, elapsed,
+                                  state['queries'], state['sql'], state['render'])
+        if self.app.config['METRICS_SERVER_TIMING']:
+            response.headers.add('Server-Timing', ', '.join((
+                f'app;dur={elapsed * 1000:.1f}',
+                f'db;dur={state["sql"] * 1000:.1f};desc="{state["queries"]} queries"',
+                f'render;dur={state["render"] * 1000:.1f}',
+            )))
+        self._maybe_flush()
+        return response
+
+    def _before_render(self, app, template, context, **extra):
+        state = g.get('metrics')
+        if state is not None:
+            state['rendering'].append(time.perf_counter())
+
+    def _after_render(self, app, template, context, **extra):
+        state = g.get('metrics')
+        if state is not None and state['rendering']:
+            started = state['rendering'].pop()
+            # Only the outermost render counts; nested renders are inside it
+            if not state['rendering']:
+                state['render'] += time.perf_counter() - started
+
+    # SQL timing
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get('metrics_started')
+        if not started:
+            return
+        elapsed = time.perf_counter() - started.pop()
+        if has_request_context():
+            state = g.get('metrics')
+            if state is not None:
+                state['queries'] += 1
+                state['sql'] += elapsed
+        threshold = self.app.config['SLOW_QUERY_MS']
+        if threshold is not None and elapsed * 1000 >= threshold:
+            self._log_slow(conn, cursor, statement, parameters, executemany, elapsed)
+
+    def _log_slow(self, conn, cursor, statement, parameters, executemany, elapsed):
+        endpoint = request.endpoint if has_request_context() else None
+        self.registry.slow_query(endpoint or 'none')
+        plan = ''
+        prefix = EXPLAIN.get(conn.dialect.name)
+        if prefix and not executemany and statement.lstrip().upper().startswith('SELECT'):
+            try:
+                # A raw DBAPI cursor, so the EXPLAIN itself doesn't fire these events
+                explain = conn.connection.dbapi_connection.cursor()
+                try:
+                    explain.execute(prefix + statement, parameters)
+                    plan = '\n'.join('    ' + ' | '.join(str(col) for col in row) for row in explain.fetchall())
+                finally:
+                    explain.close()
+            except Exception as error:  # the plan is a nicety; never fail the query over it
+                plan = f'    (EXPLAIN failed: {error})'
+        self.slow_log.warning('Slow query (%.1f ms, endpoint %s): %s\n    parameters: %r\n%s',
+                              elapsed * 1000, endpoint, ' '.join(statement.split()), parameters, plan)
+
+    # Exposition
+
+    def metrics_view(self):
+        token = self.app.config['METRICS_TOKEN']
+        if token:
+            if request.headers.get('Authorization') != f'Bearer {token}':
+                abort(403)
+        elif request.remote_addr not in LOOPBACK:
+            abort(403)
+        return Response(render_prometheus(merge(self._snapshots())), mimetype='text/plain; version=0.0.4')
+
+    def _snapshots(self):
+        own = self.registry.snapshot()
+        directory = self.app.config['METRICS_DIR']
+        if not directory:
+            return [own]
+        self._flush(own)
+        snapshots = []
+        cutoff = time.time() - self.app.config['METRICS_STALE_SECONDS']
+        for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    continue
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # a worker is replacing it, or it just went away
+        return snapshots
+
+    def _maybe_flush(self):
+        if self.app.config['METRICS_DIR'] and time.monotonic() - self._flushed >= self.app.config['METRICS_FLUSH_SECONDS']:
+            self._flush(self.registry.snapshot())
+
+    def _flush(self, snapshot):
+        directory = self.app.config['METRICS_DIR']
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'metrics-{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(path + '.tmp', path)
+        self._flushed = time.monotonic()
@@ -0,0 +1,302 @@
+"""Versioned schema migrations and query-plan checks.
+
+The models in ``app.py`` are the single source of truth for the schema,
+including indexes. ``db.create_all()`` builds a fresh database from them, but
+it never alters an existing one. Each migration here brings an existing
+database up to the models one step at a time, and the applied versions are
+recorded in ``schema_migrations``. Every step is idempotent, so running them
+against a database that ``create_all()`` just built is harmless.
+
+    flask db-upgrade        apply pending migrations
+    flask db-status         show applied and pending migrations
+    flask db-check-plans    EXPLAIN every query the main routes run and fail
+                            on full scans or sorts of the large tables
+"""
+import sys
+from datetime import datetime
+
+import click
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, event, inspect, select, text, update
+
+import comments
+import content
+
+_meta = MetaData()
+schema_migrations = Table(
+    'schema_migrations', _meta,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+
+# Helpers for migration steps
+
+def create_indexes(conn, metadata, table, *names):
+    """Create indexes declared on the models if they don't exist yet.
+
+    Names the models no longer declare are skipped: a later migration drops
+    them, so migrations never need editing once they have shipped.
+    """
+    declared = {index.name: index for index in metadata.tables[table].indexes}
+    for name in names:
+        if name in declared:
+            declared[name].create(conn, checkfirst=True)
+
+
+def drop_indexes(conn, *names):
+    for name in names:
+        conn.execute(text(f'DROP INDEX IF EXISTS {name}'))
+
+
+def add_columns(conn, metadata, table, *names):
+    """Add model columns missing from an existing table.
+
+    NOT NULL is kept for columns with a server default, which fills the
+    existing rows, so the result matches what ``create_all()`` builds.
+    """
+    existing = {column['name'] for column in inspect(conn).get_columns(table)}
+    ddl_compiler = conn.dialect.ddl_compiler(conn.dialect, None)
+    for name in names:
+        if name in existing:
+            continue
+        column = metadata.tables[table].c[name]
+        ddl = column.type.compile(conn.dialect)
+        default = ddl_compiler.get_column_default_string(column)
+        clause = f' DEFAULT {default}' if default is not None else ''
+        if default is not None and not column.nullable:
+            clause += ' NOT NULL'
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {name} {ddl}{clause}'))
+
+
+# Migrations
+
+@migration(1, 'Composite indexes matched to route queries')
+def _query_indexes(conn, metadata):
+    create_indexes(conn, metadata, 'post',
+                   'idx_post_published_created', 'idx_post_category_published_created',
+                   'idx_post_featured_created', 'idx_post_user_created', 'idx_post_created')
+    create_indexes(conn, metadata, 'comment',
+                   'idx_comment_post_approved', 'idx_comment_created', 'idx_comment_user')
+    create_indexes(conn, metadata, 'post_tags', 'idx_post_tags_tag')
+    # Single-column indexes from create_database.py that the composites
+    # above make redundant (or that duplicate a UNIQUE/PRIMARY KEY index).
+    drop_indexes(conn, 'idx_post_user_id', 'idx_post_category_id', 'idx_post_slug',
+                 'idx_post_published', 'idx_post_featured', 'idx_post_created_at',
+                 'idx_comment_post_id', 'idx_comment_user_id', 'idx_comment_approved',
+                 'idx_post_tags_post_id', 'idx_post_tags_tag_id')
+
+
+@migration(2, 'Responsive variants for featured images')
+def _image_variants(conn, metadata):
+    add_columns(conn, metadata, 'post', 'featured_image_variants')
+
+
+@migration(3, 'Rendered post bodies and derived text fields')
+def _rendered_content(conn, metadata):
+    add_columns(conn, metadata, 'post', 'content_html', 'toc', 'summary', 'word_count', 'reading_time')
+    post = metadata.tables['post']
+    rows = conn.execute(select(post.c.id, post.c.content, post.c.excerpt)
+                        .where(post.c.content_html.is_(None))).all()
+    for post_id, source, excerpt in rows:
+        conn.execute(update(post).where(post.c.id == post_id).values(**content.process(source, excerpt)))
+
+
+@migration(4, 'Approved and pending comment counters on posts')
+def _comment_counters(conn, metadata):
+    add_columns(conn, metadata, 'post', 'approved_comment_count', 'pending_comment_count')
+    post = metadata.tables['post']
+    conn.execute(update(post).values(**comments.counter_values(post, metadata.tables['comment'])))
+
+
+@migration(5, 'Moderation queue indexes by status, post and author')
+def _moderation_indexes(conn, metadata):
+    create_indexes(conn, metadata, 'comment',
+                   'idx_comment_approved_created', 'idx_comment_post_created', 'idx_comment_user_created')
+    # Migration 1 created this; idx_comment_user_created starts with the same column
+    drop_indexes(conn, 'idx_comment_user')
+
+
+@migration(6, 'Room for scrypt and argon2 password hashes')
+def _password_hash_length(conn, metadata):
+    # SQLite doesn't enforce VARCHAR lengths
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('ALTER TABLE "user" ALTER COLUMN password_hash TYPE VARCHAR(255)'))
+
+
+@migration(7, 'Newsletter unsubscribes and delivery queue')
+def _newsletter_delivery(conn, metadata):
+    add_columns(conn, metadata, 'newsletter', 'unsubscribed_at')
+    metadata.tables['newsletter_issue'].create(conn, checkfirst=True)
+    # Signup now stores lower-cased addresses; fold existing ones unless that would collide
+    conn.execute(text('UPDATE newsletter SET email = lower(trim(email)) WHERE email != lower(trim(email)) '
+                      'AND NOT EXISTS (SELECT 1 FROM newsletter other WHERE other.email = lower(trim(newsletter.email)))'))
+
+
+@migration(8, 'Precomputed related posts and decayed popularity')
+def _recommendations(conn, metadata):
+    add_columns(conn, metadata, 'post', 'popularity')
+    # Start from all-time views; the first refreshes decay them into a recent ranking
+    conn.execute(text('UPDATE post SET popularity = COALESCE(views, 0)'))
+    create_indexes(conn, metadata, 'post', 'idx_post_published_popularity')
+    metadata.tables['post_related'].create(conn, checkfirst=True)
+
+
+@migration(9, 'Content-addressed upload storage')
+def _stored_files(conn, metadata):
+    # Existing uploads stay under static/uploads until `flask images-import`
+    metadata.tables['stored_file'].create(conn, checkfirst=True)
+
+
+@migration(10, 'Rolled-up page views and dashboard totals')
+def _analytics(conn, metadata):
+    # Totals are counted from the tables the first time the dashboard asks for them
+    for name in ('analytics_event', 'post_views_hourly', 'post_views_daily', 'site_views_daily', 'analytics_counter'):
+        metadata.tables[name].create(conn, checkfirst=True)
+
+
+@migration(11, 'Slug history for redirects from renamed posts')
+def _slug_history(conn, metadata):
+    metadata.tables['slug_history'].create(conn, checkfirst=True)
+
+
+class Migrator:
+    def __init__(self, app=None, db=None):
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+        app.extensions['migrator'] = self
+
+        @app.cli.command('db-upgrade')
+        def upgrade_command():
+            """Apply pending schema migrations."""
+            applied = self.upgrade()
+            for version, description in applied:
+                click.echo(f'Applied {version}: {description}')
+            if not applied:
+                click.echo('Database is up to date.')
+
+        @app.cli.command('db-status')
+        def status_command():
+            """List schema migrations and whether they are applied."""
+            applied = self.applied_versions()
+            for version, description, _ in MIGRATIONS:
+                click.echo(f"[{'x' if version in applied else ' '}] {version}: {description}")
+
+        @app.cli.command('db-check-plans')
+        def check_plans_command():
+            """EXPLAIN the queries behind the main routes and report scans and sorts."""
+            problems = self.check_query_plans()
+            for endpoint, statement, detail in problems:
+                click.echo(f'{endpoint}: {detail}\n    {statement}')
+            if problems:
+                sys.exit(1)
+            click.echo('All route queries use indexes.')
+
+    def applied_versions(self):
+        with self.db.engine.begin() as conn:
+            schema_migrations.create(conn, checkfirst=True)
+            return {row.version for row in conn.execute(schema_migrations.select())}
+
+    def upgrade(self):
+        """Apply pending migrations in order, each in its own transaction."""
+        applied = []
+        done = self.applied_versions()
+        for version, description, fn in MIGRATIONS:
+            if version in done:
+                continue
+            with self.db.engine.begin() as conn:
+                fn(conn, self.db.metadata)
+                conn.execute(schema_migrations.insert().values(
+                    version=version, description=description, applied_at=datetime.utcnow()))
+            applied.append((version, description))
+        return applied
+
+    # Query plan regression check
+
+    # Tables that grow with content; anything else (categories, tags, users
+    # looked up by key) is small or always hit by primary key.
+    LARGE_TABLES = ('post', 'comment', 'post_tags', 'post_related', 'post_views_hourly', 'post_views_daily')
+
+    def check_query_plans(self, paths=None, user_id=None):
+        """Run the main routes and EXPLAIN every SELECT they issue.
+
+        Returns ``(endpoint, statement, plan detail)`` for each full scan of a
+        large table and each ORDER BY that needs a temporary sort. Ranked
+        search results are exempt from the sort check since BM25 order can't
+        come from an index.
+        """
+        app, db = self.app, self.db
+        captured = []
+        with app.app_context():
+            if db.engine.dialect.name != 'sqlite':
+                raise click.UsageError('db-check-plans reads SQLite query plans; point DATABASE_URL at SQLite')
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT') and not executemany:
+                captured.append((statement, parameters))
+
+        with app.app_context():
+            if paths is None:
+                paths, default_user = self._default_paths()
+                user_id = user_id or default_user
+            engine = db.engine
+            problems = []
+            client = app.test_client()
+            if user_id is not None:
+                with client.session_transaction() as session:
+                    session['_user_id'] = str(user_id)
+                    session['_fresh'] = True
+            for path in paths:
+                captured.clear()
+                event.listen(engine, 'before_cursor_execute', capture)
+                try:
+                    client.get(path)
+                finally:
+                    event.remove(engine, 'before_cursor_execute', capture)
+                with engine.connect() as conn:
+                    for statement, parameters in list(captured):
+                        plan = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+                        for row in plan:
+                            detail = row[-1]
+                            if _is_problem(detail, statement, self.LARGE_TABLES):
+                                problems.append((path, ' '.join(statement.split()), detail))
+        return problems
+
+    def _default_paths(self):
+        db = self.db
+        one = lambda sql: db.session.execute(text(sql)).scalar()  # noqa: E731
+        slug = one('SELECT slug FROM post WHERE is_published = 1 LIMIT 1') or 'missing'
+        category = one('SELECT id FROM category LIMIT 1') or 1
+        tag = one('SELECT id FROM tag LIMIT 1') or 1
+        admin = one('SELECT id FROM "user" WHERE is_admin = 1 LIMIT 1')
+        commented = one('SELECT post_id FROM comment LIMIT 1') or 1
+        paths = ['/', '/blog', f'/blog?category={category}', f'/blog?tag={tag}', '/blog?search=test',
+                 f'/post/{slug}', '/dashboard', '/admin', '/admin/posts', '/admin/comments',
+                 '/admin/comments?status=pending', f'/admin/comments?post={commented}',
+                 f'/admin/comments?user={admin or 1}&status=approved', '/api/v1/posts',
+                 f'/api/v1/posts?category={category}', f'/api/v1/posts?tag={tag}', f'/api/v1/posts/{slug}',
+                 f'/api/v1/posts/{commented}/comments']
+        return paths, admin
+
+
+def _is_problem(detail, statement, tables):
+    if 'TEMP B-TREE' in detail and 'ORDER BY' in detail:
+        return 'post_fts' not in statement and 'GROUP BY' not in statement
+    words = detail.split()
+    if len(words) >= 2 and words[0] == 'SCAN' and words[1] in tables:
+        return 'INDEX' not in detail
+    return False
@@ -0,0 +1,394 @@
+"""Newsletter signups, bulk import/export and batched delivery.
+
+Signup is a single ``INSERT ... ON CONFLICT`` on the normalized address.
+Concurrent signups for one email can't both insert, and neither fails with
+an IntegrityError. Signing up again after unsubscribing resubscribes.
+
+    flask newsletter-import FILE.csv    add addresses in batched transactions;
+                                        rows that are invalid or already present
+                                        are skipped
+    flask newsletter-export [FILE]      stream subscribers as CSV (also
+                                        /admin/newsletter/export.csv)
+    flask newsletter-queue SUBJECT FILE queue an issue written in Markdown
+    flask newsletter-send [--watch]     deliver queued issues
+
+Import and export walk the table in primary-key order, a batch at a time,
+so memory use doesn't grow with the list. Export uses a fresh keyset query
+per batch, so no read transaction stays open while the response streams.
+
+Delivery: queueing an issue renders its HTML and text bodies once and
+stores them on the issue. Only the unsubscribe link differs between
+recipients, and it is substituted as each message is built. The sender
+takes active subscribers in ``id`` order, ``NEWSLETTER_BATCH_SIZE`` at a
+time, over one SMTP connection per batch. It stores the issue's cursor
+(``last_subscriber_id``) after each batch and paces itself to
+``NEWSLETTER_RATE`` messages a second. A sender that is stopped resumes
+from the last committed batch, so at most one batch is sent twice. Run a
+single sender process.
+
+Backends (``NEWSLETTER_BACKEND``): ``smtp`` (``NEWSLETTER_SMTP_*``),
+``console`` (prints messages), ``memory`` (keeps them in ``outbox``, for
+tests), or a ``module:Class`` path. For a local SMTP stand-in run
+``python -m aiosmtpd -n -l localhost:8025`` and set
+``NEWSLETTER_SMTP_PORT = 8025``.
+"""
+import csv
+import importlib
+import io
+import smtplib
+import sys
+import time
+from datetime import datetime
+from email.message import EmailMessage
+from email.utils import formataddr, make_msgid
+
+import click
+from email_validator import EmailNotValidError, validate_email
+from flask import render_template, url_for
+from itsdangerous import BadSignature, URLSafeSerializer
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+import content
+
+EXPORT_COLUMNS = ('email', 'subscribed_at')
+UNSUBSCRIBE_PLACEHOLDER = '__UNSUBSCRIBE_TOKEN__'
+
+
+def normalize_email(value):
+    """The canonical, lower-cased form of ``value``, or None if it isn't an email address."""
+    try:
+        return validate_email((value or '').strip(), check_deliverability=False).normalized.lower()
+    except EmailNotValidError:
+        return None
+
+
+# Delivery backends: open(), send(message) -> bool, close()
+
+class SMTPBackend:
+    def __init__(self, host='localhost', port=25, username=None, password=None, use_tls=False, timeout=30):
+        self.host, self.port, self.timeout = host, port, timeout
+        self.username, self.password, self.use_tls = username, password, use_tls
+        self.connection = None
+
+    def open(self):
+        self.connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            self.connection.starttls()
+        if self.username:
+            self.connection.login(self.username, self.password)
+
+    def send(self, message):
+        try:
+            self.connection.send_message(message)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+            # This recipient failed; the connection is still usable
+            return False
+        return True
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except smtplib.SMTPException:
+                self.connection.close()
+            self.connection = None
+
+
+class ConsoleBackend:
+    def __init__(self, stream=None, **options):
+        self.stream = stream or sys.stdout
+
+    def open(self):
+        pass
+
+    def send(self, message):
+        self.stream.write(f"To: {message['To']}\nSubject: {message['Subject']}\n\n")
+        return True
+
+    def close(self):
+        pass
+
+
+class MemoryBackend:
+    outbox = []
+
+    def __init__(self, **options):
+        pass
+
+    def open(self):
+        pass
+
+    def send(self, message):
+        self.outbox.append(message)
+        return True
+
+    def close(self):
+        pass
+
+
+BACKENDS = {'smtp': SMTPBackend, 'console': ConsoleBackend, 'memory': MemoryBackend}
+
+
+class NewsletterEngine:
+    def __init__(self, app=None, db=None, subscriber=None, issue=None):
+        if app is not None:
+            self.init_app(app, db, subscriber, issue)
+
+    def init_app(self, app, db, subscriber, issue):
+        app.config.setdefault('NEWSLETTER_FROM', 'newsletter@localhost')
+        app.config.setdefault('NEWSLETTER_FROM_NAME', 'CoNexus')
+        app.config.setdefault('NEWSLETTER_BASE_URL', 'http://localhost:5000')
+        app.config.setdefault('NEWSLETTER_BACKEND', 'smtp')
+        app.config.setdefault('NEWSLETTER_SMTP_HOST', 'localhost')
+        app.config.setdefault('NEWSLETTER_SMTP_PORT', 25)
+        app.config.setdefault('NEWSLETTER_SMTP_USERNAME', None)
+        app.config.setdefault('NEWSLETTER_SMTP_PASSWORD', None)
+        app.config.setdefault('NEWSLETTER_SMTP_TLS', False)
+        app.config.setdefault('NEWSLETTER_BATCH_SIZE', 100)
+        app.config.setdefault('NEWSLETTER_RATE', 10)  # messages per second; 0 = unthrottled
+        app.config.setdefault('NEWSLETTER_IMPORT_BATCH', 1000)
+        self.app = app
+        self.db = db
+        self.subscriber = subscriber
+        self.issue = issue
+        app.extensions['newsletter'] = self
+
+        @app.cli.command('newsletter-import')
+        @click.argument('source', type=click.File('r', encoding='utf-8-sig'))
+        def import_command(source):
+            """Import subscribers from a CSV file with an "email" column (or emails in the first column)."""
+            added, skipped = self.import_csv(source)
+            click.echo(f'Added {added} subscribers, skipped {skipped} rows.')
+
+        @app.cli.command('newsletter-export')
+        @click.argument('target', type=click.File('w', encoding='utf-8'), default='-')
+        def export_command(target):
+            """Write active subscribers as CSV to FILE (default stdout)."""
+            for chunk in self.export_csv():
+                target.write(chunk)
+
+        @app.cli.command('newsletter-queue')
+        @click.argument('subject')
+        @click.argument('source', type=click.File('r', encoding='utf-8'))
+        def queue_command(subject, source):
+            """Render a Markdown issue once and queue it for every active subscriber."""
+            issue = self.queue(subject, source.read())
+            click.echo(f'Queued issue {issue.id}: {issue.subject}')
+
+        @app.cli.command('newsletter-send')
+        @click.option('--watch', is_flag=True, help='Keep running and poll for new issues.')
+        @click.option('--interval', default=30, show_default=True, help='Seconds between polls with --watch.')
+        def send_command(watch, interval):
+            """Deliver queued issues in throttled batches."""
+            while True:
+                for issue_id, sent, failed in self.deliver_pending():
+                    click.echo(f'Issue {issue_id}: sent {sent}, failed {failed}.')
+                if not watch:
+                    break
+                time.sleep(interval)
+
+    # Signup
+
+    def subscribe(self, email):
+        """Add or reactivate ``email``; returns 'subscribed', 'exists' or 'invalid'."""
+        email = normalize_email(email)
+        if email is None:
+            return 'invalid'
+        table = self.subscriber.__table__
+        statement = (self._insert(table).values(email=email, subscribed_at=datetime.utcnow())
+                     .on_conflict_do_update(index_elements=[table.c.email],
+                                            set_={'unsubscribed_at': None, 'subscribed_at': datetime.utcnow()},
+                                            where=table.c.unsubscribed_at.isnot(None))
+                     .returning(table.c.id))
+        changed = self.db.session.execute(statement).first() is not None
+        self.db.session.commit()
+        return 'subscribed' if changed else 'exists'
+
+    def unsubscribe(self, token):
+        """Deactivate the subscriber a token was issued for; False if the token is invalid."""
+        try:
+            email = self._serializer().loads(token)
+        except BadSignature:
+            return False
+        table = self.subscriber.__table__
+        self.db.session.execute(update(table).where(table.c.email == email, table.c.unsubscribed_at.is_(None))
+                                .values(unsubscribed_at=datetime.utcnow()))
+        self.db.session.commit()
+        return True
+
+    def unsubscribe_token(self, email):
+        return self._serializer().dumps(email)
+
+    def _unsubscribe_url(self):
+        # Rendered once with a placeholder that each message swaps for its own token
+        return url_for('newsletter_unsubscribe', token=UNSUBSCRIBE_PLACEHOLDER, _external=True)
+
+    def _serializer(self):
+        return URLSafeSerializer(self.app.config['SECRET_KEY'], salt='newsletter-unsubscribe')
+
+    def _insert(self, table):
+        dialect = self.db.session.get_bind().dialect.name
+        return (postgresql if dialect == 'postgresql' else sqlite).insert(table)
+
+    # Import and export
+
+    def import_csv(self, source):
+        """Add the addresses in a CSV stream, one transaction per batch; returns ``(added, skipped)``."""
+        table = self.subscriber.__table__
+        session = self.db.session
+        size = self.app.config['NEWSLETTER_IMPORT_BATCH']
+        statement = self._insert(table).on_conflict_do_nothing(index_elements=[table.c.email])
+        before = session.execute(select(func.count()).select_from(table)).scalar()
+        rows = 0
+        batch = {}
+        now = datetime.utcnow()
+        for record in _email_column(csv.reader(source)):
+            rows += 1
+            email = normalize_email(record)
+            if email is not None:
+                batch[email] = {'email': email, 'subscribed_at': now}
+            if len(batch) >= size:
+                session.execute(statement, list(batch.values()))
+                session.commit()
+                batch.clear()
+        if batch:
+            session.execute(statement, list(batch.values()))
+            session.commit()
+        added = session.execute(select(func.count()).select_from(table)).scalar() - before
+        return added, rows - added
+
+    def export_csv(self, batch_size=1000):
+        """Yield the active subscribers as CSV text, one batch of rows per chunk."""
+        table = self.subscriber.__table__
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        yield buffer.getvalue()
+        last_id = 0
+        while True:
+            with self.app.app_context():
+                rows = self.db.session.execute(
+                    select(table.c.id, table.c.email, table.c.subscribed_at)
+                    .where(table.c.id > last_id, table.c.unsubscribed_at.is_(None))
+                    .order_by(table.c.id).limit(batch_size)).all()
+            if not rows:
+                return
+            buffer.seek(0)
+            buffer.truncate()
+            for _, email, subscribed_at in rows:
+                writer.writerow((email, subscribed_at.isoformat(sep=' ') if subscribed_at else ''))
+            last_id = rows[-1][0]
+            yield buffer.getvalue()
+
+    # Delivery
+
+    def queue(self, subject, source):
+        """Render an issue once and queue it for delivery."""
+        rendered = content.process(source)
+        issue = self.issue(subject=subject, body=source, status='queued', queued_at=datetime.utcnow())
+        with self.app.test_request_context(base_url=self.app.config['NEWSLETTER_BASE_URL']):
+            context = {'subject': subject, 'body_html': rendered['content_html'],
+                       # Markdown reads fine as it is, so the text part is the source
+                       'body_text': source.strip(), 'unsubscribe_url': self._unsubscribe_url()}
+            issue.html = render_template('email/newsletter.html', **context)
+            issue.text = render_template('email/newsletter.txt', **context)
+        self.db.session.add(issue)
+        self.db.session.commit()
+        return issue
+
+    def deliver_pending(self):
+        """Send every queued issue, oldest first; yields ``(issue_id, sent, failed)`` as each finishes."""
+        Issue = self.issue
+        with self.app.app_context():
+            pending = self.db.session.execute(select(Issue.id).where(Issue.status.in_(('queued', 'sending')))
+                                              .order_by(Issue.queued_at, Issue.id)).scalars().all()
+        for issue_id in pending:
+            yield (issue_id, *self.deliver(issue_id))
+
+    def deliver(self, issue_id):
+        """Send one issue to the subscribers it hasn't reached yet; returns ``(sent, failed)``."""
+        config = self.app.config
+        table = self.subscriber.__table__
+        session = self.db.session
+        backend = self.backend()
+        sent = failed = 0
+        with self.app.test_request_context(base_url=config['NEWSLETTER_BASE_URL']):
+            unsubscribe_url = self._unsubscribe_url()
+        with self.app.app_context():
+            issue = session.get(self.issue, issue_id)
+            if issue.status == 'queued':
+                issue.status = 'sending'
+                session.commit()
+            while True:
+                recipients = session.execute(
+                    select(table.c.id, table.c.email)
+                    .where(table.c.id > issue.last_subscriber_id, table.c.unsubscribed_at.is_(None))
+                    .order_by(table.c.id).limit(config['NEWSLETTER_BATCH_SIZE'])).all()
+                if not recipients:
+                    break
+                started = time.monotonic()
+                batch_sent = batch_failed = 0
+                backend.open()
+                try:
+                    for _, email in recipients:
+                        if backend.send(self.message(issue, email, unsubscribe_url)):
+                            batch_sent += 1
+                        else:
+                            batch_failed += 1
+                finally:
+                    backend.close()
+                issue.last_subscriber_id = recipients[-1][0]
+                issue.sent_count += batch_sent
+                issue.failed_count += batch_failed
+                session.commit()
+                sent, failed = sent + batch_sent, failed + batch_failed
+                if config['NEWSLETTER_RATE']:
+                    time.sleep(max(0, len(recipients) / config['NEWSLETTER_RATE'] - (time.monotonic() - started)))
+            issue.status = 'sent'
+            issue.sent_at = datetime.utcnow()
+            session.commit()
+        return sent, failed
+
+    def message(self, issue, email, unsubscribe_url):
+        """The issue addressed to ``email``; ``unsubscribe_url`` has the token placeholder in it."""
+        config = self.app.config
+        token = self.unsubscribe_token(email)
+        message = EmailMessage()
+        message['Subject'] = issue.subject
+        message['From'] = formataddr((config['NEWSLETTER_FROM_NAME'], config['NEWSLETTER_FROM']))
+        message['To'] = email
+        message['Message-ID'] = make_msgid(domain=config['NEWSLETTER_FROM'].rpartition('@')[2] or None)
+        message['List-Unsubscribe'] = f'<{unsubscribe_url.replace(UNSUBSCRIBE_PLACEHOLDER, token)}>'
+        message['List-Unsubscribe-Post'] = 'List-Unsubscribe=One-Click'
+        message.set_content(issue.text.replace(UNSUBSCRIBE_PLACEHOLDER, token))
+        message.add_alternative(issue.html.replace(UNSUBSCRIBE_PLACEHOLDER, token), subtype='html')
+        return message
+
+    def backend(self):
+        config = self.app.config
+        name = config['NEWSLETTER_BACKEND']
+        if name in BACKENDS:
+            cls = BACKENDS[name]
+        else:
+            module, _, attr = name.partition(':')
+            cls = getattr(importlib.import_module(module), attr)
+        return cls(host=config['NEWSLETTER_SMTP_HOST'], port=config['NEWSLETTER_SMTP_PORT'],
+                   username=config['NEWSLETTER_SMTP_USERNAME'], password=config['NEWSLETTER_SMTP_PASSWORD'],
+                   use_tls=config['NEWSLETTER_SMTP_TLS'])
+
+
+def _email_column(reader):
+    """Values of the "email" column, or of the first column when there is no header."""
+    first = next(reader, None)
+    if first is None:
+        return
+    header = [cell.strip().lower() for cell in first]
+    if 'email' in header:
+        index = header.index('email')
+    else:
+        index = 0
+        yield first[0] if first else ''
+    for row in reader:
+        if len(row) > index:
+            yield row[index]
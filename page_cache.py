@@ -0,0 +1,288 @@
+"""Rendered-page cache for anonymous GET requests.
+
+Views opt in with ``@page_cache.cached(...)``. A cached entry stores the
+rendered body together with the *generation* of every dependency tag the page
+declared (``'posts'``, ``'post:12'``, ``'category:3'``...). Writes never touch
+cached pages directly: a session hook works out which tags a commit affected
+and bumps their generations, and any entry recorded against an older
+generation is treated as a miss. Tags are bumped only after the transaction
+commits, so a concurrent request can't re-cache the old content.
+
+Two backends are provided:
+
+* ``SQLiteBackend`` (the default) -- a small WAL-mode SQLite file on local
+  disk, shared by every gunicorn worker on the host.
+* ``MemoryBackend`` -- per-process LRU with TTL. Fast, but invalidations only
+  reach the worker that made the write, so use it with a single worker.
+
+Responses carry an ETag and Last-Modified derived from the posts' ``updated_at``
+and the dependency generations, so revalidating clients get 304s.
+
+Configuration (``app.config``):
+
+    PAGE_CACHE_BACKEND       'sqlite', 'memory' or None (no caching)
+    PAGE_CACHE_TTL           300
+    PAGE_CACHE_MAX_ENTRIES   512
+    PAGE_CACHE_PATH          instance/page_cache.db
+"""
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import g, make_response, request, session
+from flask_login import current_user
+from sqlalchemy import event
+
+
+class MemoryBackend:
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def generations(self, tags):
+        with self._lock:
+            return {tag: self._generations.get(tag, 0) for tag in tags}
+
+    def bump(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+
+
+class SQLiteBackend:
+    def __init__(self, path, max_entries=5000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._conn()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS entry (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL);
+            CREATE TABLE IF NOT EXISTS generation (tag TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        """)
+
+    def _conn(self):
+        # One connection per thread (and per forked worker, since the
+        # threading.local is keyed to the thread that created it).
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute('SELECT value, expires FROM entry WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        conn = self._conn()
+        conn.execute('INSERT OR REPLACE INTO entry (key, value, expires) VALUES (?, ?, ?)',
+                     (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expires))
+        if hash(key) % 64 == 0:
+            self._prune(conn)
+
+    def _prune(self, conn):
+        conn.execute('DELETE FROM entry WHERE expires < ?', (time.time(),))
+        conn.execute('DELETE FROM entry WHERE key IN (SELECT key FROM entry ORDER BY expires DESC LIMIT -1 OFFSET ?)',
+                     (self.max_entries,))
+
+    def delete(self, key):
+        self._conn().execute('DELETE FROM entry WHERE key = ?', (key,))
+
+    def clear(self):
+        self._conn().execute('DELETE FROM entry')
+
+    def generations(self, tags):
+        tags = list(tags)
+        if not tags:
+            return {}
+        placeholders = ', '.join('?' * len(tags))
+        found = dict(self._conn().execute(
+            f'SELECT tag, value FROM generation WHERE tag IN ({placeholders})', tags).fetchall())
+        return {tag: found.get(tag, 0) for tag in tags}
+
+    def bump(self, tags):
+        self._conn().executemany(
+            'INSERT INTO generation (tag, value) VALUES (?, 1) '
+            'ON CONFLICT(tag) DO UPDATE SET value = value + 1', [(tag,) for tag in tags])
+
+
+class PageCache:
+    def __init__(self, app=None, db=None, tags_for=None):
+        self.backend = None
+        if app is not None:
+            self.init_app(app, db, tags_for)
+
+    def init_app(self, app, db, tags_for):
+        """``tags_for(obj)`` returns the dependency tags a flushed model object affects."""
+        app.config.setdefault('PAGE_CACHE_BACKEND', 'sqlite')
+        app.config.setdefault('PAGE_CACHE_TTL', 300)
+        app.config.setdefault('PAGE_CACHE_MAX_ENTRIES', 512)
+        app.config.setdefault('PAGE_CACHE_PATH', os.path.join(app.instance_path, 'page_cache.db'))
+        self.app = app
+        self.tags_for = tags_for
+        backend = app.config['PAGE_CACHE_BACKEND']
+        if backend == 'memory':
+            self.backend = MemoryBackend(app.config['PAGE_CACHE_MAX_ENTRIES'])
+        elif backend == 'sqlite':
+            self.backend = SQLiteBackend(app.config['PAGE_CACHE_PATH'], app.config['PAGE_CACHE_MAX_ENTRIES'])
+        elif backend:
+            raise ValueError(f'Unknown PAGE_CACHE_BACKEND {backend!r}')
+        app.extensions['page_cache'] = self
+        event.listen(db.session, 'after_flush', self._collect)
+        event.listen(db.session, 'after_commit', self._invalidate)
+        event.listen(db.session, 'after_soft_rollback', self._discard)
+
+    # View API
+
+    def cached(self, *tags, query_args=(), on_hit=None):
+        """Cache a view's response for anonymous visitors.
+
+        ``tags`` are dependencies known up front; views add more with
+        ``depends_on()``. Only ``query_args`` are part of the cache key. On a
+        hit, ``on_hit(meta)`` is called with whatever the view stored via
+        ``meta()``, for side effects such as counting views.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if not self._cacheable():
+                    return view(*args, **kwargs)
+                key = self._key(query_args)
+                entry = self.backend.get(key)
+                if entry is not None and self.backend.generations(entry['generations']) == entry['generations']:
+                    if on_hit is not None:
+                        on_hit(entry['meta'])
+                    return self._respond(entry, 'HIT')
+
+                g.page_cache = {'generations': self.backend.generations(tags), 'meta': {}, 'last_modified': None}
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or not self._cacheable():
+                    return response
+                state = g.page_cache
+                entry = {
+                    'body': response.get_data(),
+                    'mimetype': response.mimetype,
+                    'generations': state['generations'],
+                    'meta': state['meta'],
+                    'last_modified': state['last_modified'],
+                    'etag': _etag(key, state['generations'], state['last_modified']),
+                }
+                self.backend.set(key, entry, self.app.config['PAGE_CACHE_TTL'])
+                return self._respond(entry, 'MISS')
+            return wrapper
+        return decorator
+
+    def depends_on(self, *tags):
+        """Record extra dependency tags for the page being rendered.
+
+        Call it before loading the data the tags cover: the generations read
+        here are what a later commit must move past to invalidate the entry.
+        """
+        state = g.get('page_cache')
+        if state is not None:
+            state['generations'].update(self.backend.generations(tags))
+
+    def meta(self, **values):
+        """Store values that are handed to ``on_hit`` when the page is served from cache."""
+        state = g.get('page_cache')
+        if state is not None:
+            state['meta'].update(values)
+
+    def last_modified(self, *posts):
+        """Derive Last-Modified for the page from the posts it shows."""
+        state = g.get('page_cache')
+        stamps = [p.updated_at for p in posts if p is not None and p.updated_at]
+        if state is not None and stamps:
+            newest = max(stamps)
+            if state['last_modified'] is None or newest > state['last_modified']:
+                state['last_modified'] = newest
+
+    def invalidate(self, *tags):
+        if self.backend is not None and tags:
+            self.backend.bump(tags)
+
+    # Internals
+
+    def _cacheable(self):
+        return (self.backend is not None
+                and request.method == 'GET'
+                and '_flashes' not in session
+                and not current_user.is_authenticated)
+
+    def _key(self, query_args):
+        args = '&'.join(f'{name}={request.args.get(name, "")}' for name in query_args)
+        return f'page:{request.host}{request.path}?{args}'
+
+    def _respond(self, entry, status):
+        response = make_response(entry['body'])
+        response.mimetype = entry['mimetype']
+        response.set_etag(entry['etag'])
+        if entry['last_modified'] is not None:
+            response.last_modified = entry['last_modified']
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        response.headers['X-Cache'] = status
+        return response.make_conditional(request)
+
+    def _collect(self, session, flush_context):
+        if self.tags_for is None:
+            return
+        pending = session.info.setdefault('page_cache_tags', set())
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            pending.update(self.tags_for(obj))
+
+    def _invalidate(self, session):
+        tags = session.info.pop('page_cache_tags', None)
+        if tags:
+            self.invalidate(*tags)
+
+    def _discard(self, session, previous_transaction):
+        session.info.pop('page_cache_tags', None)
+
+
+def _etag(key, generations, last_modified):
+    parts = [key, repr(sorted(generations.items())), last_modified.isoformat() if last_modified else '']
+    return hashlib.sha1('|'.join(parts).encode()).hexdigest()
@@ -0,0 +1,150 @@
+"""Keyset (cursor) pagination and cached totals for listing pages.
+
+OFFSET pagination makes the database walk and discard every row before the
+requested page, and Flask-SQLAlchemy's ``paginate()`` adds a ``COUNT(*)`` over
+the whole filtered set on top. ``keyset_paginate`` instead remembers the sort
+key of the last row shown (the cursor) and asks for rows strictly after it,
+which an index on the sort columns answers in constant time however deep the
+page is.
+
+Cursors are opaque URL-safe strings. A malformed or tampered cursor is
+treated as "first page" rather than an error.
+"""
+import base64
+import binascii
+import json
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import literal, tuple_
+
+
+class KeysetPage:
+    def __init__(self, items, next_cursor, prev_cursor, total=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(values):
+    data = [{'dt': v.isoformat()} if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(data, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def decode_cursor(token, columns):
+    """Return the cursor's values for ``columns``, or None if ``token`` is missing or invalid.
+
+    Each value must have the Python type of its column, so a cursor that
+    decodes but was edited by hand never reaches the database.
+    """
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        data = json.loads(raw)
+        values = [datetime.fromisoformat(v['dt']) if isinstance(v, dict) else v for v in data]
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        return None
+    if len(values) != len(columns) or not all(map(_matches, values, columns)):
+        return None
+    return values
+
+
+def _matches(value, column):
+    try:
+        expected = column.type.python_type
+    except NotImplementedError:
+        # Untyped expressions such as a search rank: any number or string
+        expected = (int, float, str)
+    if expected is float:
+        expected = (int, float)
+    if isinstance(value, bool) and expected is not bool:
+        return False
+    return isinstance(value, expected)
+
+
+def keyset_paginate(query, order_by, after=None, before=None, per_page=20, descending=True, total=None, columns=False):
+    """Fetch one page of ``query`` ordered by the ``order_by`` columns.
+
+    ``order_by`` must end in a unique column (normally the primary key) so
+    the sort is total. Pass ``after`` to page forward and ``before`` to page
+    back; both are cursors from a previous ``KeysetPage``. ``total`` is
+    passed through for display; callers supply a cached or approximate count
+    rather than paying for ``COUNT(*)``. With ``columns=True``, ``query``
+    selects columns and the items are tuples of them rather than entities.
+    """
+    key = tuple_(*order_by)
+    backwards = False
+    cursor = decode_cursor(before, order_by)
+    if cursor is not None:
+        backwards = True
+    else:
+        cursor = decode_cursor(after, order_by)
+
+    if cursor is not None:
+        bound = tuple_(*[literal(value, column.type) for value, column in zip(cursor, order_by)])
+        query = query.filter(key > bound if descending == backwards else key < bound)
+
+    ascending = descending == backwards
+    ordering = [column.asc() if ascending else column.desc() for column in order_by]
+    width = len(query.column_descriptions) if columns else 1
+    rows = query.add_columns(*order_by).order_by(None).order_by(*ordering).limit(per_page + 1).all()
+
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+    items = [tuple(row[:width]) for row in rows] if columns else [row[0] for row in rows]
+    first_key = encode_cursor(rows[0][width:]) if rows else None
+    last_key = encode_cursor(rows[-1][width:]) if rows else None
+
+    if backwards:
+        next_cursor = last_key
+        prev_cursor = first_key if more else None
+    else:
+        next_cursor = last_key if more else None
+        prev_cursor = first_key if cursor is not None else None
+    return KeysetPage(items, next_cursor, prev_cursor, total)
+
+
+class CountCache:
+    """Per-process memo for expensive counts, refreshed every ``ttl`` seconds."""
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        now = time.monotonic()
+        hit = self._values.get(key)
+        if hit is not None and hit[1] > now:
+            return hit[0]
+        value = compute()
+        with self._lock:
+            self._values[key] = (value, now + self.ttl)
+        return value
+
+    def clear(self, key=None):
+        with self._lock:
+            if key is None:
+                self._values.clear()
+            else:
+                self._values.pop(key, None)
@@ -0,0 +1,327 @@
+"""Related posts and popularity rankings, computed ahead of page views.
+
+The post page used to find related posts with a fresh query on every view:
+the three newest posts in the same category, ignoring tags, and identical
+for every reader. ``post_related`` now holds each published post's best
+``RECOMMEND_RELATED_COUNT`` matches in rank order, so the page reads them
+with one primary-key lookup.
+
+A candidate's score is the sum, over the tags it shares with the post, of
+the tag's inverse document frequency ``log(1 + posts / posts with tag)``,
+plus ``RECOMMEND_CATEGORY_WEIGHT`` if it's in the same category. Sharing a
+rare tag counts for more than sharing a common one. Ties go to the newer
+post. Only the newest ``RECOMMEND_CANDIDATES`` posts of each tag and of the
+category are considered, which bounds the work per post on large sites.
+
+Lists are kept current in two ways:
+
+* Incrementally. After a commit that creates, publishes or re-tags a post,
+  or moves it to another category, that post's list is recomputed. The
+  post is taken out of every other list and inserted again wherever it
+  still beats the weakest entry, so a list it drops out of is one entry
+  short until the next full refresh. This runs on a background thread, off
+  the request.
+* In full. ``flask recommend-refresh`` rebuilds every list, which also
+  settles the slow drift in tag frequencies. Posts that are deleted vanish
+  from every list through ``ON DELETE CASCADE``. Unpublished posts are
+  filtered out when lists are read.
+
+``Post.popularity`` is a time-decayed view count. Each buffered view flush
+adds the new views to it (see view_counter.py). Each ``recommend-refresh``
+multiplies every score by ``0.5 ** (hours since the last decay /
+RECOMMEND_HALF_LIFE_HOURS)``, so a view counts half as much after one
+half-life. Scores that fall below ``RECOMMEND_POPULARITY_FLOOR`` are reset
+to 0. ``popular()`` reads the top of ``idx_post_published_popularity``. The
+time of the last decay is stored in the database, so runs can come from
+cron or from ``recommend-refresh --watch`` and still decay by the right
+amount. When two runs race, only one of them applies the decay.
+
+Configuration (``app.config``):
+
+    RECOMMEND_RELATED_COUNT      6
+    RECOMMEND_CANDIDATES         100
+    RECOMMEND_CATEGORY_WEIGHT    1.0
+    RECOMMEND_HALF_LIFE_HOURS    72
+    RECOMMEND_POPULARITY_FLOOR   0.01
+"""
+import heapq
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from operator import itemgetter
+
+import click
+from sqlalchemy import (Column, DateTime, MetaData, String, Table, case, delete, event, func, inspect, insert, select,
+                        update)
+
+# Keeps IN lists under SQLite's bound-parameter limit
+BATCH = 500
+
+_meta = MetaData()
+recommendation_runs = Table(
+    'recommendation_runs', _meta,
+    Column('name', String(50), primary_key=True),
+    Column('ran_at', DateTime, nullable=False),
+)
+
+
+def idf(tag_posts, total_posts):
+    return math.log(1 + total_posts / max(tag_posts, 1))
+
+
+def top(scores, limit):
+    """The ``limit`` best ``{post_id: score}`` entries, ties broken by newer (higher) id."""
+    return heapq.nlargest(limit, scores.items(), key=itemgetter(1, 0))
+
+
+class Recommendations:
+    def __init__(self, app=None, db=None, post=None, post_tags=None, post_related=None):
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, db, post, post_tags, post_related)
+
+    def init_app(self, app, db, post, post_tags, post_related):
+        app.config.setdefault('RECOMMEND_RELATED_COUNT', 6)
+        app.config.setdefault('RECOMMEND_CANDIDATES', 100)
+        app.config.setdefault('RECOMMEND_CATEGORY_WEIGHT', 1.0)
+        app.config.setdefault('RECOMMEND_HALF_LIFE_HOURS', 72)
+        app.config.setdefault('RECOMMEND_POPULARITY_FLOOR', 0.01)
+        self.app = app
+        self.db = db
+        self.model = post
+        self.post_tags = post_tags
+        self.table = post_related
+        app.extensions['recommendations'] = self
+        event.listen(db.session, 'after_flush', self._collect)
+        event.listen(db.session, 'after_commit', self._apply)
+        event.listen(db.session, 'after_soft_rollback', self._discard)
+
+        @app.cli.command('recommend-refresh')
+        @click.option('--watch', is_flag=True, help='Keep running and refresh every --interval seconds.')
+        @click.option('--interval', default=3600, show_default=True, help='Seconds between runs with --watch.')
+        def refresh_command(watch, interval):
+            """Decay popularity scores and rebuild every related-posts list."""
+            while True:
+                factor = self.decay()
+                count = self.refresh_related()
+                click.echo(f'Popularity decayed by {factor:.3f}; related posts rebuilt for {count} posts.')
+                if not watch:
+                    break
+                time.sleep(interval)
+
+    # Reading
+
+    def related(self, post_id, limit=3, options=()):
+        """Published related posts of ``post_id``, best first."""
+        Post = self.model
+        return (Post.query.options(*options)
+                .join(self.table, self.table.c.related_id == Post.id)
+                .filter(self.table.c.post_id == post_id, Post.is_published == True)  # noqa: E712
+                .order_by(self.table.c.rank).limit(limit).all())
+
+    def popular(self, limit=6, options=()):
+        """Published posts with the highest decayed view counts."""
+        Post = self.model
+        return (Post.query.options(*options)
+                .filter(Post.is_published == True, Post.popularity > 0)  # noqa: E712
+                .order_by(Post.popularity.desc(), Post.id.desc()).limit(limit).all())
+
+    # Popularity
+
+    def decay(self):
+        """Apply the decay owed since the last run; returns the factor applied."""
+        Post = self.model
+        runs = recommendation_runs
+        now = datetime.utcnow()
+        with self.app.app_context(), self.db.engine.begin() as conn:
+            runs.create(conn, checkfirst=True)
+            last = conn.execute(select(runs.c.ran_at).where(runs.c.name == 'decay')).scalar()
+            if last is None:
+                conn.execute(insert(runs).values(name='decay', ran_at=now))
+                return 1.0
+            # Claim the interval; a concurrent run that read the same time updates nothing and stops
+            claimed = conn.execute(update(runs).where(runs.c.name == 'decay', runs.c.ran_at == last)
+                                   .values(ran_at=now)).rowcount
+            if not claimed:
+                return 1.0
+            hours = max((now - last).total_seconds(), 0) / 3600
+            factor = 0.5 ** (hours / self.app.config['RECOMMEND_HALF_LIFE_HOURS'])
+            decayed = Post.popularity * factor
+            conn.execute(update(Post).where(Post.popularity > 0).values(
+                popularity=case((decayed < self.app.config['RECOMMEND_POPULARITY_FLOOR'], 0), else_=decayed)))
+        return factor
+
+    # Related posts
+
+    def refresh_related(self, batch_size=1000):
+        """Rebuild every published post's list in memory; returns the number of posts."""
+        Post, tags_table = self.model, self.post_tags
+        limit = self.app.config['RECOMMEND_RELATED_COUNT']
+        candidates = self.app.config['RECOMMEND_CANDIDATES']
+        weight = self.app.config['RECOMMEND_CATEGORY_WEIGHT']
+        with self.app.app_context():
+            with self.db.engine.connect() as conn:
+                rows = conn.execute(select(Post.id, Post.category_id)
+                                    .where(Post.is_published == True)  # noqa: E712
+                                    .order_by(Post.created_at.desc(), Post.id.desc())).all()
+                posts = dict(rows)
+                post_tags = defaultdict(list)
+                for post_id, tag_id in conn.execute(select(tags_table.c.post_id, tags_table.c.tag_id)):
+                    if post_id in posts:
+                        post_tags[post_id].append(tag_id)
+            tagged, in_category = defaultdict(list), defaultdict(list)
+            # Newest first, as update_related reads them from the indexes
+            for post_id in sorted(posts, reverse=True):
+                for tag_id in post_tags[post_id]:
+                    tagged[tag_id].append(post_id)
+            for post_id, category_id in rows:
+                if category_id is not None:
+                    in_category[category_id].append(post_id)
+            weights = {tag_id: idf(len(ids), len(posts)) for tag_id, ids in tagged.items()}
+
+            ids = sorted(posts)
+            for first in range(0, len(ids), batch_size):
+                rows = []
+                for post_id in ids[first:first + batch_size]:
+                    scores = defaultdict(float)
+                    for tag_id in post_tags[post_id]:
+                        for other in tagged[tag_id][:candidates]:
+                            scores[other] += weights[tag_id]
+                    if posts[post_id] is not None:
+                        for other in in_category[posts[post_id]][:candidates]:
+                            scores[other] += weight
+                    scores.pop(post_id, None)
+                    rows += [{'post_id': post_id, 'rank': rank, 'related_id': other, 'score': score}
+                             for rank, (other, score) in enumerate(top(scores, limit))]
+                with self.db.engine.begin() as conn:
+                    self._replace(conn, ids[first:first + batch_size], rows)
+            with self.db.engine.begin() as conn:
+                published = select(Post.id).where(Post.is_published == True)  # noqa: E712
+                conn.execute(delete(self.table).where(self.table.c.post_id.not_in(published)))
+        return len(ids)
+
+    def update_related(self, post_ids):
+        """Recompute the lists of ``post_ids`` and offer each to its candidates' lists."""
+        Post, tags_table = self.model, self.post_tags
+        limit = self.app.config['RECOMMEND_RELATED_COUNT']
+        candidates = self.app.config['RECOMMEND_CANDIDATES']
+        weight = self.app.config['RECOMMEND_CATEGORY_WEIGHT']
+        with self.app.app_context(), self.db.engine.begin() as conn:
+            posts = dict(conn.execute(select(Post.id, Post.category_id).where(
+                Post.id.in_(post_ids), Post.is_published == True)).all())  # noqa: E712
+            self._replace(conn, post_ids, [])
+            # Taken out of other posts' lists too; the offers below put them back where they still belong
+            changed = list(post_ids)
+            for first in range(0, len(changed), BATCH):
+                conn.execute(delete(self.table).where(self.table.c.related_id.in_(changed[first:first + BATCH])))
+            if not posts:
+                return
+            # Frequencies count published posts only, as in refresh_related
+            total = conn.execute(select(func.count()).select_from(Post)
+                                 .where(Post.is_published == True)).scalar()  # noqa: E712
+            tagged = (select(tags_table.c.post_id).join(Post, Post.id == tags_table.c.post_id)
+                      .where(Post.is_published == True))  # noqa: E712
+            for post_id, category_id in posts.items():
+                tag_ids = conn.execute(select(tags_table.c.tag_id).where(tags_table.c.post_id == post_id)).scalars().all()
+                weights = {tag_id: idf(count, total) for tag_id, count in conn.execute(
+                    tagged.with_only_columns(tags_table.c.tag_id, func.count()).where(tags_table.c.tag_id.in_(tag_ids))
+                    .group_by(tags_table.c.tag_id))} if tag_ids else {}
+                pool = set()
+                for tag_id in tag_ids:
+                    pool.update(conn.execute(tagged.where(tags_table.c.tag_id == tag_id)
+                                             .order_by(tags_table.c.post_id.desc()).limit(candidates)).scalars())
+                if category_id is not None:
+                    pool.update(conn.execute(select(Post.id).where(
+                        Post.category_id == category_id, Post.is_published == True)  # noqa: E712
+                        .order_by(Post.created_at.desc(), Post.id.desc()).limit(candidates)).scalars())
+                pool.discard(post_id)
+                pool = list(pool)
+                scores = {}
+                for first in range(0, len(pool), BATCH):
+                    chunk = pool[first:first + BATCH]
+                    for other, other_category in conn.execute(select(Post.id, Post.category_id).where(
+                            Post.id.in_(chunk), Post.is_published == True)):  # noqa: E712
+                        scores[other] = weight if category_id is not None and other_category == category_id else 0.0
+                    if weights:
+                        for other, tag_id in conn.execute(select(tags_table.c.post_id, tags_table.c.tag_id).where(
+                                tags_table.c.post_id.in_(chunk), tags_table.c.tag_id.in_(list(weights)))):
+                            if other in scores:
+                                scores[other] += weights[tag_id]
+                scores = {other: score for other, score in scores.items() if score > 0}
+                self._replace(conn, [post_id], [
+                    {'post_id': post_id, 'rank': rank, 'related_id': other, 'score': score}
+                    for rank, (other, score) in enumerate(top(scores, limit))])
+                self._offer(conn, post_id, scores, limit)
+
+    def _offer(self, conn, post_id, scores, limit):
+        """Insert ``post_id`` into each candidate's list where it beats the weakest entry."""
+        related = self.table
+        others = list(scores)
+        for first in range(0, len(others), BATCH):
+            chunk = others[first:first + BATCH]
+            lists = defaultdict(dict)
+            for owner, other, score in conn.execute(select(related.c.post_id, related.c.related_id, related.c.score)
+                                                    .where(related.c.post_id.in_(chunk))):
+                lists[owner][other] = score
+            changed, rows = [], []
+            for owner in chunk:
+                current = lists[owner]
+                current.pop(post_id, None)
+                if len(current) >= limit and scores[owner] <= min(current.values()):
+                    continue
+                current[post_id] = scores[owner]
+                changed.append(owner)
+                rows += [{'post_id': owner, 'rank': rank, 'related_id': other, 'score': score}
+                         for rank, (other, score) in enumerate(top(current, limit))]
+            self._replace(conn, changed, rows)
+
+    def _replace(self, conn, post_ids, rows):
+        post_ids = list(post_ids)
+        for first in range(0, len(post_ids), BATCH):
+            conn.execute(delete(self.table).where(self.table.c.post_id.in_(post_ids[first:first + BATCH])))
+        if rows:
+            conn.execute(insert(self.table), rows)
+
+    # Incremental updates, applied only once the change is committed
+
+    def _collect(self, session, flush_context):
+        changed = {obj.id for obj in session.new if isinstance(obj, self.model)}
+        for obj in session.dirty:
+            if isinstance(obj, self.model) and _related_inputs_modified(obj):
+                changed.add(obj.id)
+        if changed:
+            session.info.setdefault('recommendations_changed', set()).update(changed)
+
+    def _apply(self, session):
+        changed = session.info.pop('recommendations_changed', None)
+        if changed:
+            self._pool().submit(self._update, changed)
+
+    def _update(self, post_ids):
+        try:
+            self.update_related(post_ids)
+        except Exception:
+            # The next full refresh catches up
+            self.app.logger.exception('Failed to update related posts for %s', sorted(post_ids))
+
+    def _pool(self):
+        # One thread per process: updates run in commit order and never contend with each other
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(1, thread_name_prefix='recommendations')
+                self._pid = os.getpid()
+            return self._executor
+
+    def _discard(self, session, previous_transaction):
+        session.info.pop('recommendations_changed', None)
+
+
+def _related_inputs_modified(obj):
+    state = inspect(obj)
+    return any(state.attrs[name].history.has_changes() for name in ('tags', 'category_id', 'is_published'))
@@ -0,0 +1,184 @@
+"""Full-text search over posts backed by an SQLite FTS5 index.
+
+``post_fts`` holds a plain-text copy of each post's title, excerpt and content
+keyed by ``rowid = post.id``. It is kept in sync from the ORM: every flush that
+inserts, edits or deletes a ``Post`` updates the matching index row in the same
+transaction, so the routes don't need to know about it.
+
+Searches are ranked with BM25 (title weighted above excerpt above body), the
+last term is treated as a prefix so search-as-you-type works, and
+``snippets()`` returns highlighted fragments that are safe to render.
+
+On databases without FTS5 (or before ``flask search-rebuild`` has created the
+index) ``available`` is False and callers fall back to LIKE matching.
+"""
+import html
+import re
+
+import click
+from markupsafe import Markup, escape
+from sqlalchemy import column, event, func, inspect, literal_column, select, table, text
+
+CREATE_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(
+    title, excerpt, content,
+    tokenize = 'porter unicode61 remove_diacritics 2',
+    prefix = '2 3'
+)
+"""
+
+# Relative BM25 weights for title, excerpt and content.
+WEIGHTS = (10.0, 5.0, 1.0)
+
+INDEXED_FIELDS = ('title', 'excerpt', 'content')
+
+post_fts = table('post_fts', column('rowid'), column('title'), column('excerpt'), column('content'))
+_fts = literal_column('post_fts')
+
+# Snippet markers that can't occur in indexed text; swapped for <mark> after escaping.
+_OPEN, _CLOSE = '\x02', '\x03'
+
+_TAG_RE = re.compile(r'<[^>]*>')
+_SPACE_RE = re.compile(r'\s+')
+_TERM_RE = re.compile(r'\w+\*?', re.UNICODE)
+
+
+def plain_text(value):
+    """Strip tags and entities from post HTML for indexing."""
+    if not value:
+        return ''
+    return _SPACE_RE.sub(' ', html.unescape(_TAG_RE.sub(' ', value))).strip()
+
+
+def to_match_query(search):
+    """Turn free text into a safe FTS5 MATCH expression.
+
+    Every term is quoted (so FTS5 operators in user input are inert) and
+    terms are ANDed together. The last term, or any term the user ended with
+    ``*``, is a prefix match.
+    """
+    terms = _TERM_RE.findall(search)
+    if not terms:
+        return None
+    parts = []
+    for i, term in enumerate(terms):
+        prefix = term.endswith('*') or i == len(terms) - 1
+        parts.append('"%s"%s' % (term.rstrip('*'), '*' if prefix else ''))
+    return ' '.join(parts)
+
+
+class SearchIndex:
+    def __init__(self, app=None, db=None, model=None):
+        self.db = None
+        self.model = None
+        self._available = None
+        if app is not None:
+            self.init_app(app, db, model)
+
+    def init_app(self, app, db, model):
+        self.app = app
+        self.db = db
+        self.model = model
+        app.extensions['search_index'] = self
+        event.listen(db.session, 'after_flush', self._after_flush)
+
+        @app.cli.command('search-rebuild')
+        def search_rebuild_command():
+            """Create the post search index and reindex every post."""
+            count = self.rebuild()
+            click.echo(f'Indexed {count} posts.')
+
+    @property
+    def available(self):
+        if self._available is None:
+            engine = self.db.engine
+            if engine.dialect.name != 'sqlite':
+                self._available = False
+            else:
+                with engine.connect() as conn:
+                    self._available = conn.execute(text(
+                        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'post_fts'"
+                    )).first() is not None
+        return self._available
+
+    def create(self, conn=None):
+        """Create the FTS table if the database supports it."""
+        if self.db.engine.dialect.name != 'sqlite':
+            self._available = False
+            return False
+        if conn is None:
+            with self.db.engine.begin() as conn:
+                conn.execute(text(CREATE_SQL))
+        else:
+            conn.execute(text(CREATE_SQL))
+        self._available = True
+        return True
+
+    def rebuild(self, batch_size=1000):
+        """Recreate the index from the post table. Returns the number of posts indexed."""
+        Post = self.model
+        count = 0
+        with self.db.engine.begin() as conn:
+            self.create(conn)
+            conn.execute(text('DELETE FROM post_fts'))
+            rows = conn.execute(select(Post.id, Post.title, Post.excerpt, Post.content)).yield_per(batch_size)
+            for batch in rows.partitions():
+                conn.execute(text(
+                    'INSERT INTO post_fts (rowid, title, excerpt, content) VALUES (:id, :title, :excerpt, :content)'
+                ), [self._document(*row) for row in batch])
+                count += len(batch)
+            conn.execute(text("INSERT INTO post_fts (post_fts) VALUES ('optimize')"))
+        return count
+
+    # Querying
+
+    def hits(self, search):
+        """Subquery of ``(post_id, rank)`` for posts matching ``search``, best first by ``rank``."""
+        match = to_match_query(search)
+        if match is None:
+            return None
+        return (select(post_fts.c.rowid.label('post_id'), func.bm25(_fts, *WEIGHTS).label('rank'))
+                .where(_fts.op('MATCH')(match))
+                .subquery('search_hits'))
+
+    def snippets(self, search, post_ids, tokens=24):
+        """Highlighted body fragments for ``post_ids`` as ``{post_id: Markup}``."""
+        match = to_match_query(search)
+        if match is None or not post_ids:
+            return {}
+        query = (select(post_fts.c.rowid,
+                        func.snippet(_fts, 2, _OPEN, _CLOSE, '…', tokens))
+                 .where(_fts.op('MATCH')(match), post_fts.c.rowid.in_(post_ids)))
+        return {post_id: _highlight(fragment) for post_id, fragment in self.db.session.execute(query)}
+
+    # Index maintenance
+
+    def _document(self, post_id, title, excerpt, content):
+        return {'id': post_id, 'title': title or '', 'excerpt': plain_text(excerpt), 'content': plain_text(content)}
+
+    def _after_flush(self, session, flush_context):
+        if not self.available:
+            return
+        Post = self.model
+        removed = [obj.id for obj in session.deleted if isinstance(obj, Post)]
+        changed = [obj for obj in session.new if isinstance(obj, Post)]
+        changed += [obj for obj in session.dirty if isinstance(obj, Post)
+                    and _text_modified(obj)]
+        if not removed and not changed:
+            return
+        conn = session.connection()
+        ids = removed + [obj.id for obj in changed]
+        conn.execute(text('DELETE FROM post_fts WHERE rowid = :id'), [{'id': i} for i in ids])
+        if changed:
+            conn.execute(text(
+                'INSERT INTO post_fts (rowid, title, excerpt, content) VALUES (:id, :title, :excerpt, :content)'
+            ), [self._document(obj.id, obj.title, obj.excerpt, obj.content) for obj in changed])
+
+
+def _text_modified(obj):
+    state = inspect(obj)
+    return any(state.attrs[name].history.has_changes() for name in INDEXED_FIELDS)
+
+
+def _highlight(fragment):
+    return Markup(str(escape(fragment)).replace(_OPEN, '<mark>').replace(_CLOSE, '</mark>'))
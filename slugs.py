@@ -0,0 +1,178 @@
+"""Post slugs: generated once, unique, and never broken by a rename.
+
+Slugs used to be built in each create/edit view with a chain of
+``str.replace`` calls. Two posts with the same title failed on the UNIQUE
+constraint, and editing a post through the author dashboard rewrote its slug
+on every save, so every old link to it broke.
+
+* ``slugify()`` folds accents to their base letters ("Café" -> "cafe"), keeps
+  letters and digits from any script, joins words with hyphens and cuts the
+  result at a word boundary within ``SLUG_MAX_LENGTH``.
+* A post added without a slug gets one from its title when the session
+  flushes. If the slug is taken, ``-2``, ``-3``... is appended. A post's
+  former slugs count as taken, so an old link never starts pointing at
+  another post.
+* Slugs change only through ``rename()``, i.e. the slug field on the edit
+  forms. The old slug goes into ``slug_history`` in the same transaction.
+  Requests for it get a 301 to the current URL.
+
+``find()`` resolves a slug with one query that checks both the post's unique
+slug index and the history table's primary key. Each worker keeps the
+results in an LRU map of slug -> post id, so a hot post costs only a
+primary-key fetch. Cached ids are never trusted blindly: if the post is gone
+the entry is dropped and the slug looked up again. A commit that renames or
+deletes a post also drops that post's entries in the worker that made it.
+
+Configuration (``app.config``):
+
+    SLUG_MAX_LENGTH          80
+    SLUG_CACHE_MAX_ENTRIES   10000
+"""
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import delete, event, insert, inspect, or_, select, union_all
+
+APOSTROPHES = re.compile(r"['’]")
+SEPARATORS = re.compile(r'[\W_]+')
+
+
+def slugify(text, max_length=80):
+    """A lower-case, hyphenated slug for ``text``; ``'post'`` if nothing is left of it."""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = APOSTROPHES.sub('', unicodedata.normalize('NFKC', text).lower())
+    slug = SEPARATORS.sub('-', text).strip('-')
+    if len(slug) > max_length:
+        cut = slug[:max_length + 1]
+        slug = cut.rsplit('-', 1)[0] if '-' in cut else slug[:max_length]
+    return slug or 'post'
+
+
+class Slugs:
+    def __init__(self, app=None, db=None, post=None, history=None):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, db, post, history)
+
+    def init_app(self, app, db, post, history):
+        app.config.setdefault('SLUG_MAX_LENGTH', 80)
+        app.config.setdefault('SLUG_CACHE_MAX_ENTRIES', 10000)
+        self.app = app
+        self.db = db
+        self.post = post
+        self.history = history
+        app.extensions['slugs'] = self
+        event.listen(db.session, 'before_flush', self._assign)
+        event.listen(db.session, 'after_flush', self._record)
+        event.listen(db.session, 'after_commit', self._invalidate)
+        event.listen(db.session, 'after_soft_rollback', self._discard)
+
+    def slugify(self, text):
+        return slugify(text, self.app.config['SLUG_MAX_LENGTH'])
+
+    def find(self, slug, query):
+        """The post from ``query`` that has or had ``slug``, or None.
+
+        Compare ``post.slug`` with ``slug`` to tell a former slug, which
+        should redirect, from the current one.
+        """
+        post_id = self._get(slug)
+        if post_id is not None:
+            post = query.filter(self.post.id == post_id).first()
+            if post is not None:
+                return post
+            self.forget(slug)
+        post_id = self.db.session.execute(self._lookup(slug)).scalar()
+        if post_id is None:
+            return None
+        self._set(slug, post_id)
+        return query.filter(self.post.id == post_id).first()
+
+    def unique(self, base, post_id=None, claimed=()):
+        """``base``, or ``base-N`` with the lowest N that no other post has or had."""
+        Post, history = self.post, self.history
+        session = self.db.session
+        taken = set(claimed)
+        for column, owner in ((Post.slug, Post.id), (history.c.slug, history.c.post_id)):
+            statement = select(column).where(or_(column == base, column.startswith(f'{base}-', autoescape=True)))
+            if post_id is not None:
+                statement = statement.where(owner != post_id)
+            taken.update(session.execute(statement).scalars())
+        slug, n = base, 1
+        while slug in taken:
+            n += 1
+            slug = f'{base}-{n}'
+        return slug
+
+    def rename(self, post, value):
+        """Give ``post`` a slug made from ``value``; blank keeps the current one."""
+        slug = self.slugify(value) if value and value.strip() else None
+        if slug and slug != post.slug:
+            post.slug = self.unique(slug, post.id)
+
+    def forget(self, *slugs):
+        """Drop cached lookups for ``slugs`` (all of them if none are given)."""
+        with self._lock:
+            if not slugs:
+                self._entries.clear()
+            for slug in slugs:
+                self._entries.pop(slug, None)
+
+    def _lookup(self, slug):
+        Post, history = self.post, self.history
+        return union_all(select(Post.id).where(Post.slug == slug),
+                         select(history.c.post_id).where(history.c.slug == slug)).limit(1)
+
+    def _get(self, slug):
+        with self._lock:
+            post_id = self._entries.get(slug)
+            if post_id is not None:
+                self._entries.move_to_end(slug)
+            return post_id
+
+    def _set(self, slug, post_id):
+        with self._lock:
+            self._entries[slug] = post_id
+            self._entries.move_to_end(slug)
+            while len(self._entries) > self.app.config['SLUG_CACHE_MAX_ENTRIES']:
+                self._entries.popitem(last=False)
+
+    # Session hooks
+
+    def _assign(self, session, flush_context, instances):
+        claimed = set()
+        for obj in session.new:
+            if isinstance(obj, self.post) and not obj.slug:
+                obj.slug = self.unique(self.slugify(obj.title), claimed=claimed)
+                claimed.add(obj.slug)
+
+    def _record(self, session, flush_context):
+        history = self.history
+        changed = set()
+        for obj in session.dirty:
+            if not isinstance(obj, self.post):
+                continue
+            old = inspect(obj).attrs.slug.history.deleted
+            if not old or not old[0] or old[0] == obj.slug:
+                continue
+            conn = session.connection()
+            # A post going back to a former slug takes it out of its history
+            conn.execute(delete(history).where(history.c.slug == obj.slug, history.c.post_id == obj.id))
+            conn.execute(insert(history).values(slug=old[0], post_id=obj.id, changed_at=datetime.utcnow()))
+            changed.update((old[0], obj.slug))
+        changed.update(obj.slug for obj in session.deleted if isinstance(obj, self.post))
+        if changed:
+            session.info.setdefault('slugs_changed', set()).update(changed)
+
+    def _invalidate(self, session):
+        changed = session.info.pop('slugs_changed', None)
+        if changed:
+            self.forget(*changed)
+
+    def _discard(self, session, previous_transaction):
+        session.info.pop('slugs_changed', None)
@@ -0,0 +1,435 @@
+"""Content-addressed file storage for uploads.
+
+A file is stored under the SHA-256 of its bytes, as
+``<aa>/<bb>/<sha256><ext>``, so the directories stay small however many
+files there are. ``save()`` copies the upload to a temporary file in
+``STORAGE_CHUNK_SIZE`` chunks and hashes it on the way, so large uploads are
+never held in memory. Content that is already stored is not written a
+second time: re-uploading an image costs a hash and a row update.
+
+Backends:
+
+* ``LocalBackend``: a directory tree under ``STORAGE_ROOT``. It is simple,
+  but every web server needs the same directory.
+* ``S3Backend``: any S3-compatible API through boto3 (AWS, MinIO, a moto
+  server...). Set ``STORAGE_S3_ENDPOINT_URL`` for anything but AWS.
+  docker-compose.s3.yml starts a MinIO stand-in. With
+  ``STORAGE_PUBLIC_URL`` pointing at the bucket or a CDN in front of it,
+  pages link to files there directly.
+
+The ``stored_file`` table has one row per key: its size, the number of
+references to it and when it was last saved. ``track()`` names the model
+columns that hold keys. Their changes adjust the counts on flush, in the
+same transaction as the change itself. ``flask storage-gc`` deletes files
+that have been unreferenced for ``STORAGE_GC_GRACE`` seconds. The grace
+period covers an upload whose post hasn't been saved yet. Saving a file
+again restarts the grace period, and a save that races with the collector
+waits on the row and then stores the file afresh. Request code passes its
+session to ``save()``, so the row is written in the request's transaction
+rather than on a second connection that would wait on SQLite's write lock.
+
+Files are served from ``/media/<key>``. The digest is a strong ETag, and
+byte ranges are supported. ``Cache-Control: immutable`` applies, since a
+key's content never changes.
+
+Configuration (``app.config``, defaulting to environment variables of the
+same name):
+
+    STORAGE_BACKEND            local (or s3)
+    STORAGE_ROOT               instance/storage
+    STORAGE_S3_BUCKET          (required for s3)
+    STORAGE_S3_PREFIX          ''
+    STORAGE_S3_ENDPOINT_URL    None (AWS)
+    STORAGE_S3_REGION          None
+    STORAGE_PUBLIC_URL         None (serve through /media)
+    STORAGE_CHUNK_SIZE         65536
+    STORAGE_GC_GRACE           86400 (s)
+"""
+import contextlib
+import hashlib
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+
+import click
+from flask import abort, request, url_for
+from sqlalchemy import delete, event, inspect, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from werkzeug.datastructures import ContentRange
+from werkzeug.http import is_resource_modified
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+ONE_YEAR = 31536000
+KEY = re.compile(r'[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})(\.[a-z0-9]+)?')
+SETTINGS = (
+    ('STORAGE_BACKEND', 'local'),
+    ('STORAGE_S3_BUCKET', None),
+    ('STORAGE_S3_PREFIX', ''),
+    ('STORAGE_S3_ENDPOINT_URL', None),
+    ('STORAGE_S3_REGION', None),
+    ('STORAGE_PUBLIC_URL', None),
+    ('STORAGE_CHUNK_SIZE', 65536),
+    ('STORAGE_GC_GRACE', 86400),
+)
+
+
+def make_key(digest, ext=''):
+    return f'{digest[:2]}/{digest[2:4]}/{digest}{ext.lower()}'
+
+
+def is_key(value):
+    """Whether ``value`` is a storage key, as opposed to e.g. a legacy static path."""
+    return bool(value) and KEY.fullmatch(value) is not None
+
+
+class LocalBackend:
+    def __init__(self, root, chunk_size=65536):
+        self.root = root
+        self.chunk_size = chunk_size
+        # Uploads are staged on the same filesystem, so storing one is a rename
+        self.staging = os.path.join(root, 'tmp')
+        os.makedirs(self.staging, exist_ok=True)
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def size(self, key):
+        """Size in bytes; raises FileNotFoundError for a missing key."""
+        return os.path.getsize(self._path(key))
+
+    def put(self, key, path, content_type=None):
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(path, target)
+
+    def read(self, key, start=0, stop=None):
+        with open(self._path(key), 'rb') as f:
+            f.seek(start)
+            remaining = None if stop is None else stop - start
+            while remaining is None or remaining > 0:
+                chunk = f.read(self.chunk_size if remaining is None else min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    @contextlib.contextmanager
+    def local_copy(self, key):
+        yield self._path(key)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+
+class S3Backend:
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, chunk_size=65536):
+        if boto3 is None:
+            raise RuntimeError('STORAGE_BACKEND = "s3" needs the boto3 package')
+        if not bucket:
+            raise ValueError('STORAGE_S3_BUCKET is not set')
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self.chunk_size = chunk_size
+        self.staging = None
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # Clients are thread-safe but their connection pools don't survive a fork
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                self._client = boto3.client('s3', endpoint_url=self.endpoint_url, region_name=self.region)
+                self._pid = os.getpid()
+            return self._client
+
+    def exists(self, key):
+        try:
+            self.size(key)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def size(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)['ContentLength']
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(key) from e
+            raise
+
+    def put(self, key, path, content_type=None):
+        extra = {'CacheControl': f'public, max-age={ONE_YEAR}, immutable'}
+        if content_type:
+            extra['ContentType'] = content_type
+        # upload_file switches to a multipart upload for large files
+        self.client.upload_file(path, self.bucket, self.prefix + key, ExtraArgs=extra)
+
+    def read(self, key, start=0, stop=None):
+        options = {}
+        if start or stop is not None:
+            options['Range'] = f'bytes={start}-{"" if stop is None else stop - 1}'
+        body = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key, **options)['Body']
+        try:
+            yield from body.iter_chunks(self.chunk_size)
+        finally:
+            body.close()
+
+    @contextlib.contextmanager
+    def local_copy(self, key):
+        fd, path = tempfile.mkstemp(prefix='storage-', suffix=os.path.splitext(key)[1])
+        os.close(fd)
+        try:
+            self.client.download_file(self.bucket, self.prefix + key, path)
+            yield path
+        finally:
+            os.remove(path)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+
+class Storage:
+    def __init__(self, app=None, db=None, table=None):
+        self.backend = None
+        self._tracked = []
+        if app is not None:
+            self.init_app(app, db, table)
+
+    def init_app(self, app, db, table):
+        for name, default in SETTINGS:
+            app.config.setdefault(name, os.environ.get(name, default))
+        app.config.setdefault('STORAGE_ROOT', os.environ.get('STORAGE_ROOT', os.path.join(app.instance_path, 'storage')))
+        self.app = app
+        self.db = db
+        self.table = table
+        chunk_size = int(app.config['STORAGE_CHUNK_SIZE'])
+        backend = app.config['STORAGE_BACKEND']
+        if backend == 'local':
+            self.backend = LocalBackend(app.config['STORAGE_ROOT'], chunk_size)
+        elif backend == 's3':
+            self.backend = S3Backend(app.config['STORAGE_S3_BUCKET'], app.config['STORAGE_S3_PREFIX'],
+                                     app.config['STORAGE_S3_ENDPOINT_URL'], app.config['STORAGE_S3_REGION'],
+                                     chunk_size)
+        else:
+            raise ValueError(f'Unknown STORAGE_BACKEND {backend!r}')
+        app.extensions['storage'] = self
+        app.add_url_rule('/media/<path:key>', 'media', self.send)
+        event.listen(db.session, 'after_flush', self._count_references)
+        event.listen(db.session, 'after_commit', self._committed)
+        event.listen(db.session, 'after_soft_rollback', self._rolled_back)
+
+        @app.cli.command('storage-gc')
+        def gc_command():
+            """Delete stored files that nothing has referenced for STORAGE_GC_GRACE seconds."""
+            count, size = self.collect_garbage()
+            click.echo(f'Deleted {count} unreferenced files ({size:,} bytes).')
+
+    # Writing
+
+    def save(self, stream, ext='', session=None):
+        """Store the rest of ``stream``; returns its key. Identical content is stored once.
+
+        With ``session``, the row is written in that session's transaction; if
+        it rolls back, a file this call added is left unreferenced for
+        ``storage-gc``.
+        """
+        chunk_size = int(self.app.config['STORAGE_CHUNK_SIZE'])
+        digest = hashlib.sha256()
+        size = 0
+        fd, path = tempfile.mkstemp(dir=self.backend.staging, prefix='upload-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            key = make_key(digest.hexdigest(), ext)
+            # The row comes first: once it exists (and was touched just now) the collector leaves the file alone
+            if session is not None:
+                new = self._claim(session.connection(), key, size)
+                if new:
+                    session.info.setdefault('storage_claimed', {})[key] = size
+            else:
+                with self.db.engine.begin() as conn:
+                    new = self._claim(conn, key, size)
+            if new or not self.backend.exists(key):
+                self.backend.put(key, path, mimetypes.guess_type(key)[0])
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        return key
+
+    def track(self, model, columns, keys_for):
+        """Count references held by ``model``'s ``columns``.
+
+        ``keys_for(*values)`` returns the keys referenced by one row's values
+        of those columns; anything that isn't a key is ignored.
+        """
+        for column in columns:
+            # Load a replaced value even if it was expired, so its references can be released
+            event.listen(getattr(model, column), 'set', _replaced, active_history=True)
+        self._tracked.append((model, tuple(columns), keys_for))
+
+    def adjust(self, conn, deltas):
+        """Apply ``{key: change}`` reference count changes on ``conn``."""
+        table = self.table
+        for key, change in deltas.items():
+            if change and is_key(key):
+                conn.execute(update(table).where(table.c.key == key).values(refcount=table.c.refcount + change))
+
+    def collect_garbage(self):
+        """Delete files unreferenced for the grace period; returns ``(files, bytes)`` removed."""
+        table = self.table
+        cutoff = datetime.utcnow() - timedelta(seconds=int(self.app.config['STORAGE_GC_GRACE']))
+        unreferenced = (table.c.refcount <= 0) & (table.c.touched_at < cutoff)
+        count = size = 0
+        with self.app.app_context():
+            with self.db.engine.connect() as conn:
+                candidates = conn.execute(select(table.c.key, table.c.size).where(unreferenced)).all()
+            for key, file_size in candidates:
+                # The file goes before the row is committed, so a concurrent save of the
+                # same content waits for the row and then stores the file again
+                with self.db.engine.begin() as conn:
+                    if conn.execute(delete(table).where(table.c.key == key, unreferenced)).rowcount:
+                        self.backend.delete(key)
+                        count += 1
+                        size += file_size
+        return count, size
+
+    # Reading
+
+    def url(self, key):
+        public = self.app.config['STORAGE_PUBLIC_URL']
+        if public:
+            return f'{public.rstrip("/")}/{key}'
+        return url_for('media', key=key)
+
+    def local_copy(self, key):
+        """Context manager giving a filesystem path with the file's content."""
+        return self.backend.local_copy(key)
+
+    def send(self, key):
+        match = KEY.fullmatch(key)
+        if match is None:
+            abort(404)
+        try:
+            size = self.backend.size(key)
+        except FileNotFoundError:
+            abort(404)
+        etag = match.group(1)
+        response = self.app.response_class(mimetype=mimetypes.guess_type(key)[0] or 'application/octet-stream',
+                                           direct_passthrough=True)
+        response.set_etag(etag)
+        response.accept_ranges = 'bytes'
+        response.cache_control.public = True
+        response.cache_control.max_age = ONE_YEAR
+        response.cache_control.immutable = True
+        if not is_resource_modified(request.environ, etag=etag):
+            response.status_code = 304
+            return response
+
+        start, stop = 0, size
+        ranges = request.range
+        # A single range only, and only while If-Range (if sent) still names this content
+        if ranges is not None and len(ranges.ranges) == 1 and request.if_range.date is None \
+                and request.if_range.etag in (None, etag):
+            bounds = ranges.range_for_length(size)
+            if bounds is None:
+                response.status_code = 416
+                response.headers['Content-Range'] = f'bytes */{size}'
+                return response
+            start, stop = bounds
+            response.status_code = 206
+            response.content_range = ContentRange('bytes', start, stop, size)
+        response.content_length = stop - start
+        if request.method != 'HEAD':
+            response.response = self.backend.read(key, start, stop)
+        return response
+
+    # Internals
+
+    def _claim(self, conn, key, size):
+        """Create or touch ``key``'s row on ``conn``; returns True if it's new."""
+        table = self.table
+        now = datetime.utcnow()
+        dialect = postgresql if conn.dialect.name == 'postgresql' else sqlite
+        inserted = conn.execute(dialect.insert(table).values(key=key, size=size, refcount=0, touched_at=now)
+                                .on_conflict_do_nothing(index_elements=[table.c.key])).rowcount
+        if not inserted:
+            conn.execute(update(table).where(table.c.key == key).values(touched_at=now))
+        return bool(inserted)
+
+    def _committed(self, session):
+        session.info.pop('storage_claimed', None)
+
+    def _rolled_back(self, session, previous_transaction):
+        # The rows went with the transaction. The files stay, unreferenced, for the
+        # collector: another upload of the same content may have stored one and
+        # not committed yet, and its claim only touches the row put back here.
+        claimed = session.info.pop('storage_claimed', None)
+        if not claimed:
+            return
+        try:
+            with self.db.engine.begin() as conn:
+                for key, size in claimed.items():
+                    self._claim(conn, key, size)
+        except Exception:
+            self.app.logger.exception('Could not record %s after a rollback', sorted(claimed))
+
+    def _count_references(self, session, flush_context):
+        if not self._tracked:
+            return
+        deltas = Counter()
+        for model, columns, keys_for in self._tracked:
+            for obj in session.new:
+                if isinstance(obj, model):
+                    deltas.update(keys_for(*(getattr(obj, c) for c in columns)))
+            for obj in session.deleted:
+                if isinstance(obj, model):
+                    deltas.subtract(keys_for(*_committed_values(obj, columns)))
+            for obj in session.dirty:
+                if not isinstance(obj, model):
+                    continue
+                state = inspect(obj)
+                if any(state.attrs[c].history.has_changes() for c in columns):
+                    deltas.subtract(keys_for(*_committed_values(obj, columns)))
+                    deltas.update(keys_for(*(getattr(obj, c) for c in columns)))
+        if any(deltas.values()):
+            self.adjust(session.connection(), deltas)
+
+
+def _replaced(target, value, oldvalue, initiator):
+    return value
+
+
+def _committed_values(obj, columns):
+    state = inspect(obj)
+    values = []
+    for column in columns:
+        history = state.attrs[column].history
+        values.append(history.deleted[0] if history.deleted else getattr(obj, column))
+    return values
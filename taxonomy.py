@@ -0,0 +1,220 @@
+"""Process-wide cache of categories, tags and their published-post counts.
+
+Navigation (category lists, tag clouds, filter dropdowns) appears on almost
+every page but changes rarely. ``TaxonomyCache`` keeps an immutable snapshot
+of it in memory, so rendering those parts of a page needs no queries.
+
+The snapshot is refreshed lazily:
+
+* A commit in this process that touches a category or tag reloads the whole
+  snapshot on next access. A commit that only changes posts (publishing,
+  moving between categories, retagging) recounts the posts and keeps the
+  taxonomy rows as they are.
+* Each such commit also bumps a version stamp file in the instance folder.
+  Other workers compare the stamp (a single ``stat()``) on access and reload
+  when it has moved.
+"""
+import os
+import tempfile
+import threading
+from dataclasses import dataclass
+from types import MappingProxyType
+
+from sqlalchemy import event, func, inspect, select
+
+
+@dataclass(frozen=True)
+class Term:
+    id: int
+    name: str
+    description: str = None
+    post_count: int = 0
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    categories: tuple
+    tags: tuple
+    tag_cloud: tuple
+    categories_by_id: MappingProxyType
+    tags_by_id: MappingProxyType
+    categories_by_name: MappingProxyType
+    tags_by_name: MappingProxyType
+    published_posts: int
+
+
+class VersionStamp:
+    """A version number shared between processes through a small file."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def current(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns)
+
+    def bump(self):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.path) as f:
+                version = int(f.read() or 0) + 1
+        except (FileNotFoundError, ValueError):
+            version = 1
+        # Write-then-rename gives the file a new inode, so readers notice the
+        # change even when two bumps land within the same mtime tick.
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.taxonomy-')
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(version))
+        os.replace(tmp, self.path)
+
+
+class TaxonomyCache:
+    def __init__(self, app=None, db=None, **models):
+        self._snapshot = None
+        self._terms = None
+        self._stamp_seen = None
+        self._stale = None
+        self._own_stamp = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, db, **models)
+
+    def init_app(self, app, db, category, tag, post, post_tags):
+        app.config.setdefault('TAXONOMY_VERSION_FILE', os.path.join(app.instance_path, 'taxonomy.version'))
+        self.app = app
+        self.db = db
+        self.Category, self.Tag, self.Post, self.post_tags = category, tag, post, post_tags
+        self.stamp = VersionStamp(app.config['TAXONOMY_VERSION_FILE'])
+        app.extensions['taxonomy'] = self
+        event.listen(db.session, 'after_flush', self._collect)
+        event.listen(db.session, 'after_commit', self._committed)
+        event.listen(db.session, 'after_soft_rollback', self._discard)
+
+    # Read API
+
+    @property
+    def snapshot(self):
+        stamp = self.stamp.current()
+        if self._snapshot is None or self._stale or stamp != self._stamp_seen:
+            with self._lock:
+                self._refresh(stamp)
+        return self._snapshot
+
+    @property
+    def categories(self):
+        return self.snapshot.categories
+
+    @property
+    def tags(self):
+        return self.snapshot.tags
+
+    @property
+    def published_posts(self):
+        return self.snapshot.published_posts
+
+    @property
+    def tag_cloud(self):
+        """Tags with at least one published post, most used first."""
+        return self.snapshot.tag_cloud
+
+    def category(self, category_id):
+        return self.snapshot.categories_by_id.get(category_id)
+
+    def tag(self, tag_id):
+        return self.snapshot.tags_by_id.get(tag_id)
+
+    def invalidate(self, counts_only=False):
+        """Mark the snapshot stale here and in every other worker."""
+        self._changed('counts' if counts_only else 'all')
+
+    # Loading
+
+    def _refresh(self, stamp):
+        if self._snapshot is not None and not self._stale and stamp == self._stamp_seen:
+            return  # another thread refreshed while we waited for the lock
+        # Other workers' changes could be to anything, so only our own
+        # post-only commits get the cheaper recount.
+        counts_only = self._stale == 'counts' and stamp == self._own_stamp
+        self._stale = None
+        with self.db.engine.connect() as conn:
+            if self._terms is None or not counts_only:
+                self._terms = self._load_terms(conn)
+            category_counts, tag_counts = self._load_counts(conn)
+        categories, tags = self._terms
+        self._snapshot = _build_snapshot(categories, tags, category_counts, tag_counts)
+        self._stamp_seen = stamp
+
+    def _load_terms(self, conn):
+        Category, Tag = self.Category, self.Tag
+        categories = conn.execute(
+            select(Category.id, Category.name, Category.description).order_by(Category.id)).all()
+        tags = conn.execute(select(Tag.id, Tag.name).order_by(Tag.name)).all()
+        return categories, tags
+
+    def _load_counts(self, conn):
+        Post, post_tags = self.Post, self.post_tags
+        category_counts = dict(conn.execute(
+            select(Post.category_id, func.count(Post.id))
+            .where(Post.is_published == True)  # noqa: E712
+            .group_by(Post.category_id)).all())
+        tag_counts = dict(conn.execute(
+            select(post_tags.c.tag_id, func.count(post_tags.c.post_id))
+            .join(Post, Post.id == post_tags.c.post_id)
+            .where(Post.is_published == True)  # noqa: E712
+            .group_by(post_tags.c.tag_id)).all())
+        return category_counts, tag_counts
+
+    # Change tracking
+
+    def _collect(self, session, flush_context):
+        change = session.info.get('taxonomy_change')
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, (self.Category, self.Tag)):
+                change = 'all'
+                break
+            if isinstance(obj, self.Post) and change is None and _affects_counts(obj, session):
+                change = 'counts'
+        if change:
+            session.info['taxonomy_change'] = change
+
+    def _committed(self, session):
+        change = session.info.pop('taxonomy_change', None)
+        if change:
+            self._changed(change)
+
+    def _discard(self, session, previous_transaction):
+        session.info.pop('taxonomy_change', None)
+
+    def _changed(self, change):
+        if change == 'all' or self._stale is None:
+            self._stale = change
+        self.stamp.bump()
+        self._own_stamp = self.stamp.current()
+
+
+def _affects_counts(post, session):
+    if post in session.new or post in session.deleted:
+        return True
+    state = inspect(post)
+    return any(state.attrs[name].history.has_changes() for name in ('is_published', 'category_id', 'tags'))
+
+
+def _build_snapshot(categories, tags, category_counts, tag_counts):
+    category_terms = tuple(Term(id, name, description, category_counts.get(id, 0))
+                           for id, name, description in categories)
+    tag_terms = tuple(Term(id, name, None, tag_counts.get(id, 0)) for id, name in tags)
+    cloud = tuple(sorted((t for t in tag_terms if t.post_count), key=lambda t: (-t.post_count, t.name)))
+    return Snapshot(
+        categories=category_terms,
+        tags=tag_terms,
+        tag_cloud=cloud,
+        categories_by_id=MappingProxyType({t.id: t for t in category_terms}),
+        tags_by_id=MappingProxyType({t.id: t for t in tag_terms}),
+        categories_by_name=MappingProxyType({t.name: t for t in category_terms}),
+        tags_by_name=MappingProxyType({t.name: t for t in tag_terms}),
+        published_posts=sum(category_counts.values()),
+    )
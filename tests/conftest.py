@@ -0,0 +1,26 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The app reads DATABASE_URL at import; keep tests off instance/blog.db
+_tmp = tempfile.mkdtemp(prefix='conexus-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_tmp, 'test.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import app, db, page_cache
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    with app.app_context():
+        db.create_all()
+    page_cache.backend.clear()
+    yield app
+    app.extensions['auth'].pool.shutdown()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,46 @@
+"""Statement budgets for rendered pages (see enforce_query_budget in app.py)."""
+import re
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+
+@pytest.fixture(scope='module')
+def posts(app):
+    from app import Category, Post, Tag, User, db
+    with app.app_context():
+        author = User(username='author', email='author@example.com',
+                      password_hash=generate_password_hash('secret', method='pbkdf2:sha256:1000'))
+        categories = [Category(name=f'Category {i}') for i in range(3)]
+        tags = [Tag(name=f'tag{i}') for i in range(4)]
+        db.session.add_all([author, *categories, *tags])
+        db.session.flush()
+        for i in range(9):
+            post = Post(title=f'Post {i}', content=f'<p>Body {i}</p>', excerpt=f'Excerpt {i}',
+                        user_id=author.id, category_id=categories[i % 3].id)
+            post.tags = [tags[i % 4], tags[(i + 1) % 4]]
+            db.session.add(post)
+        db.session.commit()
+        return [category.id for category in categories]
+
+
+def statements(response):
+    return int(re.search(r'"(\d+) queries"', response.headers['Server-Timing']).group(1))
+
+
+def test_blog_page_is_three_statements(client, posts):
+    client.get(f'/blog?category={posts[0]}')  # loads the taxonomy cache
+    response = client.get('/blog')
+    assert response.status_code == 200
+    assert response.headers['X-Cache'] == 'MISS'
+    assert len(re.findall(r'href="/post/', response.get_data(as_text=True))) >= 9
+    assert statements(response) <= 3
+
+
+def test_page_over_budget_fails(app, client, posts):
+    app.config['SQL_QUERY_BUDGET'] = 1
+    try:
+        with pytest.raises(AssertionError, match='budget 1'):
+            client.get(f'/blog?category={posts[1]}')
+    finally:
+        app.config['SQL_QUERY_BUDGET'] = 12
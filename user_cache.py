@@ -0,0 +1,166 @@
+"""The logged-in user, from a small cache instead of a query per request.
+
+Flask-Login calls ``load_user`` on every request that carries a session. It
+used to run ``User.query.get()`` each time, a user-table query on every
+authenticated page. Every template needs that user to draw the navigation,
+and admin routes need it for the ``is_admin`` check. ``UserCache.load()``
+now returns a ``UserSnapshot``. The snapshot is an immutable view of the
+few columns those checks read (``id``, ``username``, ``is_admin``), taken
+from a per-process LRU cache with a TTL. Only a miss queries the database,
+and it selects just those columns.
+
+A route that reads anything else from ``current_user`` (``email``,
+``posts``...) transparently gets the full ORM object, which is loaded once
+per request on first access. ``snapshot.model`` returns that object
+explicitly.
+
+Commits that insert, change or delete a user drop that user's entry, so the
+worker that made the change sees it at once. Other gunicorn workers see it
+when their entry expires, after at most ``USER_CACHE_TTL`` seconds. That
+includes revoking ``is_admin``, so keep the TTL short.
+
+Configuration (``app.config``):
+
+    USER_CACHE_TTL          60 (seconds; 0 disables the cache)
+    USER_CACHE_MAX_ENTRIES  10000
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from flask_login import UserMixin, user_logged_in
+from sqlalchemy import event, select
+
+SNAPSHOT_FIELDS = ('id', 'username', 'is_admin')
+
+
+class UserSnapshot(UserMixin):
+    """Read-only stand-in for a ``User`` that loads the real row only when needed."""
+
+    __slots__ = ('_values', '_loader', '_model')
+
+    def __init__(self, values, loader):
+        object.__setattr__(self, '_values', dict(zip(SNAPSHOT_FIELDS, values)))
+        object.__setattr__(self, '_loader', loader)
+        object.__setattr__(self, '_model', None)
+
+    @property
+    def id(self):
+        return self._values['id']
+
+    @property
+    def username(self):
+        return self._values['username']
+
+    @property
+    def is_admin(self):
+        return bool(self._values['is_admin'])
+
+    @property
+    def model(self):
+        """The full ``User``, loaded on first use and kept for this request."""
+        if self._model is None:
+            object.__setattr__(self, '_model', self._loader(self.id))
+        return self._model
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'UserSnapshot is read-only; change {name!r} on current_user.model')
+
+    def __repr__(self):
+        return f'<UserSnapshot {self.id} {self.username!r}>'
+
+
+class UserCache:
+    def __init__(self, app=None, db=None, model=None):
+        if app is not None:
+            self.init_app(app, db, model)
+
+    def init_app(self, app, db, model):
+        app.config.setdefault('USER_CACHE_TTL', 60)
+        app.config.setdefault('USER_CACHE_MAX_ENTRIES', 10000)
+        self.app = app
+        self.db = db
+        self.model = model
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        app.extensions['user_cache'] = self
+        event.listen(db.session, 'after_flush', self._collect)
+        event.listen(db.session, 'after_commit', self._invalidate)
+        event.listen(db.session, 'after_soft_rollback', self._discard)
+        user_logged_in.connect(self._logged_in, app)
+
+    def load(self, user_id):
+        """A ``UserSnapshot`` for ``user_id``, or None if there is no such user."""
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+        values = self._get(user_id)
+        if values is None:
+            User = self.model
+            row = self.db.session.execute(
+                select(*(getattr(User, field) for field in SNAPSHOT_FIELDS)).where(User.id == user_id)).first()
+            if row is None:
+                return None
+            values = tuple(row)
+            self._set(user_id, values)
+        return UserSnapshot(values, self._load_model)
+
+    def forget(self, *user_ids):
+        """Drop the cached snapshots of ``user_ids`` (every snapshot if none are given)."""
+        with self._lock:
+            if not user_ids:
+                self._entries.clear()
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def _logged_in(self, app, user):
+        # The login view already has the row; the next request needn't fetch it again
+        if isinstance(user, self.model):
+            self._set(user.id, tuple(getattr(user, field) for field in SNAPSHOT_FIELDS))
+
+    def _load_model(self, user_id):
+        return self.db.session.get(self.model, user_id)
+
+    def _get(self, user_id):
+        with self._lock:
+            item = self._entries.get(user_id)
+            if item is None:
+                return None
+            values, expires = item
+            if expires < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return values
+
+    def _set(self, user_id, values):
+        ttl = self.app.config['USER_CACHE_TTL']
+        if not ttl:
+            return
+        with self._lock:
+            self._entries[user_id] = (values, time.monotonic() + ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.app.config['USER_CACHE_MAX_ENTRIES']:
+                self._entries.popitem(last=False)
+
+    # Invalidation, applied only once the change is committed
+
+    def _collect(self, session, flush_context):
+        changed = {obj.id for obj in list(session.new) + list(session.dirty) + list(session.deleted)
+                   if isinstance(obj, self.model)}
+        if changed:
+            session.info.setdefault('user_cache_changed', set()).update(changed)
+
+    def _invalidate(self, session):
+        changed = session.info.pop('user_cache_changed', None)
+        if changed:
+            self.forget(*changed)
+
+    def _discard(self, session, previous_transaction):
+        session.info.pop('user_cache_changed', None)
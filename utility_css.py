@@ -0,0 +1,582 @@
+"""Generate Tailwind-compatible utility CSS for the classes templates use.
+
+This is a small, dependency-free stand-in for the Tailwind compiler that the
+CDN script ran in every visitor's browser. ``generate(tokens)`` takes every
+candidate word found in the templates. It emits Preflight plus a rule for
+each word that names a utility this module knows, with variants such as
+``hover:``, ``focus:``, ``group-hover:``, ``dark:`` (class strategy) and
+the responsive screens. Other words are ignored, as Tailwind itself ignores
+them. The cascade order follows Tailwind's: utilities in core plugin order,
+then state variants, then ``dark:``, then each screen from small to large.
+
+The theme matches Tailwind 3 defaults plus the ``primary`` colours the site
+used to pass to the CDN script as ``tailwind.config``. Only the utility
+families the site needs are covered. A new class outside them shows up in
+``unknown_utilities()`` output from ``flask assets-build``.
+"""
+import re
+
+SCREENS = (('sm', 640), ('md', 768), ('lg', 1024), ('xl', 1280), ('2xl', 1536))
+
+# Variant name -> selector template; {} is the escaped class selector.
+VARIANTS = {
+    'first': '{}:first-child',
+    'last': '{}:last-child',
+    'group-hover': '.group:hover {}',
+    'focus-within': '{}:focus-within',
+    'hover': '{}:hover',
+    'focus': '{}:focus',
+    'focus-visible': '{}:focus-visible',
+    'active': '{}:active',
+    'disabled': '{}:disabled',
+    'dark': '.dark {}',
+}
+VARIANT_ORDER = list(VARIANTS)
+
+PALETTE = {
+    'gray': ('#f9fafb', '#f3f4f6', '#e5e7eb', '#d1d5db', '#9ca3af', '#6b7280', '#4b5563', '#374151', '#1f2937', '#111827', '#030712'),
+    'red': ('#fef2f2', '#fee2e2', '#fecaca', '#fca5a5', '#f87171', '#ef4444', '#dc2626', '#b91c1c', '#991b1b', '#7f1d1d', '#450a0a'),
+    'orange': ('#fff7ed', '#ffedd5', '#fed7aa', '#fdba74', '#fb923c', '#f97316', '#ea580c', '#c2410c', '#9a3412', '#7c2d12', '#431407'),
+    'yellow': ('#fefce8', '#fef9c3', '#fef08a', '#fde047', '#facc15', '#eab308', '#ca8a04', '#a16207', '#854d0e', '#713f12', '#422006'),
+    'green': ('#f0fdf4', '#dcfce7', '#bbf7d0', '#86efac', '#4ade80', '#22c55e', '#16a34a', '#15803d', '#166534', '#14532d', '#052e16'),
+    'blue': ('#eff6ff', '#dbeafe', '#bfdbfe', '#93c5fd', '#60a5fa', '#3b82f6', '#2563eb', '#1d4ed8', '#1e40af', '#1e3a8a', '#172554'),
+    'indigo': ('#eef2ff', '#e0e7ff', '#c7d2fe', '#a5b4fc', '#818cf8', '#6366f1', '#4f46e5', '#4338ca', '#3730a3', '#312e81', '#1e1b4b'),
+    'purple': ('#faf5ff', '#f3e8ff', '#e9d5ff', '#d8b4fe', '#c084fc', '#a855f7', '#9333ea', '#7e22ce', '#6b21a8', '#581c87', '#3b0764'),
+    'pink': ('#fdf2f8', '#fce7f3', '#fbcfe8', '#f9a8d4', '#f472b6', '#ec4899', '#db2777', '#be185d', '#9d174d', '#831843', '#500724'),
+}
+SHADES = ('50', '100', '200', '300', '400', '500', '600', '700', '800', '900', '950')
+
+COLORS = {'white': '#fff', 'black': '#000', 'transparent': 'transparent', 'current': 'currentColor'}
+for _family, _values in PALETTE.items():
+    COLORS.update({f'{_family}-{shade}': value for shade, value in zip(SHADES, _values)})
+# Site theme (formerly tailwind.config in base.html). The config only gave
+# 50/500/600/700, which are blue's; the templates use the rest of the scale.
+COLORS.update({f'primary-{shade}': value for shade, value in zip(SHADES, PALETTE['blue'])})
+
+FONT_SIZES = {
+    'xs': ('0.75rem', '1rem'), 'sm': ('0.875rem', '1.25rem'), 'base': ('1rem', '1.5rem'),
+    'lg': ('1.125rem', '1.75rem'), 'xl': ('1.25rem', '1.75rem'), '2xl': ('1.5rem', '2rem'),
+    '3xl': ('1.875rem', '2.25rem'), '4xl': ('2.25rem', '2.5rem'), '5xl': ('3rem', '1'),
+    '6xl': ('3.75rem', '1'), '7xl': ('4.5rem', '1'), '8xl': ('6rem', '1'), '9xl': ('8rem', '1'),
+}
+FONT_WEIGHTS = {'thin': 100, 'extralight': 200, 'light': 300, 'normal': 400, 'medium': 500,
+                'semibold': 600, 'bold': 700, 'extrabold': 800, 'black': 900}
+FONT_FAMILIES = {
+    'sans': 'ui-sans-serif, system-ui, sans-serif, "Apple Color Emoji", "Segoe UI Emoji", "Segoe UI Symbol", "Noto Color Emoji"',
+    'serif': 'ui-serif, Georgia, Cambria, "Times New Roman", Times, serif',
+    'mono': 'ui-monospace, SFMono-Regular, Menlo, Monaco, Consolas, "Liberation Mono", "Courier New", monospace',
+}
+TRACKING = {'tighter': '-0.05em', 'tight': '-0.025em', 'normal': '0em', 'wide': '0.025em', 'wider': '0.05em', 'widest': '0.1em'}
+LEADING = {'none': '1', 'tight': '1.25', 'snug': '1.375', 'normal': '1.5', 'relaxed': '1.625', 'loose': '2'}
+MAX_WIDTHS = {'none': 'none', 'xs': '20rem', 'sm': '24rem', 'md': '28rem', 'lg': '32rem', 'xl': '36rem',
+              '2xl': '42rem', '3xl': '48rem', '4xl': '56rem', '5xl': '64rem', '6xl': '72rem', '7xl': '80rem',
+              'full': '100%', 'prose': '65ch', 'screen-sm': '640px', 'screen-md': '768px', 'screen-lg': '1024px',
+              'screen-xl': '1280px'}
+RADII = {'none': '0px', 'sm': '0.125rem', '': '0.25rem', 'md': '0.375rem', 'lg': '0.5rem', 'xl': '0.75rem',
+         '2xl': '1rem', '3xl': '1.5rem', 'full': '9999px'}
+SHADOWS = {
+    'sm': '0 1px 2px 0 rgb(0 0 0 / 0.05)',
+    '': '0 1px 3px 0 rgb(0 0 0 / 0.1), 0 1px 2px -1px rgb(0 0 0 / 0.1)',
+    'md': '0 4px 6px -1px rgb(0 0 0 / 0.1), 0 2px 4px -2px rgb(0 0 0 / 0.1)',
+    'lg': '0 10px 15px -3px rgb(0 0 0 / 0.1), 0 4px 6px -4px rgb(0 0 0 / 0.1)',
+    'xl': '0 20px 25px -5px rgb(0 0 0 / 0.1), 0 8px 10px -6px rgb(0 0 0 / 0.1)',
+    '2xl': '0 25px 50px -12px rgb(0 0 0 / 0.25)',
+    'inner': 'inset 0 2px 4px 0 rgb(0 0 0 / 0.05)',
+    'none': '0 0 #0000',
+}
+GRADIENT_DIRECTIONS = {'t': 'to top', 'tr': 'to top right', 'r': 'to right', 'br': 'to bottom right',
+                       'b': 'to bottom', 'bl': 'to bottom left', 'l': 'to left', 'tl': 'to top left'}
+EASE = 'cubic-bezier(0.4, 0, 0.2, 1)'
+TRANSITIONS = {
+    '': 'color, background-color, border-color, text-decoration-color, fill, stroke, opacity, box-shadow, transform, filter, backdrop-filter',
+    'all': 'all',
+    'colors': 'color, background-color, border-color, text-decoration-color, fill, stroke',
+    'opacity': 'opacity',
+    'shadow': 'box-shadow',
+    'transform': 'transform',
+}
+TRANSFORM = ('translate(var(--tw-translate-x), var(--tw-translate-y)) rotate(var(--tw-rotate)) '
+             'skewX(var(--tw-skew-x)) skewY(var(--tw-skew-y)) scaleX(var(--tw-scale-x)) scaleY(var(--tw-scale-y))')
+BOX_SHADOW = 'var(--tw-ring-offset-shadow, 0 0 #0000), var(--tw-ring-shadow, 0 0 #0000), var(--tw-shadow)'
+
+DISPLAY = {'block': 'block', 'inline-block': 'inline-block', 'inline': 'inline', 'flex': 'flex',
+           'inline-flex': 'inline-flex', 'table': 'table', 'grid': 'grid', 'inline-grid': 'inline-grid',
+           'contents': 'contents', 'hidden': 'none'}
+STATIC = {
+    # name: (family, declarations)
+    'sr-only': ('accessibility', 'position: absolute; width: 1px; height: 1px; padding: 0; margin: -1px; '
+                                 'overflow: hidden; clip: rect(0, 0, 0, 0); white-space: nowrap; border-width: 0'),
+    'pointer-events-none': ('pointerEvents', 'pointer-events: none'),
+    'pointer-events-auto': ('pointerEvents', 'pointer-events: auto'),
+    'static': ('position', 'position: static'),
+    'fixed': ('position', 'position: fixed'),
+    'absolute': ('position', 'position: absolute'),
+    'relative': ('position', 'position: relative'),
+    'sticky': ('position', 'position: sticky'),
+    'mx-auto': ('margin', 'margin-left: auto; margin-right: auto'),
+    'flex-1': ('flex', 'flex: 1 1 0%'),
+    'flex-auto': ('flex', 'flex: 1 1 auto'),
+    'flex-none': ('flex', 'flex: none'),
+    'flex-shrink-0': ('flexShrink', 'flex-shrink: 0'),
+    'shrink-0': ('flexShrink', 'flex-shrink: 0'),
+    'flex-grow': ('flexGrow', 'flex-grow: 1'),
+    'grow': ('flexGrow', 'flex-grow: 1'),
+    'transform': ('transform', f'transform: {TRANSFORM}'),
+    'cursor-pointer': ('cursor', 'cursor: pointer'),
+    'appearance-none': ('appearance', 'appearance: none'),
+    'flex-row': ('flexDirection', 'flex-direction: row'),
+    'flex-col': ('flexDirection', 'flex-direction: column'),
+    'flex-wrap': ('flexWrap', 'flex-wrap: wrap'),
+    'flex-nowrap': ('flexWrap', 'flex-wrap: nowrap'),
+    'items-start': ('alignItems', 'align-items: flex-start'),
+    'items-end': ('alignItems', 'align-items: flex-end'),
+    'items-center': ('alignItems', 'align-items: center'),
+    'items-baseline': ('alignItems', 'align-items: baseline'),
+    'items-stretch': ('alignItems', 'align-items: stretch'),
+    'justify-start': ('justifyContent', 'justify-content: flex-start'),
+    'justify-end': ('justifyContent', 'justify-content: flex-end'),
+    'justify-center': ('justifyContent', 'justify-content: center'),
+    'justify-between': ('justifyContent', 'justify-content: space-between'),
+    'justify-around': ('justifyContent', 'justify-content: space-around'),
+    'overflow-auto': ('overflow', 'overflow: auto'),
+    'overflow-hidden': ('overflow', 'overflow: hidden'),
+    'overflow-x-auto': ('overflow', 'overflow-x: auto'),
+    'overflow-y-auto': ('overflow', 'overflow-y: auto'),
+    'scroll-smooth': ('scrollBehavior', 'scroll-behavior: smooth'),
+    'truncate': ('textOverflow', 'overflow: hidden; text-overflow: ellipsis; white-space: nowrap'),
+    'whitespace-nowrap': ('whitespace', 'white-space: nowrap'),
+    'whitespace-pre-line': ('whitespace', 'white-space: pre-line'),
+    'break-words': ('wordBreak', 'overflow-wrap: break-word'),
+    'border-solid': ('borderStyle', 'border-style: solid'),
+    'border-dashed': ('borderStyle', 'border-style: dashed'),
+    'border-none': ('borderStyle', 'border-style: none'),
+    'object-cover': ('objectFit', 'object-fit: cover'),
+    'object-contain': ('objectFit', 'object-fit: contain'),
+    'text-left': ('textAlign', 'text-align: left'),
+    'text-center': ('textAlign', 'text-align: center'),
+    'text-right': ('textAlign', 'text-align: right'),
+    'text-justify': ('textAlign', 'text-align: justify'),
+    'align-middle': ('verticalAlign', 'vertical-align: middle'),
+    'uppercase': ('textTransform', 'text-transform: uppercase'),
+    'lowercase': ('textTransform', 'text-transform: lowercase'),
+    'capitalize': ('textTransform', 'text-transform: capitalize'),
+    'italic': ('fontStyle', 'font-style: italic'),
+    'underline': ('textDecoration', 'text-decoration-line: underline'),
+    'line-through': ('textDecoration', 'text-decoration-line: line-through'),
+    'no-underline': ('textDecoration', 'text-decoration-line: none'),
+    'antialiased': ('fontSmoothing', '-webkit-font-smoothing: antialiased; -moz-osx-font-smoothing: grayscale'),
+    'outline-none': ('outlineStyle', 'outline: 2px solid transparent; outline-offset: 2px'),
+    'resize-none': ('resize', 'resize: none'),
+    'resize-y': ('resize', 'resize: vertical'),
+}
+
+# Tailwind's core plugin order, which is also the cascade order of utilities.
+FAMILIES = [
+    'accessibility', 'pointerEvents', 'position', 'inset', 'zIndex', 'gridColumn', 'margin', 'lineClamp',
+    'display', 'height', 'maxHeight', 'minHeight', 'width', 'minWidth', 'maxWidth', 'flex', 'flexShrink',
+    'flexGrow', 'scale', 'transform', 'cursor', 'resize', 'appearance', 'gridTemplateColumns', 'flexDirection',
+    'flexWrap', 'alignItems', 'justifyContent', 'gap', 'space', 'divideWidth', 'divideColor', 'overflow',
+    'scrollBehavior', 'textOverflow', 'whitespace', 'wordBreak', 'borderRadius', 'borderWidth', 'borderStyle',
+    'borderColor', 'backgroundColor', 'backgroundImage', 'gradientColorStops', 'objectFit', 'padding',
+    'textAlign', 'verticalAlign', 'fontFamily', 'fontSize', 'fontWeight', 'textTransform', 'fontStyle',
+    'lineHeight', 'letterSpacing', 'textColor', 'textDecoration', 'fontSmoothing', 'placeholderColor',
+    'opacity', 'boxShadow', 'outlineStyle', 'ringWidth', 'ringColor', 'ringOffsetWidth', 'ringOffsetColor',
+    'transitionProperty', 'transitionDuration',
+]
+FAMILY_INDEX = {name: i for i, name in enumerate(FAMILIES)}
+
+# Sub-order inside a family so that e.g. p-4 comes before px-2 before pt-1.
+SIDES = {'': ('',), 'x': ('left', 'right'), 'y': ('top', 'bottom'), 't': ('top',), 'r': ('right',),
+         'b': ('bottom',), 'l': ('left',)}
+SIDE_ORDER = ['', 'x', 'y', 't', 'r', 'b', 'l']
+CORNERS = {'': ('top-left', 'top-right', 'bottom-right', 'bottom-left'), 't': ('top-left', 'top-right'),
+           'r': ('top-right', 'bottom-right'), 'b': ('bottom-right', 'bottom-left'),
+           'l': ('top-left', 'bottom-left'), 'tl': ('top-left',), 'tr': ('top-right',),
+           'br': ('bottom-right',), 'bl': ('bottom-left',)}
+CORNER_ORDER = ['', 't', 'r', 'b', 'l', 'tl', 'tr', 'br', 'bl']
+
+CHILDREN = ' > :not([hidden]) ~ :not([hidden])'
+
+PREFLIGHT = """
+*, ::before, ::after { box-sizing: border-box; border-width: 0; border-style: solid; border-color: #e5e7eb; }
+::before, ::after { --tw-content: ''; }
+html { line-height: 1.5; -webkit-text-size-adjust: 100%; -moz-tab-size: 4; tab-size: 4;
+  font-family: ui-sans-serif, system-ui, sans-serif, "Apple Color Emoji", "Segoe UI Emoji", "Segoe UI Symbol", "Noto Color Emoji";
+  font-feature-settings: normal; font-variation-settings: normal; -webkit-tap-highlight-color: transparent; }
+body { margin: 0; line-height: inherit; }
+hr { height: 0; color: inherit; border-top-width: 1px; }
+abbr:where([title]) { text-decoration: underline dotted; }
+h1, h2, h3, h4, h5, h6 { font-size: inherit; font-weight: inherit; }
+a { color: inherit; text-decoration: inherit; }
+b, strong { font-weight: bolder; }
+code, kbd, samp, pre { font-family: ui-monospace, SFMono-Regular, Menlo, Monaco, Consolas, "Liberation Mono", "Courier New", monospace; font-size: 1em; }
+small { font-size: 80%; }
+sub, sup { font-size: 75%; line-height: 0; position: relative; vertical-align: baseline; }
+sub { bottom: -0.25em; }
+sup { top: -0.5em; }
+table { text-indent: 0; border-color: inherit; border-collapse: collapse; }
+button, input, optgroup, select, textarea { font-family: inherit; font-feature-settings: inherit; font-variation-settings: inherit;
+  font-size: 100%; font-weight: inherit; line-height: inherit; letter-spacing: inherit; color: inherit; margin: 0; padding: 0; }
+button, select { text-transform: none; }
+button, input:where([type='button']), input:where([type='reset']), input:where([type='submit']) {
+  -webkit-appearance: button; background-color: transparent; background-image: none; }
+:-moz-focusring { outline: auto; }
+:-moz-ui-invalid { box-shadow: none; }
+progress { vertical-align: baseline; }
+::-webkit-inner-spin-button, ::-webkit-outer-spin-button { height: auto; }
+[type='search'] { -webkit-appearance: textfield; outline-offset: -2px; }
+::-webkit-search-decoration { -webkit-appearance: none; }
+::-webkit-file-upload-button { -webkit-appearance: button; font: inherit; }
+summary { display: list-item; }
+blockquote, dl, dd, h1, h2, h3, h4, h5, h6, hr, figure, p, pre { margin: 0; }
+fieldset { margin: 0; padding: 0; }
+legend { padding: 0; }
+ol, ul, menu { list-style: none; margin: 0; padding: 0; }
+dialog { padding: 0; }
+textarea { resize: vertical; }
+input::placeholder, textarea::placeholder { opacity: 1; color: #9ca3af; }
+button, [role="button"] { cursor: pointer; }
+:disabled { cursor: default; }
+img, svg, video, canvas, audio, iframe, embed, object { display: block; vertical-align: middle; }
+img, video { max-width: 100%; height: auto; }
+[hidden] { display: none; }
+*, ::before, ::after, ::backdrop { --tw-translate-x: 0; --tw-translate-y: 0; --tw-rotate: 0; --tw-skew-x: 0;
+  --tw-skew-y: 0; --tw-scale-x: 1; --tw-scale-y: 1; --tw-ring-offset-width: 0px; --tw-ring-offset-color: #fff;
+  --tw-ring-color: rgb(59 130 246 / 0.5); --tw-ring-offset-shadow: 0 0 #0000; --tw-ring-shadow: 0 0 #0000;
+  --tw-shadow: 0 0 #0000; }
+"""
+
+
+def spacing(value):
+    """Tailwind spacing scale: ``4`` -> ``1rem``, ``px``, ``0.5``, ``auto``, fractions, ``full``..."""
+    if value == 'px':
+        return '1px'
+    if value == '0':
+        return '0px'
+    if value == 'auto':
+        return 'auto'
+    if value == 'full':
+        return '100%'
+    if re.fullmatch(r'\d+/\d+', value):
+        numerator, denominator = map(int, value.split('/'))
+        return f'{numerator / denominator * 100:g}%'
+    if re.fullmatch(r'\d+(\.5)?', value):
+        return f'{float(value) / 4:g}rem'
+    return None
+
+
+def color(value):
+    """``blue-900`` or ``blue-900/20`` -> CSS colour, or None."""
+    name, _, alpha = value.partition('/')
+    hex_value = COLORS.get(name)
+    if hex_value is None or (alpha and not alpha.isdigit()):
+        return None
+    if not alpha or not hex_value.startswith('#'):
+        return hex_value
+    digits = hex_value[1:]
+    if len(digits) == 3:
+        digits = ''.join(c * 2 for c in digits)
+    r, g, b = (int(digits[i:i + 2], 16) for i in (0, 2, 4))
+    return f'rgb({r} {g} {b} / {int(alpha) / 100:g})'
+
+
+def utility(name):
+    """``(family, sub-order, declarations, selector suffix)`` for a utility, or None."""
+    if name in STATIC:
+        family, declarations = STATIC[name]
+        return family, 0, declarations, ''
+    if name in DISPLAY:
+        return 'display', 0, f'display: {DISPLAY[name]}', ''
+
+    m = re.fullmatch(r'(-?)(m|p)([xytrbl]?)-(.+)', name)
+    if m:
+        negative, kind, side, value = m.groups()
+        size = spacing(value)
+        if size is None or (negative and kind == 'p'):
+            return None
+        if negative:
+            size = f'-{size}'
+        prop = 'margin' if kind == 'm' else 'padding'
+        declarations = '; '.join(f'{prop}-{s}: {size}' if s else f'{prop}: {size}' for s in SIDES[side])
+        return ('margin' if kind == 'm' else 'padding'), SIDE_ORDER.index(side), declarations, ''
+
+    m = re.fullmatch(r'(w|h|min-h|min-w|max-h)-(.+)', name)
+    if m:
+        kind, value = m.groups()
+        special = {'screen': '100vh' if 'h' in kind else '100vw', 'min': 'min-content', 'max': 'max-content',
+                   'fit': 'fit-content'}
+        size = special.get(value) or spacing(value)
+        if size is None:
+            return None
+        prop, family = {'w': ('width', 'width'), 'h': ('height', 'height'), 'min-h': ('min-height', 'minHeight'),
+                        'min-w': ('min-width', 'minWidth'), 'max-h': ('max-height', 'maxHeight')}[kind]
+        return family, 0, f'{prop}: {size}', ''
+
+    m = re.fullmatch(r'max-w-(.+)', name)
+    if m and m.group(1) in MAX_WIDTHS:
+        return 'maxWidth', 0, f'max-width: {MAX_WIDTHS[m.group(1)]}', ''
+
+    m = re.fullmatch(r'(-?)(inset|top|right|bottom|left)-(.+)', name)
+    if m:
+        negative, side, value = m.groups()
+        size = spacing(value)
+        if size is None:
+            return None
+        size = f'-{size}' if negative else size
+        sides = ('top', 'right', 'bottom', 'left') if side == 'inset' else (side,)
+        return 'inset', ['inset', 'top', 'right', 'bottom', 'left'].index(side), \
+            '; '.join(f'{s}: {size}' for s in sides), ''
+
+    m = re.fullmatch(r'z-(\d+|auto)', name)
+    if m:
+        return 'zIndex', 0, f'z-index: {m.group(1)}', ''
+
+    m = re.fullmatch(r'col-span-(\d+|full)', name)
+    if m:
+        span = m.group(1)
+        value = '1 / -1' if span == 'full' else f'span {span} / span {span}'
+        return 'gridColumn', 0, f'grid-column: {value}', ''
+
+    m = re.fullmatch(r'grid-cols-(\d+|none)', name)
+    if m:
+        n = m.group(1)
+        value = 'none' if n == 'none' else f'repeat({n}, minmax(0, 1fr))'
+        return 'gridTemplateColumns', 0, f'grid-template-columns: {value}', ''
+
+    m = re.fullmatch(r'line-clamp-(\d+|none)', name)
+    if m:
+        n = m.group(1)
+        if n == 'none':
+            return 'lineClamp', 0, 'overflow: visible; display: block; -webkit-box-orient: horizontal; -webkit-line-clamp: none', ''
+        return 'lineClamp', 0, f'overflow: hidden; display: -webkit-box; -webkit-box-orient: vertical; -webkit-line-clamp: {n}', ''
+
+    m = re.fullmatch(r'gap-([xy]-)?(.+)', name)
+    if m:
+        axis, value = m.groups()
+        size = spacing(value)
+        if size is None:
+            return None
+        prop = {None: 'gap', 'x-': 'column-gap', 'y-': 'row-gap'}[axis]
+        return 'gap', [None, 'x-', 'y-'].index(axis), f'{prop}: {size}', ''
+
+    m = re.fullmatch(r'space-([xy])-(.+)', name)
+    if m:
+        axis, value = m.groups()
+        size = spacing(value)
+        if size is None:
+            return None
+        prop = 'margin-left' if axis == 'x' else 'margin-top'
+        return 'space', 'xy'.index(axis), f'{prop}: {size}', CHILDREN
+
+    m = re.fullmatch(r'divide-([xy])(?:-(\d+))?', name)
+    if m:
+        axis, width = m.groups()
+        width = f'{width or 1}px'
+        if axis == 'y':
+            declarations = f'border-top-width: {width}; border-bottom-width: 0'
+        else:
+            declarations = f'border-left-width: {width}; border-right-width: 0'
+        return 'divideWidth', 'xy'.index(axis), declarations, CHILDREN
+
+    m = re.fullmatch(r'divide-(.+)', name)
+    if m and color(m.group(1)):
+        return 'divideColor', 0, f'border-color: {color(m.group(1))}', CHILDREN
+
+    m = re.fullmatch(r'rounded(?:-(tl|tr|br|bl|t|r|b|l))?(?:-(.+))?', name)
+    if m:
+        corner, size = m.group(1) or '', m.group(2) or ''
+        if size not in RADII:
+            return None
+        declarations = '; '.join(f'border-{c}-radius: {RADII[size]}' for c in CORNERS[corner]) \
+            if corner else f'border-radius: {RADII[size]}'
+        return 'borderRadius', CORNER_ORDER.index(corner), declarations, ''
+
+    m = re.fullmatch(r'border(?:-([xytrbl]))?(?:-(\d+))?', name)
+    if m:
+        side, width = m.group(1) or '', m.group(2)
+        width = f'{width}px' if width else '1px'
+        if side:
+            declarations = '; '.join(f'border-{s}-width: {width}' for s in SIDES[side])
+        else:
+            declarations = f'border-width: {width}'
+        return 'borderWidth', SIDE_ORDER.index(side), declarations, ''
+
+    m = re.fullmatch(r'border-(.+)', name)
+    if m and color(m.group(1)):
+        return 'borderColor', 0, f'border-color: {color(m.group(1))}', ''
+
+    m = re.fullmatch(r'bg-gradient-to-(tl|tr|br|bl|t|r|b|l)', name)
+    if m:
+        return 'backgroundImage', 0, \
+            f'background-image: linear-gradient({GRADIENT_DIRECTIONS[m.group(1)]}, var(--tw-gradient-stops))', ''
+
+    m = re.fullmatch(r'bg-(.+)', name)
+    if m and color(m.group(1)):
+        return 'backgroundColor', 0, f'background-color: {color(m.group(1))}', ''
+
+    m = re.fullmatch(r'(from|via|to)-(.+)', name)
+    if m and color(m.group(2)):
+        stop, value = m.group(1), color(m.group(2))
+        if stop == 'from':
+            declarations = (f'--tw-gradient-from: {value} var(--tw-gradient-from-position); '
+                            '--tw-gradient-to: rgb(255 255 255 / 0) var(--tw-gradient-to-position); '
+                            '--tw-gradient-stops: var(--tw-gradient-from), var(--tw-gradient-to)')
+        elif stop == 'via':
+            declarations = ('--tw-gradient-to: rgb(255 255 255 / 0) var(--tw-gradient-to-position); '
+                            f'--tw-gradient-stops: var(--tw-gradient-from), {value} var(--tw-gradient-via-position), '
+                            'var(--tw-gradient-to)')
+        else:
+            declarations = f'--tw-gradient-to: {value} var(--tw-gradient-to-position)'
+        return 'gradientColorStops', ['from', 'via', 'to'].index(stop), declarations, ''
+
+    m = re.fullmatch(r'font-(.+)', name)
+    if m:
+        value = m.group(1)
+        if value in FONT_WEIGHTS:
+            return 'fontWeight', 0, f'font-weight: {FONT_WEIGHTS[value]}', ''
+        if value in FONT_FAMILIES:
+            return 'fontFamily', 0, f'font-family: {FONT_FAMILIES[value]}', ''
+        return None
+
+    m = re.fullmatch(r'text-(.+)', name)
+    if m:
+        value = m.group(1)
+        if value in FONT_SIZES:
+            size, line_height = FONT_SIZES[value]
+            return 'fontSize', 0, f'font-size: {size}; line-height: {line_height}', ''
+        if color(value):
+            return 'textColor', 0, f'color: {color(value)}', ''
+        return None
+
+    m = re.fullmatch(r'tracking-(.+)', name)
+    if m and m.group(1) in TRACKING:
+        return 'letterSpacing', 0, f'letter-spacing: {TRACKING[m.group(1)]}', ''
+
+    m = re.fullmatch(r'leading-(.+)', name)
+    if m and (m.group(1) in LEADING or spacing(m.group(1))):
+        return 'lineHeight', 0, f'line-height: {LEADING.get(m.group(1)) or spacing(m.group(1))}', ''
+
+    m = re.fullmatch(r'placeholder-(.+)', name)
+    if m and color(m.group(1)):
+        return 'placeholderColor', 0, f'color: {color(m.group(1))}', '::placeholder'
+
+    m = re.fullmatch(r'opacity-(\d+)', name)
+    if m:
+        return 'opacity', 0, f'opacity: {int(m.group(1)) / 100:g}', ''
+
+    m = re.fullmatch(r'shadow(?:-(.+))?', name)
+    if m and (m.group(1) or '') in SHADOWS:
+        return 'boxShadow', 0, f'--tw-shadow: {SHADOWS[m.group(1) or ""]}; box-shadow: {BOX_SHADOW}', ''
+
+    m = re.fullmatch(r'ring(?:-(\d+))?', name)
+    if m:
+        width = m.group(1) or '3'
+        return 'ringWidth', 0, (
+            '--tw-ring-offset-shadow: 0 0 0 var(--tw-ring-offset-width) var(--tw-ring-offset-color); '
+            f'--tw-ring-shadow: 0 0 0 calc({width}px + var(--tw-ring-offset-width)) var(--tw-ring-color); '
+            'box-shadow: var(--tw-ring-offset-shadow), var(--tw-ring-shadow), var(--tw-shadow, 0 0 #0000)'), ''
+
+    m = re.fullmatch(r'ring-offset-(\d+)', name)
+    if m:
+        return 'ringOffsetWidth', 0, f'--tw-ring-offset-width: {m.group(1)}px', ''
+
+    m = re.fullmatch(r'ring-offset-(.+)', name)
+    if m and color(m.group(1)):
+        return 'ringOffsetColor', 0, f'--tw-ring-offset-color: {color(m.group(1))}', ''
+
+    m = re.fullmatch(r'ring-(.+)', name)
+    if m and color(m.group(1)):
+        return 'ringColor', 0, f'--tw-ring-color: {color(m.group(1))}', ''
+
+    m = re.fullmatch(r'scale-(\d+)', name)
+    if m:
+        scale = int(m.group(1)) / 100
+        return 'scale', 0, f'--tw-scale-x: {scale:g}; --tw-scale-y: {scale:g}; transform: {TRANSFORM}', ''
+
+    m = re.fullmatch(r'transition(?:-(.+))?', name)
+    if m and (m.group(1) or '') in TRANSITIONS:
+        return 'transitionProperty', 0, (f'transition-property: {TRANSITIONS[m.group(1) or ""]}; '
+                                         f'transition-timing-function: {EASE}; transition-duration: 150ms'), ''
+
+    m = re.fullmatch(r'duration-(\d+)', name)
+    if m:
+        return 'transitionDuration', 0, f'transition-duration: {m.group(1)}ms', ''
+
+    return None
+
+
+def escape_class(name):
+    return re.sub(r'([^a-zA-Z0-9_-])', r'\\\1', name)
+
+
+def parse(token):
+    """Split ``md:dark:hover:bg-gray-600`` into ``(screen, variants, utility)``, or None."""
+    *prefixes, base = token.split(':')
+    screen = None
+    variants = []
+    for prefix in prefixes:
+        screens = [name for name, _ in SCREENS]
+        if prefix in screens and screen is None and not variants:
+            screen = prefix
+        elif prefix in VARIANTS and prefix not in variants:
+            variants.append(prefix)
+        else:
+            return None
+    rule = utility(base)
+    if rule is None:
+        return None
+    return screen, variants, rule
+
+
+def rule_for(token, screen, variants, rule):
+    family, sub_order, declarations, suffix = rule
+    selector = '.' + escape_class(token)
+    # The innermost variant is written last: dark:hover:x is .dark .x:hover
+    for variant in reversed(variants):
+        selector = VARIANTS[variant].format(selector)
+    return f'{selector}{suffix} {{ {declarations}; }}'
+
+
+def sort_key(token, screen, variants, rule):
+    screens = [name for name, _ in SCREENS]
+    return (
+        screens.index(screen) + 1 if screen else 0,
+        'dark' in variants,
+        sorted(VARIANT_ORDER.index(v) for v in variants),
+        FAMILY_INDEX[rule[0]],
+        rule[1],
+        token,
+    )
+
+
+def generate(tokens):
+    """CSS for the utilities among ``tokens``: Preflight, then utilities in cascade order."""
+    parsed = []
+    for token in set(tokens):
+        result = parse(token)
+        if result is not None:
+            parsed.append((token, *result))
+    parsed.sort(key=lambda item: sort_key(*item))
+
+    out = [PREFLIGHT.strip()]
+    current_screen = None
+    for token, screen, variants, rule in parsed:
+        if screen != current_screen:
+            if current_screen is not None:
+                out.append('}')
+            if screen is not None:
+                out.append(f'@media (min-width: {dict(SCREENS)[screen]}px) {{')
+            current_screen = screen
+        out.append(rule_for(token, screen, variants, rule))
+    if current_screen is not None:
+        out.append('}')
+    return '\n'.join(out) + '\n'
+
+
+def unknown_utilities(tokens):
+    """Tokens shaped like utilities that ``generate`` has no rule for."""
+    shaped = re.compile(r'^(?:[a-z0-9-]+:)*-?(?:bg|text|border|rounded|shadow|p[xytrbl]?|m[xytrbl]?|w|h|'
+                        r'max-w|min-h|min-w|gap|space-[xy]|divide|font|grid-cols|col-span|ring|from|via|to|'
+                        r'opacity|duration|transition|scale|z|top|right|bottom|left|inset|leading|tracking|'
+                        r'line-clamp|placeholder)-[a-z0-9./-]+$')
+    return sorted(t for t in set(tokens) if shaped.match(t) and parse(t) is None)
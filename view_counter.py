@@ -0,0 +1,258 @@
+"""Buffered view counting for post pages.
+
+Instead of one UPDATE + COMMIT per page view, increments are collected in an
+in-process buffer and written back with a single batched
+``UPDATE post SET views = views + ?`` statement (which also adds them to the
+decayed ``popularity`` score). A flush happens every
+``VIEW_COUNTER_FLUSH_INTERVAL`` seconds, as soon as ``VIEW_COUNTER_FLUSH_THRESHOLD``
+views are pending, and once more when the process exits.
+
+Every increment is also appended to a small per-process journal file. If a
+worker dies before it can flush, the next process to start replays the
+journal, so a crash loses no views (at worst a batch may be counted twice if
+the process dies between the commit and the journal cleanup). Journals are
+named after the process id plus a random token, so a worker that is given
+a dead worker's pid replays that worker's journal instead of appending to it.
+
+Callbacks registered with ``on_flush`` run in the same transaction as the
+batched UPDATE, so anything they write commits or rolls back with it.
+"""
+import atexit
+import glob
+import os
+import threading
+import uuid
+from collections import Counter
+
+from sqlalchemy import text
+
+# popularity is the decayed view count that recommendations.py ranks by
+FLUSH_SQL = text('UPDATE post SET views = COALESCE(views, 0) + :n, popularity = popularity + :n WHERE id = :id')
+
+
+class ViewCounter:
+    def __init__(self, app=None, db=None):
+        self._lock = threading.Lock()
+        self._pending = Counter()
+        self._total = 0
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._journal_name = None
+        self._journal = None
+        self._on_flush = []
+        self.app = None
+        self.db = None
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        app.config.setdefault('VIEW_COUNTER_FLUSH_INTERVAL', 5.0)
+        app.config.setdefault('VIEW_COUNTER_FLUSH_THRESHOLD', 500)
+        app.config.setdefault('VIEW_COUNTER_JOURNAL_DIR', os.path.join(app.instance_path, 'views'))
+        self.app = app
+        self.db = db
+        app.extensions['view_counter'] = self
+        app.add_template_filter(self.view_count, 'view_count')
+        atexit.register(self.shutdown)
+
+    # Public API
+
+    def increment(self, post_id, n=1):
+        """Record ``n`` views of ``post_id`` without touching the database."""
+        self._ensure_worker()
+        with self._lock:
+            self._pending[post_id] += n
+            self._total += n
+            if self._journal is not None:
+                self._journal.write(f'{post_id} {n}\n')
+            full = self._total >= self.app.config['VIEW_COUNTER_FLUSH_THRESHOLD']
+        if full:
+            self._wakeup.set()
+
+    def on_flush(self, callback):
+        """Call ``callback(conn, batch)`` with every ``{post_id: views}`` batch as it is written."""
+        self._on_flush.append(callback)
+
+    def pending(self, post_id):
+        """Views recorded for ``post_id`` that have not been flushed yet."""
+        return self._pending.get(post_id, 0)
+
+    def view_count(self, post):
+        """Approximately current view count: stored value plus buffered views."""
+        return (post.views or 0) + self.pending(post.id)
+
+    def flush(self):
+        """Write all buffered increments in one transaction.
+
+        On failure the increments are merged back into the buffer so the next
+        flush retries them.
+        """
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, Counter()
+            self._total = 0
+            rotated = self._rotate_journal()
+        try:
+            self._apply(batch)
+        except Exception:
+            with self._lock:
+                self._pending.update(batch)
+                self._total += sum(batch.values())
+                self._restore_journal(rotated)
+            self.app.logger.exception('Failed to flush %d buffered post views', sum(batch.values()))
+            return 0
+        if rotated:
+            os.remove(rotated)
+        return sum(batch.values())
+
+    def shutdown(self):
+        """Flush on process exit and drop the journal once it is empty."""
+        self.flush()
+        with self._lock:
+            if self._journal is None or self._pid != os.getpid() or self._pending:
+                return
+            self._journal.close()
+            self._journal = None
+            os.remove(self._journal_path())
+
+    def recover(self):
+        """Replay journals left behind by processes that exited without flushing."""
+        journal_dir = self.app.config['VIEW_COUNTER_JOURNAL_DIR']
+        if not journal_dir or not os.path.isdir(journal_dir):
+            return 0
+        recovered = 0
+        for path in glob.glob(os.path.join(journal_dir, '*.log*')):
+            if self._owns(path):
+                continue
+            pid = _journal_pid(path)
+            # Our own pid on another process's journal means that process is gone
+            if pid is None or (pid != os.getpid() and _pid_alive(pid)):
+                continue
+            replaying = _replaying_pid(path)
+            if replaying is not None and replaying != os.getpid() and _pid_alive(replaying):
+                continue  # another worker is replaying it right now
+            claimed = f'{path}.replay-{os.getpid()}'
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue  # another worker got there first
+            batch = _read_journal(claimed)
+            try:
+                self._apply(batch)
+            except Exception:
+                os.rename(claimed, path)
+                raise
+            os.remove(claimed)
+            recovered += sum(batch.values())
+        return recovered
+
+    # Internals
+
+    def _apply(self, batch):
+        if not batch:
+            return
+        params = [{'id': post_id, 'n': n} for post_id, n in batch.items()]
+        with self.app.app_context():
+            with self.db.engine.begin() as conn:
+                conn.execute(FLUSH_SQL, params)
+                for callback in self._on_flush:
+                    callback(conn, batch)
+
+    def _ensure_worker(self):
+        # Started lazily so that each forked gunicorn worker gets its own thread
+        # and journal rather than inheriting the master's.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._pending = Counter()
+            self._total = 0
+            self._journal_name = f'{self._pid}-{uuid.uuid4().hex[:12]}'
+            self._journal = self._open_journal()
+            self._thread = threading.Thread(target=self._run, name='view-counter-flush', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        interval = self.app.config['VIEW_COUNTER_FLUSH_INTERVAL']
+        try:
+            self.recover()
+        except Exception:
+            self.app.logger.exception('Failed to replay view counter journals')
+        while True:
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def _journal_path(self):
+        journal_dir = self.app.config['VIEW_COUNTER_JOURNAL_DIR']
+        if not journal_dir:
+            return None
+        return os.path.join(journal_dir, f'{self._journal_name}.log')
+
+    def _owns(self, path):
+        # The live journal and its rotated copies belong to this process
+        return (self._journal_name is not None and self._pid == os.getpid()
+                and os.path.basename(path).startswith(f'{self._journal_name}.'))
+
+    def _open_journal(self):
+        path = self._journal_path()
+        if path is None:
+            return None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return open(path, 'a', buffering=1)
+
+    def _rotate_journal(self):
+        # Called with the lock held: the journal for the batch being flushed is
+        # moved aside so new increments go to a fresh file.
+        if self._journal is None:
+            return None
+        path = self._journal_path()
+        self._journal.close()
+        rotated = f'{path}.{self._pid}-flushing'
+        os.rename(path, rotated)
+        self._journal = open(path, 'a', buffering=1)
+        return rotated
+
+    def _restore_journal(self, rotated):
+        # A failed flush puts its batch back in the buffer; its journal lines go
+        # back into the live journal so a later crash can still recover them.
+        if rotated is None or self._journal is None:
+            return
+        with open(rotated) as f:
+            self._journal.write(f.read())
+        os.remove(rotated)
+
+
+def _journal_pid(path):
+    name = os.path.basename(path).split('.', 1)[0].split('-', 1)[0]
+    return int(name) if name.isdigit() else None
+
+
+def _replaying_pid(path):
+    # Claimed journals end in .replay-<pid of the process replaying them>
+    head, _, pid = path.rpartition('.replay-')
+    return int(pid) if head and pid.isdigit() else None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _read_journal(path):
+    batch = Counter()
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
+                batch[int(parts[0])] += int(parts[1])
+    return batch